@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8
+"""
+Benchmark the bag downloader against a local S3 stand-in.
+
+This generates synthetic bags, uploads them to an S3-compatible server, and
+times ``download_bag()`` and ``download_compressed_bag()`` across a range of
+worker counts, chunk sizes, hedging percentiles and compression backends.  By default it starts the stand-in from
+``local_s3.py``; pass ``--endpoint-url`` to use another server (e.g. MinIO).
+
+Each download runs in a fresh process, so we can measure its peak memory,
+and the results are written as JSON so they can be compared across commits:
+
+    pip install -e ".[s3]"
+    python benchmarks/bench_download.py run --output before.json
+    git checkout my-branch
+    python benchmarks/bench_download.py run --output after.json
+    python benchmarks/bench_download.py compare before.json after.json
+
+The bags are generated from a fixed seed, so every run downloads the same
+files.  Use ``--scale`` to make the files smaller for a quick check.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import boto3
+
+from local_s3 import LocalS3Server
+
+KiB = 1024
+MiB = 1024 * KiB
+
+# Each profile is a list of ``(count, min_size, max_size)``.  The large files
+# are bigger than the S3 provider's default multipart threshold, so they're
+# fetched with concurrent Range requests.
+PROFILES = {
+    "many-small": [(2000, 1 * KiB, 64 * KiB)],
+    "few-large": [(4, 96 * MiB, 96 * MiB)],
+    "mixed": [
+        (1000, 1 * KiB, 64 * KiB),
+        (8, 1 * MiB, 16 * MiB),
+        (1, 96 * MiB, 96 * MiB),
+    ],
+}
+
+BUCKET = "wellcomecollection-storage-benchmarks"
+
+# The stand-in doesn't check credentials, but boto3 won't sign a request
+# without some.
+DUMMY_CREDENTIALS = {
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}
+
+
+def _s3_client(endpoint_url, **kwargs):
+    return boto3.client("s3", endpoint_url=endpoint_url, **kwargs)
+
+
+def _synthetic_files(profile, scale, seed):
+    """
+    Yields ``(name, contents)`` for every file in a synthetic bag.
+
+    The contents are random, so they don't compress -- like the JPEG 2000s
+    and video files that make up most of our bags.
+    """
+    rng = random.Random("%s-%d" % (profile, seed))
+
+    yield "bagit.txt", b"BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n"
+    yield "bag-info.txt", b"External-Identifier: %s\n" % profile.encode("ascii")
+
+    index = 0
+    for count, min_size, max_size in PROFILES[profile]:
+        for _ in range(count):
+            size = max(1, int(rng.randint(min_size, max_size) * scale))
+            yield "data/objects/%05d.jp2" % index, rng.randbytes(size)
+            index += 1
+
+
+def create_bag(s3_client, profile, scale, seed):
+    """
+    Upload a synthetic bag to the S3 stand-in, and return a storage manifest
+    that describes it.
+    """
+    prefix = "%s/scale-%s/seed-%d" % (profile, scale, seed)
+
+    manifest_files = []
+    tag_manifest_files = []
+
+    for name, contents in _synthetic_files(profile, scale, seed):
+        path = "v1/%s" % name
+        s3_client.put_object(Bucket=BUCKET, Key="%s/%s" % (prefix, path), Body=contents)
+
+        manifest_file = {
+            "name": name,
+            "path": path,
+            "size": len(contents),
+            "checksum": hashlib.sha256(contents).hexdigest(),
+        }
+
+        if name.startswith("data/"):
+            manifest_files.append(manifest_file)
+        else:
+            tag_manifest_files.append(manifest_file)
+
+    return {
+        "id": "benchmarks/%s" % profile,
+        "space": {"id": "benchmarks"},
+        "info": {"externalIdentifier": profile},
+        "version": "v1",
+        "createdDate": "2020-01-01T00:00:00.000000Z",
+        "location": {
+            "provider": {"id": "amazon-s3"},
+            "bucket": BUCKET,
+            "path": prefix,
+        },
+        "replicaLocations": [],
+        "manifest": {"checksumAlgorithm": "SHA-256", "files": manifest_files},
+        "tagManifest": {"checksumAlgorithm": "SHA-256", "files": tag_manifest_files},
+    }
+
+
+def _max_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes; macOS reports bytes.
+    if sys.platform == "darwin":
+        return max_rss
+    else:
+        return max_rss * 1024
+
+
+def _download_once(job):
+    """
+    Run a single download, and return its timings.  This runs in a fresh
+    process, so the peak memory is for this download alone.
+    """
+    from wellcome_storage_service import (
+        DownloadStats,
+        HedgingPolicy,
+        download_bag,
+        download_compressed_bag,
+    )
+    from wellcome_storage_service import downloader
+
+    class LocalS3Provider(downloader.S3InfrequentAccessProvider):
+        def _new_s3_client(self, config):
+            return _s3_client(job["endpoint_url"], config=config)
+
+    downloader.register_provider("amazon-s3", LocalS3Provider)
+
+    if job["chunk_size"] is not None:
+        downloader.CHUNK_SIZE = job["chunk_size"]
+
+    baseline_rss = _max_rss_bytes()
+    stats = DownloadStats()
+    out_dir = tempfile.mkdtemp(dir=job["scratch_dir"])
+
+    try:
+        start = time.perf_counter()
+
+        if job["function"] == "download_bag":
+            download_bag(
+                job["storage_manifest"],
+                out_dir=out_dir,
+                max_workers=job["max_workers"],
+                verify=job["verify"],
+                listener=stats,
+                hedging=(
+                    HedgingPolicy(percentile=job["hedging"]) if job["hedging"] else None
+                ),
+            )
+        else:
+            compression, _, threads = job["compression"].partition(":")
+            download_compressed_bag(
+                job["storage_manifest"],
+                out_path=os.path.join(out_dir, "bag.tar"),
+                listener=stats,
+                compression=compression,
+                threads=int(threads) if threads else None,
+                skip_compressed=job["skip_compressed_files"],
+            )
+
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_dir)
+
+    summary = stats.summary()
+
+    return {
+        "seconds": seconds,
+        "bytes": summary["bytes"],
+        "baseline_rss_bytes": baseline_rss,
+        "max_rss_bytes": _max_rss_bytes(),
+        "time_to_first_byte_p50": summary["time_to_first_byte"]["p50"],
+        "time_to_first_byte_p99": summary["time_to_first_byte"]["p99"],
+        "read_seconds": summary["read_seconds"],
+        "write_seconds": summary["write_seconds"],
+        "hedged": summary["hedged"],
+    }
+
+
+def _run_in_fresh_process(job):
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, mp_context=context
+    ) as executor:
+        return executor.submit(_download_once, job).result()
+
+
+def _jobs(args):
+    """
+    Yields the configurations to benchmark for a bag: ``download_bag()`` with
+    every combination of worker count and chunk size, then a compressed
+    download with each compression backend (which is always sequential, and
+    uses tarfile's buffering).
+    """
+    for max_workers in args.workers:
+        for chunk_size in args.chunk_sizes:
+            for hedging in args.hedging:
+                yield {
+                    "function": "download_bag",
+                    "max_workers": max_workers or None,
+                    "chunk_size": chunk_size,
+                    "hedging": hedging or None,
+                }
+
+    if not args.skip_compressed:
+        for compression in args.compressions:
+            yield {
+                "function": "download_compressed_bag",
+                "max_workers": None,
+                "chunk_size": None,
+                "hedging": None,
+                "compression": compression,
+                "skip_compressed_files": args.skip_compressed_files,
+            }
+
+
+def _summarise(config, runs):
+    seconds = statistics.median(r["seconds"] for r in runs)
+    size = runs[0]["bytes"]
+
+    return dict(
+        config,
+        runs=runs,
+        bytes=size,
+        median_seconds=seconds,
+        hedged=statistics.median(r["hedged"] for r in runs),
+        throughput=size / seconds,
+        max_rss_bytes=max(r["max_rss_bytes"] for r in runs),
+        rss_increase_bytes=max(
+            r["max_rss_bytes"] - r["baseline_rss_bytes"] for r in runs
+        ),
+    )
+
+
+def _config_label(result):
+    return "%-10s %-23s workers=%-4s chunk=%-8s hedge=%-4s compression=%-6s" % (
+        result["profile"],
+        result["function"],
+        result["max_workers"] or "-",
+        result["chunk_size"] or "-",
+        "p%d" % result["hedging"] if result.get("hedging") else "-",
+        result.get("compression") or "-",
+    )
+
+
+def _git_commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=here, stderr=subprocess.DEVNULL
+        )
+        status = subprocess.check_output(
+            ["git", "status", "--porcelain", "--", ".."],
+            cwd=here,
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    commit = commit.decode("ascii").strip()
+    return commit + "-dirty" if status.strip() else commit
+
+
+def _environment(args):
+    from wellcome_storage_service.version import __version__
+
+    return {
+        "commit": _git_commit(),
+        "client_version": __version__,
+        "date": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "boto3": boto3.__version__,
+        "endpoint_url": args.endpoint_url or "local-s3",
+        "scale": args.scale,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "verify": args.verify,
+    }
+
+
+def _benchmark(args, endpoint_url, scratch_dir):
+    s3_client = _s3_client(endpoint_url)
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    results = []
+
+    for profile in args.profiles:
+        print("Creating %s bag..." % profile, file=sys.stderr)
+        storage_manifest = create_bag(
+            s3_client, profile=profile, scale=args.scale, seed=args.seed
+        )
+
+        for config in _jobs(args):
+            job = dict(
+                config,
+                endpoint_url=endpoint_url,
+                storage_manifest=storage_manifest,
+                scratch_dir=scratch_dir,
+                verify=args.verify,
+            )
+            runs = [_run_in_fresh_process(job) for _ in range(args.repeat)]
+
+            result = _summarise(dict(config, profile=profile), runs)
+            results.append(result)
+
+            print(
+                "%s %8.1f MiB/s  %6.2fs  peak RSS %6.1f MiB (+%.1f MiB)  hedged %d"
+                % (
+                    _config_label(result),
+                    result["throughput"] / MiB,
+                    result["median_seconds"],
+                    result["max_rss_bytes"] / MiB,
+                    result["rss_increase_bytes"] / MiB,
+                    result["hedged"],
+                ),
+                file=sys.stderr,
+            )
+
+    return results
+
+
+def run(args):
+    for name, value in DUMMY_CREDENTIALS.items():
+        os.environ.setdefault(name, value)
+
+    scratch_dir = tempfile.mkdtemp(prefix="bench_download_", dir=args.scratch_dir)
+
+    try:
+        if args.endpoint_url:
+            results = _benchmark(args, args.endpoint_url, scratch_dir)
+        else:
+            with LocalS3Server(root=os.path.join(scratch_dir, "s3")) as server:
+                results = _benchmark(args, server.endpoint_url, scratch_dir)
+    finally:
+        shutil.rmtree(scratch_dir)
+
+    output = {"environment": _environment(args), "results": results}
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(output, outfile, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+
+
+def _result_key(result):
+    return (
+        result["profile"],
+        result["function"],
+        result["max_workers"],
+        result["chunk_size"],
+        result.get("hedging"),
+        result.get("compression"),
+    )
+
+
+def compare(args):
+    with open(args.before) as infile:
+        before = json.load(infile)
+    with open(args.after) as infile:
+        after = json.load(infile)
+
+    for name in ("commit", "platform", "endpoint_url", "scale", "seed"):
+        if before["environment"].get(name) != after["environment"].get(name):
+            print(
+                "%s: %s -> %s"
+                % (
+                    name,
+                    before["environment"].get(name),
+                    after["environment"].get(name),
+                )
+            )
+    print()
+
+    before_results = {_result_key(r): r for r in before["results"]}
+
+    for result in after["results"]:
+        try:
+            old = before_results[_result_key(result)]
+        except KeyError:
+            continue
+
+        print(
+            "%s %8.1f -> %8.1f MiB/s (%+6.1f%%)   peak RSS %6.1f -> %6.1f MiB"
+            % (
+                _config_label(result),
+                old["throughput"] / MiB,
+                result["throughput"] / MiB,
+                (result["throughput"] / old["throughput"] - 1) * 100,
+                old["max_rss_bytes"] / MiB,
+                result["max_rss_bytes"] / MiB,
+            )
+        )
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def _profile_list(value):
+    profiles = value.split(",")
+    for profile in profiles:
+        if profile not in PROFILES:
+            raise argparse.ArgumentTypeError(
+                "Unknown profile %r; choose from %s" % (profile, ", ".join(PROFILES))
+            )
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument(
+        "--profiles", type=_profile_list, default=list(PROFILES), help="e.g. mixed"
+    )
+    run_parser.add_argument(
+        "--workers",
+        type=_int_list,
+        default=[0, 4, 16],
+        help="Values of max_workers to try; 0 means download sequentially",
+    )
+    run_parser.add_argument(
+        "--chunk-sizes", type=_int_list, default=[8096, 64 * KiB, 1 * MiB]
+    )
+    run_parser.add_argument(
+        "--hedging",
+        type=_int_list,
+        default=[0],
+        help="Percentiles to try for a HedgingPolicy in download_bag; 0 means no hedging",
+    )
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiply every file size by this"
+    )
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument(
+        "--verify", action="store_true", help="Verify checksums while downloading"
+    )
+    run_parser.add_argument("--skip-compressed", action="store_true")
+    run_parser.add_argument(
+        "--compressions",
+        type=lambda value: value.split(","),
+        default=["gzip"],
+        help="Compression backends for download_compressed_bag, as name[:threads], e.g. gzip,gzip:8,zstd:8,none",
+    )
+    run_parser.add_argument(
+        "--skip-compressed-files",
+        action="store_true",
+        help="Don't compress files that are already compressed (all of them, in these bags)",
+    )
+    run_parser.add_argument(
+        "--endpoint-url", help="Use this S3-compatible server, not the stand-in"
+    )
+    run_parser.add_argument(
+        "--scratch-dir", help="Where to put the stand-in's data and the downloads"
+    )
+    run_parser.add_argument("--output", help="Write the results to this JSON file")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare the results from two runs"
+    )
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
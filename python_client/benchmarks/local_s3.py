@@ -0,0 +1,200 @@
+# -*- encoding: utf-8
+"""
+A minimal S3-compatible server, which serves objects from a local directory.
+
+This is a stand-in for S3 in the benchmarks: it speaks enough of the S3
+REST API (path-style CreateBucket, PutObject, GetObject and HeadObject,
+including Range requests) for boto3 to talk to it, so a benchmark exercises
+the same SDK and HTTP code as a real download, without the variance of a
+real network.  It doesn't check signatures, and doesn't do multipart uploads.
+
+    with LocalS3Server(root="/tmp/s3") as server:
+        s3_client = boto3.client("s3", endpoint_url=server.endpoint_url, ...)
+
+"""
+
+import email.utils
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(?P<start>\d+)-(?P<end>\d*)$")
+
+
+def _read_aws_chunked(rfile, write):
+    """
+    Decode a body sent with ``Content-Encoding: aws-chunked``, which newer
+    versions of botocore use to send a checksum after the object.
+    """
+    while True:
+        header = rfile.readline().strip()
+        size = int(header.split(b";")[0], 16)
+        if size == 0:
+            break
+        write(rfile.read(size))
+        rfile.readline()
+
+    # Skip any trailing headers, up to the blank line.
+    while rfile.readline().strip():
+        pass
+
+
+class _S3RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Buffer the response, so the headers and the start of the body go out
+    # together; otherwise every small GET waits ~40ms for a delayed ACK.
+    # The buffer is flushed after every request.
+    wbufsize = COPY_BUFFER_SIZE
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_expect_100(self):
+        # boto3 waits for the "100 Continue" before it sends the body of
+        # a PutObject, so it can't sit in the buffer.
+        result = super().handle_expect_100()
+        self.wfile.flush()
+        return result
+
+    def _path(self):
+        bucket_and_key = unquote(urlparse(self.path).path).lstrip("/")
+        bucket, _, key = bucket_and_key.partition("/")
+        return key, os.path.join(self.server.root, bucket, key)
+
+    def _send_error(self, status, code):
+        body = (
+            "<?xml version='1.0' encoding='UTF-8'?>"
+            "<Error><Code>%s</Code></Error>" % code
+        ).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        key, path = self._path()
+
+        if not key:
+            os.makedirs(path, exist_ok=True)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        md5 = hashlib.md5()
+
+        with open(path, "wb") as out_file:
+
+            def write(data):
+                md5.update(data)
+                out_file.write(data)
+
+            if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+                _read_aws_chunked(self.rfile, write)
+            else:
+                remaining = int(self.headers.get("Content-Length", 0))
+                while remaining:
+                    data = self.rfile.read(min(remaining, COPY_BUFFER_SIZE))
+                    write(data)
+                    remaining -= len(data)
+
+        self.send_response(200)
+        self.send_header("ETag", '"%s"' % md5.hexdigest())
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_object_headers(self):
+        """
+        Send the status and headers for a GET or HEAD, and return the
+        ``(path, start, length)`` of the bytes to send, or None if there's
+        nothing to send.
+        """
+        _, path = self._path()
+
+        if not os.path.isfile(path):
+            self._send_error(404, "NoSuchKey")
+            return None
+
+        size = os.path.getsize(path)
+        start, length = 0, size
+
+        match = RANGE_RE.match(self.headers.get("Range", ""))
+        if match is not None:
+            start = int(match.group("start"))
+            end = int(match.group("end") or size - 1)
+            if start >= size:
+                self._send_error(416, "InvalidRange")
+                return None
+            length = min(end, size - 1) - start + 1
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (start, start + length - 1, size)
+            )
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Type", "binary/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header(
+            "Last-Modified",
+            email.utils.formatdate(os.path.getmtime(path), usegmt=True),
+        )
+        self.end_headers()
+        return path, start, length
+
+    def do_HEAD(self):
+        self._send_object_headers()
+
+    def do_GET(self):
+        to_send = self._send_object_headers()
+        if to_send is None:
+            return
+
+        path, start, length = to_send
+        with open(path, "rb") as in_file:
+            in_file.seek(start)
+            while length:
+                data = in_file.read(min(length, COPY_BUFFER_SIZE))
+                if not data:
+                    break
+                self.wfile.write(data)
+                length -= len(data)
+
+
+class LocalS3Server(object):
+    """
+    Runs the stand-in on a random port on localhost, in a background thread.
+    Use it as a context manager to start and stop it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _S3RequestHandler)
+        self._server.daemon_threads = True
+        self._server.root = root
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def endpoint_url(self):
+        host, port = self._server.server_address
+        return "http://%s:%d" % (host, port)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -28,8 +28,17 @@ setup(
     packages=find_packages(SOURCE),
     package_dir={"": SOURCE},
     version=__version__,
-    install_requires=["requests_oauthlib>=1.2.0,<2"],
-    extras_require={"s3": ["boto3>=1.9.253,<2"]},
+    install_requires=[
+        "requests_oauthlib>=1.2.0,<2",
+        'futures>=3.2.0,<4; python_version < "3"',
+    ],
+    extras_require={
+        "s3": ["boto3>=1.9.253,<2"],
+        "async": ['httpx[http2]>=0.18,<1; python_version >= "3.6"'],
+        "streaming": ["ijson>=2.5,<4"],
+        "azure": ["azure-storage-blob>=12,<13", "azure-identity>=1,<2"],
+        "zstd": ['zstandard>=0.15,<1; python_version >= "3.6"'],
+    },
     description="A client for the Wellcome Storage Service",
     long_description=open(README).read(),
     author="Wellcome Trust (Digital Platform Team)",
@@ -1,36 +1,102 @@
 # -*- encoding: utf-8
 
+import collections
+import email.utils
 import functools
 import json
 import os
+import random
+import threading
 import time
 
 from oauthlib.oauth2 import BackendApplicationClient
+import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
 
-from .downloader import download_bag, download_compressed_bag
-from .exceptions import BagNotFound, IngestNotFound, ServerError, UserError
+from ._token_cache import read_cached_token, token_needs_refresh, write_cached_token
+from ._utils import RateLimiter, imap_unordered
+from .bag_contents import iter_bag_contents
+from .bag_filesystem import BagFilesystem
+from .content_cache import ContentCache
+from .downloader import (
+    download_bag,
+    download_compressed_bag,
+    FileFilter,
+    FileVerification,
+)
+from .exceptions import (
+    BagDownloadError,
+    BagNotFound,
+    FilesNotInBag,
+    FixityError,
+    IngestNotFound,
+    ServerError,
+    UserError,
+)
+from .fixity import BagVerificationResult, verify_bag_directory
+from .hedging import HedgingPolicy
+from .ingests import _wait_for_ingests, ingest_stage_timings, is_finished
+from .manifest_cache import ManifestCache
+from .progress import DownloadListener, DownloadStats
 from .secrets import get_secrets
+from .storage_manifest import StorageManifest
+from .streaming import parse_storage_manifest, StreamingStorageManifest
+from .sync import sync_bag, SyncResult
+from .uploader import upload_bag
 
 
 __all__ = [
     "download_bag",
     "download_compressed_bag",
+    "DownloadListener",
+    "DownloadStats",
+    "FileFilter",
+    "FileVerification",
+    "BagDownloadError",
+    "BagFilesystem",
     "BagNotFound",
+    "BagVerificationResult",
+    "BulkIngestResult",
+    "ContentCache",
+    "FilesNotInBag",
+    "FixityError",
+    "HedgingPolicy",
+    "ingest_stage_timings",
     "IngestNotFound",
+    "is_finished",
+    "iter_bag_contents",
+    "ManifestCache",
     "ServerError",
+    "StorageManifest",
+    "StreamingStorageManifest",
+    "sync_bag",
+    "SyncResult",
     "UserError",
     "StorageServiceClient",
+    "upload_bag",
+    "verify_bag_directory",
 ]
 
 
+# The result of one request passed to ``create_s3_ingests()``.  Exactly one of
+# ``location`` and ``error`` is set.
+BulkIngestResult = collections.namedtuple(
+    "BulkIngestResult", ["request", "location", "error"]
+)
+
+
 class StorageServiceClientBase(object):
     """
     Client for the Wellcome Storage Service API.
     """
 
-    def __init__(self, api_url):
+    backoff_factor = 0.5
+    max_backoff = 30
+
+    def __init__(self, api_url, manifest_cache=None):
         self.api_url = api_url
+        self.manifest_cache = manifest_cache
 
     def _http_get(self, url):  # pragma: no cover
         """
@@ -38,6 +104,13 @@ class StorageServiceClientBase(object):
         """
         raise NotImplementedError
 
+    def _http_get_stream(self, url):  # pragma: no cover
+        """
+        Make a GET request to the URL.  Returns a status code and a binary
+        file object for reading the body incrementally.
+        """
+        raise NotImplementedError
+
     def _http_post(self, url, json):  # pragma: no cover
         """
         Make a POST request with a given JSON body.
@@ -52,16 +125,7 @@ class StorageServiceClientBase(object):
         Returns the state of an ingest.
         """
         status_code, body = self._http_get(ingest_url)
-
-        if status_code == 404:
-            raise IngestNotFound("Ingests API returned 404 for %s" % ingest_url)
-        elif 400 <= status_code < 500:
-            error = json.loads(body)
-            raise UserError("%s: %s" % (error["label"], error["description"]))
-        elif status_code != 200:
-            raise ServerError()
-        else:
-            return json.loads(body)
+        return _parse_ingest_response(ingest_url, status_code, body)
 
     def get_ingest(self, ingest_id):
         """
@@ -71,29 +135,91 @@ class StorageServiceClientBase(object):
             ingest_url="%s/ingests/%s" % (self.api_url, ingest_id)
         )
 
+    def wait_for_ingests(
+        self, ingests, max_workers=10, min_interval=1, max_interval=60
+    ):
+        """
+        Watch a collection of ingests, and yield each one as soon as it
+        succeeds or fails.
+
+        Ingests are polled concurrently, and each one is polled more or less
+        often depending on how recently it logged an event.  Use
+        ``ingest_stage_timings()`` to see how long each stage took.
+
+        :param ingests: An iterable of ingest IDs or ingest locations, e.g. the
+            locations returned by ``create_s3_ingest()``.
+        :param max_workers: The most requests to make at once.
+        :param min_interval: The shortest time (in seconds) to wait between
+            polls of the same ingest.
+        :param max_interval: The longest time (in seconds) to wait between
+            polls of the same ingest.
+
+        """
+        return _wait_for_ingests(
+            self,
+            ingests,
+            max_workers=max_workers,
+            min_interval=min_interval,
+            max_interval=max_interval,
+        )
+
     def get_bag(self, space, external_identifier, version=None):
         """
         Returns the contents of a bag.
+
+        If the client has a ``manifest_cache`` and you ask for a specific
+        version, the manifest may come from the cache.
         """
-        bags_url_suffix = "%s/%s" % (space, external_identifier)
-        if version:
-            bags_url_suffix += "?version=%s" % version
+        cached_bag = _get_cached_bag(
+            self.manifest_cache, space, external_identifier, version
+        )
+        if cached_bag is not None:
+            return cached_bag
 
-        bags_url = "%s/bags/%s" % (self.api_url, bags_url_suffix)
+        bags_url = _bags_url(self.api_url, space, external_identifier, version)
 
         status_code, body = self._http_get(bags_url)
-        if status_code == 404:
-            if version:
-                raise BagNotFound(
-                    "Bags API returned 404 for bag %s/%s with version %s"
-                    % (space, external_identifier, version)
-                )
-            else:
-                raise BagNotFound(
-                    "Bags API returned 404 for bag %s/%s" % (space, external_identifier)
-                )
+        bag = _parse_bag_response(
+            space, external_identifier, version, status_code, body
+        )
+
+        _cache_bag(self.manifest_cache, space, external_identifier, bag, body)
+        return bag
+
+    def stream_bag(self, space, external_identifier, version=None):
+        """
+        Returns the contents of a bag as a ``StreamingStorageManifest``.
+
+        The response is parsed incrementally, and the lists of files are kept
+        in temporary files rather than memory, so memory use stays flat however
+        many files are in the bag.  The bag-level fields (e.g. ``location``,
+        ``info``) are available as soon as this returns.
+
+        Use the result as a context manager to clean up the temporary files.
+        This needs ijson; install it with the ``streaming`` extra.
+        """
+        bags_url = _bags_url(self.api_url, space, external_identifier, version)
+
+        status_code, stream = self._http_get_stream(bags_url)
+
+        if status_code == 200:
+            return parse_storage_manifest(stream)
         else:
-            return json.loads(body)
+            body = stream.read()
+            _parse_bag_response(space, external_identifier, version, status_code, body)
+            raise ServerError()
+
+    def iter_bag_files(self, space, external_identifier, version=None):
+        """
+        Yields every file in a bag -- first the files in the manifest, then
+        the tag manifest -- without holding the whole manifest in memory.
+        """
+        with self.stream_bag(space, external_identifier, version) as bag:
+            for manifest_file in bag["manifest"]["files"]:
+                yield manifest_file
+
+            for manifest_file in bag["tagManifest"]["files"]:
+                yield manifest_file
 
     def create_s3_ingest(
         self,
@@ -110,48 +236,339 @@ class StorageServiceClientBase(object):
         Returns the location of the new ingest if created, or raises an exception
         if not.
         """
-        payload = {
-            "type": "Ingest",
-            "ingestType": {"id": ingest_type, "type": "IngestType"},
-            "space": {"id": space, "type": "Space"},
-            "sourceLocation": {
-                "type": "Location",
-                "provider": {"type": "Provider", "id": "amazon-s3"},
-                "bucket": s3_bucket,
-                "path": s3_key,
-            },
-            "bag": {
-                "type": "Bag",
-                "info": {"type": "BagInfo", "externalIdentifier": external_identifier},
-            },
-        }
-
-        if callback_url is not None:
-            payload["callback"] = {"type": "Callback", "url": callback_url}
+        payload = _s3_ingest_payload(
+            space=space,
+            external_identifier=external_identifier,
+            s3_bucket=s3_bucket,
+            s3_key=s3_key,
+            callback_url=callback_url,
+            ingest_type=ingest_type,
+        )
 
         status_code, headers, body = self._http_post(
             url=self.api_url + "/ingests", json=payload
         )
+        return _parse_create_ingest_response(status_code, headers, body)
 
-        if 400 <= status_code < 500:
-            error = json.loads(body)
-            raise UserError("%s: %s" % (error["label"], error["description"]))
-        elif status_code == 201:
-            return headers["Location"]
-        # This branch is untested because it needs a reliable way to trigger
-        else:  # pragma: no cover
-            raise ServerError()
+    def create_s3_ingest_from_directory(
+        self,
+        bag_dir,
+        space,
+        external_identifier,
+        s3_bucket,
+        s3_key,
+        callback_url=None,
+        ingest_type="create",
+        **upload_kwargs
+    ):
+        """
+        Upload a bag directory to S3 as a tar.gz, then create an ingest from it.
+
+        The archive is streamed straight into S3 without being written to
+        disk; see ``upload_bag()`` for the options in ``upload_kwargs``.
+
+        Returns the location of the new ingest if created, or raises an exception
+        if not.
+        """
+        upload_bag(bag_dir, s3_bucket=s3_bucket, s3_key=s3_key, **upload_kwargs)
+
+        return self.create_s3_ingest(
+            space=space,
+            external_identifier=external_identifier,
+            s3_bucket=s3_bucket,
+            s3_key=s3_key,
+            callback_url=callback_url,
+            ingest_type=ingest_type,
+        )
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+
+        # "Full jitter" -- picking a random time up to the exponential
+        # backoff stops lots of clients retrying in lockstep.
+        # See https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(
+            0, min(self.backoff_factor * 2 ** attempt, self.max_backoff)
+        )
+
+    def _create_s3_ingest_with_retries(self, ingest_request, rate_limiter, max_retries):
+        payload = _s3_ingest_payload(
+            space=ingest_request["space"],
+            external_identifier=ingest_request["external_identifier"],
+            s3_bucket=ingest_request["s3_bucket"],
+            s3_key=ingest_request["s3_key"],
+            callback_url=ingest_request.get("callback_url"),
+            ingest_type=ingest_request.get("ingest_type", "create"),
+        )
+
+        attempt = 0
+        while True:
+            rate_limiter.wait()
+            status_code, headers, body = self._http_post(
+                url=self.api_url + "/ingests", json=payload
+            )
+
+            if status_code not in SAFE_TO_RETRY_CREATE_STATUS_CODES:
+                return _parse_create_ingest_response(status_code, headers, body)
+            elif attempt >= max_retries:
+                raise ServerError(
+                    "Ingests API returned %d after %d retries" % (status_code, attempt)
+                )
+
+            # Every thread is sharing the rate limiter, so this slows down
+            # all of them, not just this request.
+            retry_after = _parse_retry_after(headers.get("Retry-After"))
+            rate_limiter.pause(self._backoff(attempt, retry_after=retry_after))
+            attempt += 1
+
+    def create_s3_ingests(
+        self,
+        ingest_requests,
+        max_workers=10,
+        max_requests_per_second=None,
+        max_retries=5,
+    ):
+        """
+        Create many ingests from objects in S3, and yield a ``BulkIngestResult``
+        for each one as it's created (or fails).
+
+        If the API responds with 429 Too Many Requests or 503 Service
+        Unavailable, the ingest wasn't created, so we wait and try again.
+        Other errors are returned in the result and not retried, because the
+        ingest might have been created anyway.
+
+        :param ingest_requests: An iterable of dicts with the arguments to
+            ``create_s3_ingest()``, e.g. ``{"space": "digitised",
+            "external_identifier": "b12345", "s3_bucket": "bucket",
+            "s3_key": "b12345.tar.gz"}``.  It's read lazily, so it can be
+            a generator.
+        :param max_workers: The most requests to make at once.
+        :param max_requests_per_second: If set, the most requests to make in
+            a second, including retries.
+        :param max_retries: How many times to retry a single ingest.
+
+        """
+        rate_limiter = RateLimiter(max_per_second=max_requests_per_second)
+
+        def _create(ingest_request):
+            try:
+                location = self._create_s3_ingest_with_retries(
+                    ingest_request, rate_limiter=rate_limiter, max_retries=max_retries
+                )
+            except Exception as err:
+                return BulkIngestResult(ingest_request, location=None, error=err)
+            else:
+                return BulkIngestResult(ingest_request, location=location, error=None)
+
+        return imap_unordered(_create, ingest_requests, max_workers=max_workers)
+
+
+# These functions build requests and interpret responses from the API,
+# independent of the HTTP library, so they can be shared between the
+# synchronous clients in this file and the async client.
+
+
+def _parse_ingest_response(ingest_url, status_code, body):
+    if status_code == 404:
+        raise IngestNotFound("Ingests API returned 404 for %s" % ingest_url)
+    elif 400 <= status_code < 500:
+        error = json.loads(body)
+        raise UserError("%s: %s" % (error["label"], error["description"]))
+    elif status_code != 200:
+        raise ServerError()
+    else:
+        return json.loads(body)
+
+
+def _bags_url(api_url, space, external_identifier, version):
+    bags_url_suffix = "%s/%s" % (space, external_identifier)
+    if version:
+        bags_url_suffix += "?version=%s" % version
+
+    return "%s/bags/%s" % (api_url, bags_url_suffix)
+
+
+def _parse_bag_response(space, external_identifier, version, status_code, body):
+    if status_code == 404:
+        if version:
+            raise BagNotFound(
+                "Bags API returned 404 for bag %s/%s with version %s"
+                % (space, external_identifier, version)
+            )
+        else:
+            raise BagNotFound(
+                "Bags API returned 404 for bag %s/%s" % (space, external_identifier)
+            )
+    elif 400 <= status_code < 500:
+        error = json.loads(body)
+        raise UserError("%s: %s" % (error["label"], error["description"]))
+    elif status_code != 200:
+        raise ServerError()
+    else:
+        return json.loads(body)
+
+
+def _get_cached_bag(manifest_cache, space, external_identifier, version):
+    # Only a specific version of a bag is immutable; if we're asked for the
+    # latest version, we always need to check the API.
+    if manifest_cache is None or not version:
+        return None
+
+    body = manifest_cache.get(space, external_identifier, version)
+    if body is not None:
+        return json.loads(body)
+
+
+def _cache_bag(manifest_cache, space, external_identifier, bag, body):
+    # We cache every manifest we fetch under its version, including the
+    # latest version, so a later request for that version is a cache hit.
+    # This is only called with a successful response; errors are raised by
+    # ``_parse_bag_response``, and never cached.
+    if manifest_cache is not None:
+        manifest_cache.put(space, external_identifier, bag["version"], body)
+
+
+def _s3_ingest_payload(
+    space, external_identifier, s3_bucket, s3_key, callback_url, ingest_type
+):
+    payload = {
+        "type": "Ingest",
+        "ingestType": {"id": ingest_type, "type": "IngestType"},
+        "space": {"id": space, "type": "Space"},
+        "sourceLocation": {
+            "type": "Location",
+            "provider": {"type": "Provider", "id": "amazon-s3"},
+            "bucket": s3_bucket,
+            "path": s3_key,
+        },
+        "bag": {
+            "type": "Bag",
+            "info": {"type": "BagInfo", "externalIdentifier": external_identifier},
+        },
+    }
+
+    if callback_url is not None:
+        payload["callback"] = {"type": "Callback", "url": callback_url}
+
+    return payload
+
+
+def _parse_create_ingest_response(status_code, headers, body):
+    if 400 <= status_code < 500:
+        error = json.loads(body)
+        raise UserError("%s: %s" % (error["label"], error["description"]))
+    elif status_code == 201:
+        return headers["Location"]
+    # This branch is untested because it needs a reliable way to trigger
+    else:  # pragma: no cover
+        raise ServerError()
+
+
+# Responses which mean "try again later", rather than a problem with the
+# request itself.
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+# Responses to creating an ingest which mean the request was turned away
+# before an ingest was created, so we can retry without making a duplicate.
+# A 500, 502 or 504 might come after the ingest was created.
+SAFE_TO_RETRY_CREATE_STATUS_CODES = {429, 503}
+
+
+def _parse_retry_after(retry_after):
+    """
+    Returns the number of seconds to wait from a Retry-After header, which
+    can be a number of seconds or an HTTP date, or None if it can't be parsed.
+    """
+    if retry_after is None:
+        return None
+
+    try:
+        return max(0, int(retry_after))
+    except ValueError:
+        pass
+
+    parsed_date = email.utils.parsedate_tz(retry_after)
+    if parsed_date is None:
+        return None
+
+    return max(0, email.utils.mktime_tz(parsed_date) - time.time())
 
 
 class RequestsStorageServiceClient(StorageServiceClientBase):
-    def __init__(self, api_url, sess):
+    """
+    Client that makes requests with a ``requests.Session``.
+
+    GET requests are idempotent, so if they fail with a connection error or
+    one of ``RETRYABLE_STATUS_CODES``, they're retried up to ``max_retries``
+    times.  We wait for the time in the ``Retry-After`` header if there is
+    one, or a jittered exponential backoff if not.  The ``retry_counts``
+    attribute counts the retries by reason, so you can inspect it after a run.
+
+    :param pool_maxsize: If set, the number of connections to keep alive in
+        the session's connection pool for each host.  This should be at least
+        the number of threads sharing the client.
+    :param manifest_cache: A ``ManifestCache`` for storage manifests of
+        specific bag versions.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        sess,
+        max_retries=0,
+        backoff_factor=0.5,
+        max_backoff=30,
+        pool_maxsize=None,
+        manifest_cache=None,
+    ):
         self.sess = sess
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+        self.retry_counts = collections.Counter()
+        self._retry_counts_lock = threading.Lock()
+
+        if pool_maxsize is not None:
+            adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+            self.sess.mount("https://", adapter)
+            self.sess.mount("http://", adapter)
+
+        super(RequestsStorageServiceClient, self).__init__(
+            api_url=api_url, manifest_cache=manifest_cache
+        )
 
-        super(RequestsStorageServiceClient, self).__init__(api_url=api_url)
+    def _record_retry(self, reason):
+        with self._retry_counts_lock:
+            self.retry_counts[reason] += 1
 
     def _http_get(self, url):
-        resp = self.sess.get(url)
-        return (resp.status_code, resp.text)
+        attempt = 0
+        while True:
+            try:
+                resp = self.sess.get(url)
+            except requests.ConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+                self._record_retry("connection_error")
+                time.sleep(self._backoff(attempt))
+            else:
+                if resp.status_code not in RETRYABLE_STATUS_CODES:
+                    return (resp.status_code, resp.text)
+                elif attempt >= self.max_retries:
+                    return (resp.status_code, resp.text)
+
+                self._record_retry(resp.status_code)
+                retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+                time.sleep(self._backoff(attempt, retry_after=retry_after))
+
+            attempt += 1
+
+    def _http_get_stream(self, url):
+        resp = self.sess.get(url, stream=True)
+        resp.raw.decode_content = True
+        return (resp.status_code, resp.raw)
 
     def _http_post(self, url, json):
         resp = self.sess.post(url, json=json)
@@ -165,12 +582,12 @@ def needs_token(f):
         #   1. We've never asked for a token before
         #   2. The existing token is close to expiry
         #
-        if not self.sess.token or (time.time() - 10 > self.sess.token["expires_at"]):
-            self.sess.fetch_token(
-                token_url=self.token_url,
-                client_id=self.client_id,
-                client_secret=self.client_secret,
-            )
+        # If several threads notice at once, only the first one to get the
+        # lock fetches a new token; the others see it when they get the lock.
+        if token_needs_refresh(self.sess.token):
+            with self._token_lock:
+                if token_needs_refresh(self.sess.token):
+                    self._refresh_token()
         return f(self, *args, **kwargs)
 
     return wrapper
@@ -180,50 +597,102 @@ DEFAULT_CREDENTIALS_PATH = os.path.join(
     os.environ["HOME"], ".wellcome-storage", "oauth-credentials.json"
 )
 
+DEFAULT_TOKEN_CACHE_PATH = os.path.join(
+    os.environ["HOME"], ".wellcome-storage", "oauth-token-cache.json"
+)
+
 
 class RequestsOAuthStorageServiceClient(RequestsStorageServiceClient):
-    def __init__(self, api_url, client_id, client_secret, token_url):
+    """
+    Client that authenticates with OAuth client credentials.
+
+    The client can be shared between threads.  If you pass a
+    ``token_cache_path``, e.g. ``DEFAULT_TOKEN_CACHE_PATH``, tokens are saved
+    to disk and reused by other clients until they expire.
+
+    Any other keyword arguments, e.g. ``max_retries``, are passed to
+    ``RequestsStorageServiceClient``.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        client_id,
+        client_secret,
+        token_url,
+        token_cache_path=None,
+        **kwargs
+    ):
         self.api_url = api_url
         self.client_id = client_id
         self.client_secret = client_secret
         self.token_url = token_url
+        self.token_cache_path = token_cache_path
+
+        self._token_lock = threading.Lock()
 
         client = BackendApplicationClient(client_id=client_id)
         sess = OAuth2Session(client=client)
 
         super(RequestsOAuthStorageServiceClient, self).__init__(
-            api_url=api_url, sess=sess
+            api_url=api_url, sess=sess, **kwargs
         )
 
     @classmethod
-    def from_path(self, api_url, credentials_path=DEFAULT_CREDENTIALS_PATH):
+    def from_path(self, api_url, credentials_path=DEFAULT_CREDENTIALS_PATH, **kwargs):
         oauth_creds = json.load(open(credentials_path))
-        return RequestsOAuthStorageServiceClient(api_url=api_url, **oauth_creds)
+        return RequestsOAuthStorageServiceClient(
+            api_url=api_url, **dict(oauth_creds, **kwargs)
+        )
+
+    def _refresh_token(self):
+        if self.token_cache_path is not None:
+            cached_token = read_cached_token(
+                self.token_cache_path, self.token_url, self.client_id
+            )
+            if cached_token is not None:
+                self.sess.token = cached_token
+                return
+
+        token = self.sess.fetch_token(
+            token_url=self.token_url,
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+        )
+
+        if self.token_cache_path is not None:
+            write_cached_token(
+                self.token_cache_path, self.token_url, self.client_id, dict(token)
+            )
 
     @needs_token
     def _http_get(self, url):
         return super(RequestsOAuthStorageServiceClient, self)._http_get(url)
 
+    @needs_token
+    def _http_get_stream(self, url):
+        return super(RequestsOAuthStorageServiceClient, self)._http_get_stream(url)
+
     @needs_token
     def _http_post(self, url, json):
         return super(RequestsOAuthStorageServiceClient, self)._http_post(url, json)
 
 
-def prod_client():
+def prod_client(**kwargs):
     secrets = get_secrets()
     api_url = "https://api.wellcomecollection.org/storage/v1"
     return RequestsOAuthStorageServiceClient(
         api_url=api_url,
         token_url="https://auth.wellcomecollection.org/oauth2/token",
-        **secrets
+        **dict(secrets, **kwargs)
     )
 
 
-def staging_client():
+def staging_client(**kwargs):
     secrets = get_secrets()
     api_url = "https://api-stage.wellcomecollection.org/storage/v1"
     return RequestsOAuthStorageServiceClient(
         api_url=api_url,
         token_url="https://auth.wellcomecollection.org/oauth2/token",
-        **secrets
+        **dict(secrets, **kwargs)
     )
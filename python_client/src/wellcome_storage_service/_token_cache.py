@@ -0,0 +1,94 @@
+# -*- encoding: utf-8
+"""
+An on-disk cache of OAuth tokens, so short-lived processes can reuse a
+token that's still valid rather than asking the token endpoint for a new one.
+
+The cache is a JSON file mapping ``"<token_url> <client_id>"`` to a token.
+It contains credentials, so it's only readable by the current user.
+"""
+
+import contextlib
+import json
+import os
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from ._utils import mkdir_p, remove_if_exists
+
+
+def token_needs_refresh(token):
+    """
+    Returns True if we've never had a token, or the token is close to expiry.
+    """
+    return not token or (time.time() + 10 > token["expires_at"])
+
+
+def _cache_key(token_url, client_id):
+    return "%s %s" % (token_url, client_id)
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def read_cached_token(cache_path, token_url, client_id):
+    """
+    Returns a cached token if there's one which is still valid, or None.
+    """
+    token = _read_cache(cache_path).get(_cache_key(token_url, client_id))
+
+    if token_needs_refresh(token):
+        return None
+    else:
+        return token
+
+
+@contextlib.contextmanager
+def _locked(cache_path):
+    """
+    Hold an exclusive lock on the cache, so two processes (or threads) that
+    update it at once can't lose each other's tokens.
+
+    On Windows there's no ``fcntl``, so we don't lock; the last writer wins.
+    """
+    lock_fd = os.open(cache_path + ".lock", os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the file releases the lock
+        os.close(lock_fd)
+
+
+def write_cached_token(cache_path, token_url, client_id, token):
+    cache_dir = os.path.dirname(cache_path)
+    mkdir_p(cache_dir)
+
+    with _locked(cache_path):
+        tokens = _read_cache(cache_path)
+        tokens[_cache_key(token_url, client_id)] = token
+
+        # Write to a temporary file and rename it into place, so another
+        # process never sees a half-written cache.  mkstemp() creates the
+        # file so only the current user can read it.
+        fd, tmp_path = tempfile.mkstemp(
+            dir=cache_dir or ".", prefix=os.path.basename(cache_path), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(tokens, tmp_file)
+
+            os.rename(tmp_path, cache_path)
+        except Exception:
+            remove_if_exists(tmp_path)
+            raise
@@ -2,7 +2,11 @@
 
 
 import errno
+import itertools
 import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 
 def mkdir_p(path):
@@ -21,3 +25,72 @@ def mkdir_p(path):
             pass
         else:
             raise
+
+
+def remove_if_exists(path):
+    """
+    Delete a file, if it exists.
+    """
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls so there are at most ``max_per_second`` of them, across
+    every thread that shares the limiter.  If ``max_per_second`` is None,
+    calls are only delayed by ``pause()``.
+    """
+
+    def __init__(self, max_per_second=None):
+        self.max_per_second = max_per_second
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot)
+            if self.max_per_second is not None:
+                self._next_slot = slot + 1.0 / self.max_per_second
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        """
+        Don't allow any more calls for the next ``seconds`` seconds, e.g.
+        because the server has told us to slow down.
+        """
+        with self._lock:
+            self._next_slot = max(self._next_slot, time.time() + seconds)
+
+
+def imap_unordered(function, iterable, max_workers):
+    """
+    Call ``function`` on every item of ``iterable`` on a pool of threads,
+    and yield the results in the order they finish.
+
+    Items are read from ``iterable`` as they're needed, so it can be a
+    generator that's too large to hold in memory.
+    """
+    iterator = iter(iterable)
+    in_flight = set()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # We keep a couple of items queued behind each worker, so they
+        # never go idle.
+        for item in itertools.islice(iterator, max_workers * 2):
+            in_flight.add(executor.submit(function, item))
+
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                for item in itertools.islice(iterator, 1):
+                    in_flight.add(executor.submit(function, item))
+
+                yield future.result()
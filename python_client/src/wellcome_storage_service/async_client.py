@@ -0,0 +1,288 @@
+# -*- encoding: utf-8
+"""
+An asyncio-native client for the storage service, for scripts that need to
+make thousands of API calls concurrently.
+
+This module needs Python 3 and httpx; install it with the ``async`` extra.
+"""
+
+import asyncio
+import json
+import time
+
+from ._token_cache import read_cached_token, token_needs_refresh, write_cached_token
+from . import (
+    DEFAULT_CREDENTIALS_PATH,
+    _bags_url,
+    _cache_bag,
+    _get_cached_bag,
+    _parse_bag_response,
+    _parse_create_ingest_response,
+    _parse_ingest_response,
+    _s3_ingest_payload,
+)
+from .exceptions import ServerError
+from .ingests import _ingest_url, _next_poll_delay, is_finished
+
+
+class AsyncStorageServiceClient(object):
+    """
+    Asynchronous client for the Wellcome Storage Service API.
+
+    Every request goes through a single httpx client, so concurrent callers
+    share one connection pool (using HTTP/2 where the server supports it),
+    and at most ``max_concurrency`` requests are in flight at once.
+
+    Use it as an async context manager, or call ``aclose()`` when you're done.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        max_concurrency=50,
+        http2=True,
+        http_client=None,
+        manifest_cache=None,
+    ):
+        import httpx
+
+        self.api_url = api_url
+        self.max_concurrency = max_concurrency
+        self.manifest_cache = manifest_cache
+
+        if http_client is None:
+            http_client = httpx.AsyncClient(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=max_concurrency,
+                    max_keepalive_connections=max_concurrency,
+                ),
+            )
+
+        self.http_client = http_client
+
+        # asyncio primitives are tied to the running event loop in older
+        # versions of Python, so we create this on first use.
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.http_client.aclose()
+
+    async def _auth_headers(self):
+        return {}
+
+    async def _request(self, method, url, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._semaphore:
+            headers = await self._auth_headers()
+            return await self.http_client.request(
+                method, url, headers=headers, **kwargs
+            )
+
+    async def _http_get(self, url):
+        resp = await self._request("GET", url)
+        return (resp.status_code, resp.text)
+
+    async def _http_post(self, url, json):
+        resp = await self._request("POST", url, json=json)
+        return (resp.status_code, resp.headers, resp.text)
+
+    async def get_ingest_from_location(self, ingest_url):
+        """
+        Returns the state of an ingest.
+        """
+        status_code, body = await self._http_get(ingest_url)
+        return _parse_ingest_response(ingest_url, status_code, body)
+
+    async def get_ingest(self, ingest_id):
+        """
+        Returns the state of an ingest.
+        """
+        return await self.get_ingest_from_location(
+            ingest_url="%s/ingests/%s" % (self.api_url, ingest_id)
+        )
+
+    async def _watch_ingest(self, ingest_url, finished, min_interval, max_interval):
+        try:
+            while True:
+                try:
+                    ingest = await self.get_ingest_from_location(ingest_url)
+                except ServerError:
+                    ingest = None
+
+                if ingest is not None and is_finished(ingest):
+                    await finished.put(ingest)
+                    return
+
+                await asyncio.sleep(
+                    _next_poll_delay(ingest, time.time(), min_interval, max_interval)
+                )
+        except Exception as err:
+            await finished.put(err)
+
+    async def wait_for_ingests(self, ingests, min_interval=1, max_interval=60):
+        """
+        Watch a collection of ingests, and yield each one as soon as it
+        succeeds or fails.
+
+        This works like ``wait_for_ingests()`` on the synchronous client,
+        except every ingest is watched by its own task, and the number of
+        requests in flight is capped by ``max_concurrency``.
+
+        Use it with ``async for``.
+        """
+        finished = asyncio.Queue()
+        tasks = [
+            asyncio.ensure_future(
+                self._watch_ingest(
+                    _ingest_url(self.api_url, ingest),
+                    finished=finished,
+                    min_interval=min_interval,
+                    max_interval=max_interval,
+                )
+            )
+            for ingest in ingests
+        ]
+
+        try:
+            for _ in tasks:
+                result = await finished.get()
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_bag(self, space, external_identifier, version=None):
+        """
+        Returns the contents of a bag.
+
+        If the client has a ``manifest_cache`` and you ask for a specific
+        version, the manifest may come from the cache.
+        """
+        cached_bag = _get_cached_bag(
+            self.manifest_cache, space, external_identifier, version
+        )
+        if cached_bag is not None:
+            return cached_bag
+
+        bags_url = _bags_url(self.api_url, space, external_identifier, version)
+
+        status_code, body = await self._http_get(bags_url)
+        bag = _parse_bag_response(
+            space, external_identifier, version, status_code, body
+        )
+
+        _cache_bag(self.manifest_cache, space, external_identifier, bag, body)
+        return bag
+
+    async def create_s3_ingest(
+        self,
+        space,
+        external_identifier,
+        s3_bucket,
+        s3_key,
+        callback_url=None,
+        ingest_type="create",
+    ):
+        """
+        Create an ingest from an object in an S3 bucket.
+
+        Returns the location of the new ingest if created, or raises an exception
+        if not.
+        """
+        payload = _s3_ingest_payload(
+            space=space,
+            external_identifier=external_identifier,
+            s3_bucket=s3_bucket,
+            s3_key=s3_key,
+            callback_url=callback_url,
+            ingest_type=ingest_type,
+        )
+
+        status_code, headers, body = await self._http_post(
+            url=self.api_url + "/ingests", json=payload
+        )
+        return _parse_create_ingest_response(status_code, headers, body)
+
+
+class AsyncOAuthStorageServiceClient(AsyncStorageServiceClient):
+    """
+    Asynchronous client that authenticates with OAuth client credentials.
+
+    If several requests find the token needs refreshing at the same time,
+    only one of them fetches a new token, and the rest wait for it.  As with
+    the synchronous client, tokens can be shared with other processes by
+    passing a ``token_cache_path``.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        client_id,
+        client_secret,
+        token_url,
+        token_cache_path=None,
+        **kwargs
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self.token_cache_path = token_cache_path
+
+        self.token = None
+        self._token_lock = None
+
+        super(AsyncOAuthStorageServiceClient, self).__init__(api_url=api_url, **kwargs)
+
+    @classmethod
+    def from_path(cls, api_url, credentials_path=DEFAULT_CREDENTIALS_PATH, **kwargs):
+        oauth_creds = json.load(open(credentials_path))
+        return cls(api_url=api_url, **dict(oauth_creds, **kwargs))
+
+    async def _fetch_token(self):
+        if self.token_cache_path is not None:
+            cached_token = read_cached_token(
+                self.token_cache_path, self.token_url, self.client_id
+            )
+            if cached_token is not None:
+                self.token = cached_token
+                return
+
+        resp = await self.http_client.post(
+            self.token_url,
+            data={"grant_type": "client_credentials"},
+            auth=(self.client_id, self.client_secret),
+        )
+        resp.raise_for_status()
+
+        token = resp.json()
+        token["expires_at"] = time.time() + token["expires_in"]
+        self.token = token
+
+        if self.token_cache_path is not None:
+            write_cached_token(
+                self.token_cache_path, self.token_url, self.client_id, token
+            )
+
+    async def _auth_headers(self):
+        if token_needs_refresh(self.token):
+            if self._token_lock is None:
+                self._token_lock = asyncio.Lock()
+
+            async with self._token_lock:
+                # Another caller may have refreshed the token while we were
+                # waiting for the lock.
+                if token_needs_refresh(self.token):
+                    await self._fetch_token()
+
+        return {"Authorization": "Bearer %s" % self.token["access_token"]}
@@ -0,0 +1,177 @@
+# -*- encoding: utf-8
+"""
+Read the files in a bag into memory, one after another.
+
+If you're processing every file in a bag (say, running OCR over every
+image), you don't need the bag on disk first.  ``iter_bag_contents()``
+gives you the contents of each file in turn, and fetches the next few
+files in the background while you work on the current one, so the
+network and your processing overlap rather than taking turns.
+"""
+
+import collections
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from .downloader import (
+    _chunk_callback,
+    _copy_chunks,
+    _InFlightLimiter,
+    _open_file,
+    _Replicas,
+    _select_files,
+    FileVerification,
+)
+from .exceptions import FixityError
+from .progress import DownloadListener
+
+
+def _fetch_contents(
+    replicas, cache, manifest_file, checksum_algorithm, verify, listener
+):
+    """
+    Read a file into memory, and return its contents.  If ``verify`` is True,
+    the contents are hashed as they're read, and we raise a ``FixityError``
+    if they don't match the manifest.
+
+    ``checksum_algorithm`` is used to verify the file, and to look it up
+    in the ``cache``.
+    """
+    if listener is None:
+        listener = DownloadListener()
+
+    listener.file_started(manifest_file)
+    hasher = hashlib.new(checksum_algorithm) if verify else None
+    buf = io.BytesIO()
+
+    try:
+        read_file_obj = _open_file(replicas, cache, manifest_file, checksum_algorithm)
+        with closing(read_file_obj):
+            _copy_chunks(
+                read_file_obj,
+                buf,
+                hasher=hasher,
+                on_chunk=_chunk_callback(listener, manifest_file),
+            )
+    except Exception as err:
+        listener.file_failed(manifest_file, err)
+        raise
+
+    contents = buf.getvalue()
+    listener.file_finished(manifest_file, len(contents))
+
+    if hasher is not None:
+        verification = FileVerification(
+            manifest_file=manifest_file,
+            checksum_algorithm=checksum_algorithm,
+            actual_checksum=hasher.hexdigest(),
+            actual_size=len(contents),
+        )
+        if not verification.is_valid:
+            raise FixityError(verification)
+
+    return contents
+
+
+def iter_bag_contents(
+    storage_manifest,
+    file_filter=None,
+    prefetch=4,
+    max_in_flight_bytes=64 * 1024 * 1024,
+    verify=False,
+    use_replicas=False,
+    listener=None,
+    cache=None,
+):
+    """
+    Yield ``(manifest_file, contents)`` for every file in a bag, in the order
+    they appear in the storage manifest, where ``contents`` is the bytes of
+    the file.
+
+    While you process one file, we fetch up to ``prefetch`` of the files
+    after it in the background, as long as they fit in
+    ``max_in_flight_bytes``.  The file you're processing counts towards the
+    budget until you ask for the next one.  A file bigger than the whole
+    budget is still fetched, but only once everything before it is done.
+
+    If a file can't be fetched, the exception is raised when you get to
+    that file, so you get all the files before it first.
+
+        for manifest_file, contents in iter_bag_contents(
+            storage_manifest, file_filter=FileFilter(include="data/*.jp2")
+        ):
+            run_ocr(manifest_file["name"], contents)
+
+    :param storage_manifest: A storage manifest returned from the storage
+        service, as retrieved with ``get_bag()``.
+    :param file_filter: If set, a ``FileFilter`` that chooses which files
+        to read, rather than the whole bag.
+    :param prefetch: The number of files to fetch ahead of the one you're
+        processing.  This is also the number of threads we fetch them on.
+    :param max_in_flight_bytes: Limits the total size of the files we hold
+        in memory at once, including the one you're processing.
+    :param verify: If True, hash every file as it's read, and raise a
+        ``FixityError`` rather than yield a file that doesn't match the
+        checksum and size in the storage manifest.
+    :param use_replicas: If True, read each file from the first of the bag's
+        locations (primary or replica) that will serve it.
+    :param listener: A ``DownloadListener`` that gets events as each file is
+        fetched.  Its methods are called from the background threads.
+    :param cache: If set, a ``ContentCache`` to read files from, rather than
+        downloading them, if they're in it.
+
+    """
+    replicas = _Replicas(
+        storage_manifest, use_replicas=use_replicas, max_workers=max(prefetch, 1)
+    )
+
+    # The cache is keyed by checksum, so we need the checksum algorithm for
+    # cache lookups even if we aren't verifying.
+    files = iter(
+        _select_files(
+            storage_manifest,
+            file_filter=file_filter,
+            with_checksums=bool(verify or cache),
+        )
+    )
+
+    # Includes the file the caller is processing, so it's one more than
+    # the number we fetch ahead.
+    limiter = _InFlightLimiter(max_files=prefetch + 1, max_bytes=max_in_flight_bytes)
+
+    # Files we've started fetching, in order, as (manifest_file, future) pairs.
+    queue = collections.deque()
+    next_file = next(files, None)
+
+    with closing(replicas), ThreadPoolExecutor(
+        max_workers=max(prefetch, 1)
+    ) as executor:
+        try:
+            while next_file is not None or queue:
+                while next_file is not None and limiter.try_acquire(
+                    next_file[0].get("size", 0)
+                ):
+                    manifest_file, checksum_algorithm = next_file
+                    future = executor.submit(
+                        _fetch_contents,
+                        replicas,
+                        cache,
+                        manifest_file,
+                        checksum_algorithm,
+                        verify,
+                        listener,
+                    )
+                    queue.append((manifest_file, future))
+                    next_file = next(files, None)
+
+                manifest_file, future = queue.popleft()
+                try:
+                    yield manifest_file, future.result()
+                finally:
+                    limiter.release(manifest_file.get("size", 0))
+        finally:
+            # If the caller stops early, don't fetch files nobody will read.
+            for _, future in queue:
+                future.cancel()
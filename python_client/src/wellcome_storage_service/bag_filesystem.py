@@ -0,0 +1,350 @@
+# -*- encoding: utf-8
+"""
+A read-only, filesystem-style view of a stored bag.
+
+Sometimes we only need a few bytes from each file in a bag -- say, the METS
+file, or the header of every JP2 to get its dimensions.  Rather than
+downloading the files, ``BagFilesystem`` lets you open them directly from
+storage: reads are served with range requests, a block at a time, so we
+only fetch the parts of each file you actually read.  Listing directories
+and getting file sizes comes from the storage manifest, and doesn't make
+any requests at all.
+"""
+
+import collections
+import errno
+import io
+import posixpath
+import threading
+
+from .downloader import _choose_provider
+from .storage_manifest import StorageManifest
+
+FileStat = collections.namedtuple(
+    "FileStat", ["name", "size", "is_dir", "checksum_algorithm", "checksum"]
+)
+FileStat.__doc__ = """
+Information about a file or directory in a ``BagFilesystem``.  For
+a directory, ``size`` is the total size of the files it contains, and
+the checksum fields are None.
+"""
+
+
+def _parent_directories(name):
+    """
+    Yields every directory above a file, e.g. for ``data/objects/b1.jp2``
+    yields ``data/objects``, ``data`` and the root directory ``""``.
+    """
+    while name:
+        name = posixpath.dirname(name)
+        yield name
+
+
+class _BlockCache(object):
+    """
+    Holds the most recently used blocks of file data, up to a total size.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._blocks = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                block = self._blocks.pop(key)
+            except KeyError:
+                return None
+
+            # Re-insert the block to mark it as most recently used
+            self._blocks[key] = block
+            return block
+
+    def put(self, key, block):
+        with self._lock:
+            if key in self._blocks:
+                self._bytes -= len(self._blocks.pop(key))
+
+            self._blocks[key] = block
+            self._bytes += len(block)
+
+            while self._bytes > self.max_bytes and len(self._blocks) > 1:
+                _, evicted = self._blocks.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+class BagFilesystem(object):
+    """
+    A read-only view of the files in a bag, which reads them from storage
+    only when you read from them.
+
+        fs = BagFilesystem(client.get_bag(space="digitised", external_identifier="b12345"))
+        fs.listdir("data")
+        with fs.open("data/b12345.xml") as mets_file:
+            mets = mets_file.read()
+
+    Files are read in blocks of ``block_size`` bytes, with one range request
+    for each run of blocks we don't have yet.  If you read a file
+    sequentially, we read ahead by up to ``readahead`` blocks in the same
+    request.  Blocks are kept in a cache shared by every file you open.
+
+    A ``BagFilesystem`` can be shared between threads, but the files it
+    opens can't.
+
+    :param storage_manifest: A storage manifest returned from the storage
+        service, as retrieved with ``get_bag()``, or a ``StorageManifest``.
+    :param block_size: The size of the blocks we fetch, in bytes.  Smaller
+        blocks mean less wasted data for small reads; bigger blocks mean
+        fewer requests for big ones.
+    :param readahead: The maximum number of extra blocks to fetch when a
+        file is being read sequentially.
+    :param max_cache_bytes: The total size of the blocks to keep in memory.
+
+    """
+
+    def __init__(
+        self,
+        storage_manifest,
+        block_size=256 * 1024,
+        readahead=8,
+        max_cache_bytes=64 * 1024 * 1024,
+    ):
+        if not isinstance(storage_manifest, StorageManifest):
+            storage_manifest = StorageManifest(storage_manifest)
+
+        self.storage_manifest = storage_manifest
+        self.block_size = block_size
+        self.readahead = readahead
+
+        self.location = storage_manifest.location
+        self.provider = _choose_provider(self.location)
+
+        self.requests = 0
+        self.bytes_fetched = 0
+
+        self._cache = _BlockCache(max_bytes=max_cache_bytes)
+        self._lock = threading.Lock()
+
+        # Maps each directory to the names of the files and directories
+        # directly inside it.
+        directories = collections.defaultdict(set)
+        for manifest_file in storage_manifest:
+            child = manifest_file["name"]
+            for directory in _parent_directories(child):
+                directories[directory].add(posixpath.basename(child))
+                child = directory
+        self._directories = dict(directories)
+
+    def _normalise(self, path):
+        name = posixpath.normpath(path).lstrip("/")
+        return "" if name == "." else name
+
+    def _get_file(self, path):
+        name = self._normalise(path)
+        try:
+            return self.storage_manifest[name]
+        except KeyError:
+            if name in self._directories:
+                raise IOError(errno.EISDIR, "Is a directory", path)
+            raise IOError(errno.ENOENT, "No such file in bag", path)
+
+    def exists(self, path):
+        name = self._normalise(path)
+        return name in self.storage_manifest or name in self._directories
+
+    def isdir(self, path):
+        return self._normalise(path) in self._directories
+
+    def isfile(self, path):
+        return self._normalise(path) in self.storage_manifest
+
+    def listdir(self, path=""):
+        """
+        Returns the names of the files and directories in a directory,
+        sorted by name.
+        """
+        name = self._normalise(path)
+        try:
+            return sorted(self._directories[name])
+        except KeyError:
+            if name in self.storage_manifest:
+                raise OSError(errno.ENOTDIR, "Not a directory", path)
+            raise OSError(errno.ENOENT, "No such directory in bag", path)
+
+    def walk(self, path=""):
+        """
+        Yields ``(dirpath, dirnames, filenames)`` for every directory under
+        ``path``, top-down, like ``os.walk``.
+        """
+        dirpath = self._normalise(path)
+        dirnames = []
+        filenames = []
+
+        for child in self.listdir(dirpath):
+            if posixpath.join(dirpath, child) in self._directories:
+                dirnames.append(child)
+            else:
+                filenames.append(child)
+
+        yield dirpath, dirnames, filenames
+
+        for dirname in dirnames:
+            for result in self.walk(posixpath.join(dirpath, dirname)):
+                yield result
+
+    def stat(self, path):
+        """
+        Returns a ``FileStat`` for a file or directory.
+        """
+        name = self._normalise(path)
+
+        if name in self._directories:
+            return FileStat(
+                name=name,
+                size=self.storage_manifest.total_size(
+                    prefix=name + "/" if name else None
+                ),
+                is_dir=True,
+                checksum_algorithm=None,
+                checksum=None,
+            )
+
+        manifest_file = self._get_file(path)
+        return FileStat(
+            name=name,
+            size=manifest_file["size"],
+            is_dir=False,
+            checksum_algorithm=self.storage_manifest.checksum_algorithm(name),
+            checksum=manifest_file["checksum"],
+        )
+
+    def open(self, path):
+        """
+        Open a file in the bag for reading, in binary mode.  The file is
+        seekable, and nothing is fetched until you read from it.
+        """
+        return io.BufferedReader(
+            _BagFile(self, self._get_file(path)), buffer_size=self.block_size
+        )
+
+    def _fetch(self, manifest_file, first_block, last_block):
+        """
+        Fetch a run of blocks with a single range request, and add them
+        to the cache.
+        """
+        start = first_block * self.block_size
+        end = min((last_block + 1) * self.block_size, manifest_file["size"]) - 1
+
+        data = self.provider.get_range(
+            location=self.location, manifest_file=manifest_file, start=start, end=end
+        )
+
+        with self._lock:
+            self.requests += 1
+            self.bytes_fetched += len(data)
+
+        blocks = {}
+        for index in range(first_block, last_block + 1):
+            block_start = (index - first_block) * self.block_size
+            block_end = block_start + self.block_size
+            blocks[index] = data[block_start:block_end]
+            self._cache.put((manifest_file["name"], index), blocks[index])
+
+        return blocks
+
+    def _read(self, manifest_file, start, length, readahead):
+        """
+        Returns ``length`` bytes of a file, starting at ``start``.
+        """
+        first_block = start // self.block_size
+        last_block = (start + length - 1) // self.block_size
+        final_block = (manifest_file["size"] - 1) // self.block_size
+
+        # Find the runs of consecutive blocks that aren't in the cache, so we
+        # can fetch each run with a single request.
+        blocks = {}
+        runs = []
+        for index in range(first_block, last_block + 1):
+            block = self._cache.get((manifest_file["name"], index))
+            if block is not None:
+                blocks[index] = block
+            elif runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+
+        # If we're reading sequentially, extend the last run to read ahead.
+        if runs:
+            runs[-1][1] = min(runs[-1][1] + readahead, final_block)
+
+        for run_first, run_last in runs:
+            blocks.update(self._fetch(manifest_file, run_first, run_last))
+
+        data = b"".join(blocks[i] for i in range(first_block, last_block + 1))
+        offset = start - first_block * self.block_size
+        end = offset + length
+        return data[offset:end]
+
+
+class _BagFile(io.RawIOBase):
+    """
+    A read-only, seekable file object for a single file in a bag.
+    """
+
+    def __init__(self, filesystem, manifest_file):
+        super(_BagFile, self).__init__()
+        self.filesystem = filesystem
+        self.manifest_file = manifest_file
+        self.name = manifest_file["name"]
+        self.size = manifest_file["size"]
+
+        self._position = 0
+        self._last_read_end = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence: %r" % whence)
+
+        if position < 0:
+            raise ValueError("Negative seek position %d" % position)
+
+        self._position = position
+        return position
+
+    def readinto(self, b):
+        length = min(len(b), self.size - self._position)
+        if length <= 0:
+            return 0
+
+        # If this read carries on from the last one, we're probably reading
+        # the file sequentially, so it's worth reading ahead.
+        if self._position == self._last_read_end:
+            readahead = self.filesystem.readahead
+        else:
+            readahead = 0
+
+        data = self.filesystem._read(
+            self.manifest_file, start=self._position, length=length, readahead=readahead
+        )
+        b[: len(data)] = data
+
+        self._position += len(data)
+        self._last_read_end = self._position
+        return len(data)
@@ -0,0 +1,243 @@
+# -*- encoding: utf-8
+"""
+Compression backends for ``download_compressed_bag()``.
+
+Our bags are mostly images and video, which are already compressed, so
+deflating them on a single core is usually the slowest part of building an
+archive.  A backend wraps the output file, and compresses everything the
+tarfile writes to it; you can choose no compression, gzip on several
+threads, or zstd.
+
+A backend is a function ``factory(fileobj, level, threads)`` that returns a
+writable file object.  Closing it must flush everything to ``fileobj``, but
+not close ``fileobj``.  If it has a ``set_compressible(compressible)``
+method, we call it before adding each file, so it can skip compressing
+files that won't get any smaller.
+"""
+
+import collections
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Maps the names you can pass as ``compression`` to ``download_compressed_bag()``
+# (e.g. ``gzip``) to functions that create a backend.
+BACKENDS = {}
+
+# Files with these extensions are already compressed, so there's nothing to
+# gain from compressing them again.
+COMPRESSED_EXTENSIONS = frozenset(
+    [
+        ".7z",
+        ".bz2",
+        ".gif",
+        ".gz",
+        ".j2k",
+        ".jp2",
+        ".jpeg",
+        ".jpg",
+        ".m4a",
+        ".mov",
+        ".mp3",
+        ".mp4",
+        ".mxf",
+        ".png",
+        ".tgz",
+        ".xz",
+        ".zip",
+        ".zst",
+    ]
+)
+
+# The gzip backend compresses the archive in blocks of this size, so
+# different blocks can be compressed on different threads.
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+
+def register_compression(name, factory):
+    """
+    Register a compression backend, so ``download_compressed_bag()`` can
+    use it when you pass ``compression=name``.
+    """
+    BACKENDS[name] = factory
+
+
+def _open_compressed(compression, fileobj, level=None, threads=None):
+    try:
+        factory = BACKENDS[compression]
+    except KeyError:
+        raise ValueError(
+            "Unsupported compression: %r (expected one of %s)"
+            % (compression, ", ".join(sorted(BACKENDS)))
+        )
+    else:
+        return factory(fileobj, level=level, threads=threads)
+
+
+def is_compressed(name):
+    """
+    Returns True if a file's extension says it's already compressed.
+    """
+    return os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+class _UncompressedWriter(object):
+    """
+    Writes the archive as it is, for a plain ``.tar``.
+    """
+
+    def __init__(self, fileobj, level=None, threads=None):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        self.fileobj.write(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def _gzip_compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _compress_gzip_member(data, level):
+    compressor = _gzip_compressor(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _GzipWriter(object):
+    """
+    Writes a gzip file.
+
+    Any gzip reader treats a series of gzip members as one file, so on
+    ``threads`` threads, we split the archive into blocks of
+    ``GZIP_BLOCK_SIZE`` bytes and compress each block as a separate member,
+    several at once (zlib releases the GIL while it works).  On one thread,
+    we write a single member, as ``tarfile`` does.
+
+    Files that aren't compressible go in their own members, stored with
+    compression level 0, which costs little more than copying them.
+    """
+
+    def __init__(self, fileobj, level=None, threads=None):
+        self.fileobj = fileobj
+        self.level = 9 if level is None else level
+        self.threads = threads or 1
+
+        self.compressible = True
+        self._compressor = None
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+
+        if self.threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        else:
+            self._executor = None
+
+    @property
+    def _current_level(self):
+        return self.level if self.compressible else 0
+
+    def set_compressible(self, compressible):
+        if compressible != self.compressible:
+            self._end_member()
+            self.compressible = compressible
+
+    def write(self, data):
+        if self._executor is None:
+            if self._compressor is None:
+                self._compressor = _gzip_compressor(self._current_level)
+            self.fileobj.write(self._compressor.compress(data))
+            return len(data)
+
+        self._buffer.extend(data)
+
+        while len(self._buffer) >= GZIP_BLOCK_SIZE:
+            block = bytes(self._buffer[:GZIP_BLOCK_SIZE])
+            del self._buffer[:GZIP_BLOCK_SIZE]
+            self._submit(block)
+
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(
+            self._executor.submit(_compress_gzip_member, block, self._current_level)
+        )
+
+        # Members have to be written in order, and we only keep a couple of
+        # blocks queued behind each thread, to bound our memory use.
+        while len(self._pending) > self.threads * 2:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def _end_member(self):
+        if self._compressor is not None:
+            self.fileobj.write(self._compressor.flush())
+            self._compressor = None
+
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def close(self):
+        try:
+            self._end_member()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+
+
+class _ZstdWriter(object):
+    """
+    Writes a zstd file, compressing on ``threads`` threads if set.
+
+    This needs the ``zstandard`` library; install it with the ``zstd`` extra.
+    Files that aren't compressible go in separate frames at the fastest
+    compression level.
+    """
+
+    # zstd's negative levels trade compression for speed; this is fast
+    # enough that incompressible data goes through at close to copy speed.
+    FASTEST_LEVEL = -5
+
+    def __init__(self, fileobj, level=None, threads=None):
+        import zstandard
+
+        self._zstandard = zstandard
+        self.fileobj = fileobj
+        self.compressible = True
+
+        self._compressors = {
+            True: zstandard.ZstdCompressor(
+                level=3 if level is None else level, threads=threads or 0
+            ),
+            False: zstandard.ZstdCompressor(
+                level=self.FASTEST_LEVEL, threads=threads or 0
+            ),
+        }
+        self._writer = self._open_frame()
+
+    def _open_frame(self):
+        return self._compressors[self.compressible].stream_writer(
+            self.fileobj, closefd=False
+        )
+
+    def set_compressible(self, compressible):
+        if compressible != self.compressible:
+            self._writer.flush(self._zstandard.FLUSH_FRAME)
+            self.compressible = compressible
+            self._writer = self._open_frame()
+
+    def write(self, data):
+        self._writer.write(data)
+        return len(data)
+
+    def close(self):
+        self._writer.close()
+
+
+register_compression("none", _UncompressedWriter)
+register_compression("gzip", _GzipWriter)
+register_compression("zstd", _ZstdWriter)
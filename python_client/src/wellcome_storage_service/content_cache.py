@@ -0,0 +1,302 @@
+# -*- encoding: utf-8
+"""
+A local cache of file contents, keyed by checksum.
+
+Different versions of a bag (and sometimes different bags) share a lot of
+identical files.  If you download bags through a ``ContentCache``, every
+verified file is kept in the cache, and the next time we need a file with
+the same checksum we copy or link it from the cache rather than fetching it
+from the storage provider again.
+"""
+
+import collections
+import errno
+import os
+import re
+import shutil
+import stat
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from ._utils import mkdir_p, remove_if_exists
+from .downloader import _hashlib_name
+
+# The ioctl for cloning a file on Linux filesystems that support
+# copy-on-write, e.g. Btrfs and XFS.  See ioctl_ficlone(2).
+FICLONE = 0x40049409
+
+CHECKSUM_RE = re.compile(r"^[0-9a-fA-F]+$")
+
+# Next to each file in the cache, an empty file whose modified time records
+# when the file was last used.
+LAST_USED_SUFFIX = ".used"
+
+
+def _reflink(src, dst):
+    """
+    Make ``dst`` a copy-on-write clone of ``src``.  Raises ``OSError``
+    (or ``IOError``) if the filesystem doesn't support it.
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported")
+
+    with open(src, "rb") as src_file:
+        with open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def _copy(src, dst, link):
+    """
+    Copy ``src`` to ``dst``, as cheaply as we can: with a reflink if the
+    filesystem supports it, then (if allowed) a hard link, then a full copy.
+    """
+    try:
+        return _reflink(src, dst)
+    except (IOError, OSError):
+        remove_if_exists(dst)
+
+    if link:
+        try:
+            return os.link(src, dst)
+        except OSError:
+            # e.g. the cache is on a different filesystem
+            pass
+
+    shutil.copyfile(src, dst)
+
+
+def _last_used(entry_path, stat_result):
+    """
+    Returns when a file in the cache was last used: the modified time of its
+    ``.used`` file, or if it's never been used, when it was added.
+    """
+    try:
+        return os.stat(entry_path + LAST_USED_SUFFIX).st_mtime
+    except OSError:
+        return stat_result.st_mtime
+
+
+class ContentCache(object):
+    """
+    Stores the contents of files on disk, keyed by checksum, and evicts the
+    least recently used files when it gets too big.
+
+    Pass a ``ContentCache`` as ``cache`` to ``download_bag()`` to check it
+    before fetching each file, and to add every file that's downloaded and
+    verified.
+
+    Files in the cache are read-only.  If ``link`` is True and the cache
+    is on the same filesystem as the download, files are hard linked out
+    of the cache, so they're read-only too: editing one in place would
+    change the cached copy.  On filesystems that support reflinks (e.g.
+    Btrfs, XFS), we use those instead, which are safe to edit.
+
+    :param cache_dir: The directory to keep the cache in.  It can be shared
+        by several processes; each one keeps its own count of the cache size,
+        so the cache may briefly be bigger than ``max_bytes``.
+    :param max_bytes: If set, remove the least recently used files when the
+        cache holds more than this many bytes.
+    :param link: If True, hard link files out of the cache if we can't
+        reflink them; otherwise copy them.
+
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, link=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.link = link
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = None
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _entry_path(self, key):
+        checksum_algorithm, checksum = key
+        return os.path.join(self.cache_dir, checksum_algorithm, checksum[:2], checksum)
+
+    def _last_used_path(self, key):
+        return self._entry_path(key) + LAST_USED_SUFFIX
+
+    def _key(self, checksum_algorithm, checksum):
+        # The checksum becomes part of a path, so make sure it's really a
+        # checksum and not something like ``../../etc/passwd``.
+        if not CHECKSUM_RE.match(checksum):
+            raise ValueError("Not a valid checksum: %r" % checksum)
+        return (_hashlib_name(checksum_algorithm), checksum.lower())
+
+    def _load_entries(self):
+        """
+        Scan the cache directory for existing files, ordered from least to
+        most recently used.  Must be called with the lock held.
+        """
+        if self._entries is not None:
+            return
+
+        found = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not CHECKSUM_RE.match(filename):
+                    continue
+                checksum_algorithm = os.path.basename(os.path.dirname(dirpath))
+                entry_path = os.path.join(dirpath, filename)
+                stat_result = os.stat(entry_path)
+                found.append(
+                    (
+                        _last_used(entry_path, stat_result),
+                        (checksum_algorithm, filename),
+                        stat_result,
+                    )
+                )
+
+        self._entries = collections.OrderedDict()
+        for _, key, stat_result in sorted(found):
+            self._entries[key] = stat_result.st_size
+            self._total_bytes += stat_result.st_size
+
+    def _touch(self, key):
+        """
+        Mark a file as recently used.  Must be called with the lock held.
+        """
+        self._entries[key] = self._entries.pop(key)
+
+        # Other processes sharing the cache see when a file was last used
+        # by the modified time of its ``.used`` file.  We can't touch the
+        # cached file itself: it may be hard linked into a download, and
+        # changing its modified time would change the downloaded file's too.
+        last_used_path = self._last_used_path(key)
+        try:
+            with open(last_used_path, "a"):
+                pass
+            os.utime(last_used_path, None)
+        except (IOError, OSError):
+            pass
+
+    def _evict(self):
+        """
+        Remove the least recently used files until the cache is small enough.
+        Must be called with the lock held.
+        """
+        if self.max_bytes is None:
+            return
+
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            remove_if_exists(self._entry_path(key))
+            remove_if_exists(self._last_used_path(key))
+
+    def _find(self, key):
+        """
+        Returns the path to a file in the cache, or None if it isn't cached.
+        """
+        with self._lock:
+            self._load_entries()
+
+            entry_path = self._entry_path(key)
+
+            # Another process might have added the file since we last looked,
+            # or evicted it.
+            if key not in self._entries and os.path.isfile(entry_path):
+                self._entries[key] = os.path.getsize(entry_path)
+                self._total_bytes += self._entries[key]
+            elif key in self._entries and not os.path.isfile(entry_path):
+                self._total_bytes -= self._entries.pop(key)
+
+            if key in self._entries:
+                self.hits += 1
+                self._touch(key)
+                return entry_path
+            else:
+                self.misses += 1
+                return None
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            self._load_entries()
+            return self._total_bytes
+
+    def get(self, checksum_algorithm, checksum, out_path):
+        """
+        If a file with this checksum is cached, copy it to ``out_path`` and
+        return True; otherwise return False.  Any existing file at
+        ``out_path`` is replaced.
+        """
+        entry_path = self._find(self._key(checksum_algorithm, checksum))
+        if entry_path is None:
+            return False
+
+        mkdir_p(os.path.dirname(out_path))
+        remove_if_exists(out_path)
+
+        try:
+            _copy(entry_path, out_path, link=self.link)
+        except (IOError, OSError) as err:
+            # The file was evicted by another process since we found it.
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+
+        return True
+
+    def open(self, checksum_algorithm, checksum):
+        """
+        Returns a binary file with the cached contents of a file, or None
+        if it isn't cached.
+        """
+        entry_path = self._find(self._key(checksum_algorithm, checksum))
+        if entry_path is None:
+            return None
+
+        try:
+            return open(entry_path, "rb")
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+
+    def put(self, checksum_algorithm, checksum, path):
+        """
+        Add a copy of the file at ``path`` to the cache.  The caller should
+        already have checked that the file matches ``checksum``.
+        """
+        key = self._key(checksum_algorithm, checksum)
+        size = os.path.getsize(path)
+
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._load_entries()
+            if key in self._entries:
+                self._touch(key)
+                return
+
+        entry_path = self._entry_path(key)
+        mkdir_p(os.path.dirname(entry_path))
+
+        # Copy to a temporary file and rename it into place, so another
+        # process never sees a half-written file.  We never hard link a file
+        # into the cache, so nothing outside the cache can change it.
+        tmp_path = "%s.%d.%d.tmp" % (
+            entry_path,
+            os.getpid(),
+            threading.current_thread().ident,
+        )
+        _copy(path, tmp_path, link=False)
+        os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.rename(tmp_path, entry_path)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = size
+                self._total_bytes += size
+            self._evict()
@@ -1,73 +1,1100 @@
 # -*- encoding: utf-8
 
 import abc
+import calendar
+import collections
+import datetime
+import errno
+import fnmatch
+import functools
+import hashlib
+import io
+import json
 import os
-import shutil
+import re
 import tarfile
-import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 
 try:
     from collections.abc import ABC
 except ImportError:  # Python 2
     from abc import ABCMeta as ABC
 
-from ._utils import mkdir_p
+try:
+    string_types = (basestring,)  # noqa: F821
+except NameError:  # Python 3
+    string_types = (str,)
+
+from ._utils import mkdir_p, remove_if_exists
+from .compression import _open_compressed, is_compressed
+from .exceptions import BagDownloadError, FilesNotInBag, FixityError
+from .progress import DownloadListener
+
+# Maps the provider IDs used in storage manifests (e.g. ``amazon-s3``) to
+# functions that create a provider for reading from that storage.
+PROVIDERS = {}
+
+# How many bytes we read from the storage provider at a time, when copying
+# a file.  Bigger chunks mean fewer calls into the provider's SDK, at the
+# cost of more memory per file in flight.
+CHUNK_SIZE = 8096
+
+
+def register_provider(provider_id, factory):
+    """
+    Register a provider for locations with a given provider ID, so the
+    downloader can read bags stored there.  ``factory`` is called with no
+    arguments, and should return an instance of ``AbstractProvider``.
+    """
+    PROVIDERS[provider_id] = factory
 
 
 def _choose_provider(location):
-    if location["provider"]["id"] == "amazon-s3":
-        return S3InfrequentAccessProvider()
-    else:
+    try:
+        factory = PROVIDERS[location["provider"]["id"]]
+    except KeyError:
         raise RuntimeError(
             "Unsupported storage provider: %s" % location["provider"]["id"]
         )
+    else:
+        return factory()
+
+
+def _hashlib_name(checksum_algorithm):
+    """
+    Returns the name hashlib uses for a checksum algorithm in the storage
+    manifest, e.g. SHA-256 becomes sha256.
+    """
+    return checksum_algorithm.lower().replace("-", "")
+
+
+def _checksum_algorithm(manifest, with_checksums):
+    if with_checksums:
+        return _hashlib_name(manifest["checksumAlgorithm"])
+    else:
+        return None
+
+
+def _all_files_with_checksum_algorithm(storage_manifest, with_checksums=True):
+    """
+    Yields ``(manifest_file, checksum_algorithm)`` for every file in the bag.
+    """
+    for manifest in (storage_manifest["manifest"], storage_manifest["tagManifest"]):
+        checksum_algorithm = _checksum_algorithm(manifest, with_checksums)
+        for manifest_file in manifest["files"]:
+            yield manifest_file, checksum_algorithm
+
+
+def _compile_globs(patterns):
+    """
+    Returns a regex that matches any of a list of shell-style glob patterns.
+    """
+    return re.compile("|".join("(?:%s)" % fnmatch.translate(p) for p in patterns))
 
 
-def _all_files(storage_manifest):
-    return (
-        storage_manifest["manifest"]["files"] + storage_manifest["tagManifest"]["files"]
+class FileFilter(object):
+    """
+    Chooses which files to download from a bag, so you can fetch (say) just
+    the METS file without fetching every image.
+
+    Files are selected by name: if you pass ``include`` or ``names``, only
+    files that match one of the ``include`` patterns or are in ``names`` are
+    selected; otherwise every file is.  The other options then narrow down
+    that selection.
+
+    :param include: A glob pattern or list of patterns, e.g. ``data/*.xml``.
+        As in ``fnmatch``, ``*`` matches any characters including ``/``.
+    :param exclude: A glob pattern or list of patterns.  Files that match
+        any of these are never selected.
+    :param names: A list of exact file names, e.g. ``["bag-info.txt"]``.
+        If any of these aren't in the bag, selecting files raises
+        ``FilesNotInBag``.
+    :param min_size: If set, skip files smaller than this many bytes.
+    :param max_size: If set, skip files larger than this many bytes.
+    :param tag_files_only: If True, only select files from the tag manifest,
+        e.g. ``bag-info.txt`` and ``manifest-sha256.txt``.
+
+    """
+
+    def __init__(
+        self,
+        include=None,
+        exclude=None,
+        names=None,
+        min_size=None,
+        max_size=None,
+        tag_files_only=False,
+    ):
+        if isinstance(include, string_types):
+            include = [include]
+        if isinstance(exclude, string_types):
+            exclude = [exclude]
+
+        self.include = include
+        self.exclude = exclude
+        self.names = set(names) if names is not None else None
+        self.min_size = min_size
+        self.max_size = max_size
+        self.tag_files_only = tag_files_only
+
+        self._include_regex = _compile_globs(include) if include else None
+        self._exclude_regex = _compile_globs(exclude) if exclude else None
+
+    def _is_included(self, name):
+        if self._include_regex is None and self.names is None:
+            return True
+        elif self.names is not None and name in self.names:
+            return True
+        elif self._include_regex is not None:
+            return self._include_regex.match(name) is not None
+        else:
+            return False
+
+    def matches(self, manifest_file):
+        """
+        Returns True if a file should be selected, based on its name and size.
+        This doesn't check ``tag_files_only``.
+        """
+        name = manifest_file["name"]
+        size = manifest_file.get("size")
+
+        if not self._is_included(name):
+            return False
+        elif self._exclude_regex is not None and self._exclude_regex.match(name):
+            return False
+        elif self.min_size is not None and size < self.min_size:
+            return False
+        elif self.max_size is not None and size > self.max_size:
+            return False
+        else:
+            return True
+
+    def select(self, storage_manifest, with_checksums=True):
+        """
+        Yields ``(manifest_file, checksum_algorithm)`` for every selected file
+        in the bag.  With ``with_checksums=False``, the checksum algorithm is
+        always None, and the manifest doesn't need to include it.
+        """
+        if self.tag_files_only:
+            manifests = (storage_manifest["tagManifest"],)
+        else:
+            manifests = (storage_manifest["manifest"], storage_manifest["tagManifest"])
+
+        seen_names = set()
+
+        for manifest in manifests:
+            checksum_algorithm = _checksum_algorithm(manifest, with_checksums)
+            for manifest_file in manifest["files"]:
+                if self.matches(manifest_file):
+                    seen_names.add(manifest_file["name"])
+                    yield manifest_file, checksum_algorithm
+
+        if self.names is not None and not self.names.issubset(seen_names):
+            raise FilesNotInBag(sorted(self.names - seen_names))
+
+
+def _select_files(storage_manifest, file_filter, with_checksums=True):
+    """
+    Returns a list of ``(manifest_file, checksum_algorithm)`` for the files
+    chosen by ``file_filter``, or an iterator over every file in the bag.
+
+    If we aren't going to hash anything, pass ``with_checksums=False``; the
+    checksum algorithm is None, and we don't look for it in the manifest.
+    """
+    if file_filter is None:
+        return _all_files_with_checksum_algorithm(
+            storage_manifest, with_checksums=with_checksums
+        )
+
+    # We plan the whole download before fetching anything, so we find out
+    # about any missing names before we start.
+    return list(file_filter.select(storage_manifest, with_checksums=with_checksums))
+
+
+class FileVerification(object):
+    """
+    The result of checking a downloaded file against its entry in the
+    storage manifest.
+    """
+
+    def __init__(self, manifest_file, checksum_algorithm, actual_checksum, actual_size):
+        self.manifest_file = manifest_file
+        self.checksum_algorithm = checksum_algorithm
+        self.actual_checksum = actual_checksum
+        self.actual_size = actual_size
+
+    def __repr__(self):
+        return "%s(name=%r, checksum_matches=%r, size_matches=%r)" % (
+            type(self).__name__,
+            self.manifest_file["name"],
+            self.checksum_matches,
+            self.size_matches,
+        )
+
+    @property
+    def expected_checksum(self):
+        return self.manifest_file["checksum"]
+
+    @property
+    def expected_size(self):
+        return self.manifest_file.get("size")
+
+    @property
+    def checksum_matches(self):
+        return self.actual_checksum == self.expected_checksum
+
+    @property
+    def size_matches(self):
+        return self.expected_size is None or self.actual_size == self.expected_size
+
+    @property
+    def is_valid(self):
+        return self.checksum_matches and self.size_matches
+
+
+class _DownloadJournal(object):
+    """
+    Records which files in a bag have been completely downloaded and verified,
+    so an interrupted download can pick up where it left off.
+
+    The journal is kept in the output directory.  Each line is a JSON object
+    with the name, size and checksum of a completed file; we append a line
+    as soon as a file is finished, so the journal is always up-to-date if
+    the process dies.
+    """
+
+    filename = ".download-journal.jsonl"
+
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, self.filename)
+        self.completed = {}
+
+        try:
+            with open(self.path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A partially-written line from an interrupted run
+                        continue
+                    self.completed[entry["name"]] = entry
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+        self._lock = threading.Lock()
+
+    def get_completed(self, out_path, manifest_file):
+        """
+        Returns the journal entry for a file if it was already downloaded,
+        matches the storage manifest, and is still on disk, or None if not.
+        """
+        try:
+            entry = self.completed[manifest_file["name"]]
+        except KeyError:
+            return None
+
+        if entry["checksum"] != manifest_file["checksum"]:
+            return None
+        elif entry["size"] != manifest_file.get("size", entry["size"]):
+            return None
+        elif not os.path.isfile(out_path):
+            return None
+        elif os.path.getsize(out_path) != entry["size"]:
+            return None
+        else:
+            return entry
+
+    def record(self, verification):
+        entry = {
+            "name": verification.manifest_file["name"],
+            "size": verification.actual_size,
+            "checksum": verification.actual_checksum,
+        }
+
+        with self._lock:
+            mkdir_p(os.path.dirname(self.path))
+            with open(self.path, "a") as journal_file:
+                journal_file.write(json.dumps(entry) + "\n")
+            self.completed[entry["name"]] = entry
+
+
+def _resume_offset(out_path, manifest_file):
+    """
+    Returns how many bytes of a partially downloaded file we can keep.
+
+    If the file is already at (or past) its expected size, we can't tell
+    whether it's complete -- for example, a ranged download preallocates
+    the whole file -- so we start again from scratch.
+    """
+    try:
+        local_size = os.path.getsize(out_path)
+    except OSError:
+        return 0
+
+    if local_size < manifest_file.get("size", 0):
+        return local_size
+    else:
+        return 0
+
+
+def _download_and_verify(
+    replicas, out_dir, manifest_file, checksum_algorithm, offset, listener
+):
+    actual_size, hasher = replicas.download(
+        out_dir=out_dir,
+        manifest_file=manifest_file,
+        hasher=hashlib.new(checksum_algorithm),
+        offset=offset,
+        listener=listener,
+    )
+
+    verification = FileVerification(
+        manifest_file=manifest_file,
+        checksum_algorithm=checksum_algorithm,
+        actual_checksum=hasher.hexdigest(),
+        actual_size=actual_size,
     )
 
+    # The partial file we resumed may not be the start of this file (e.g.
+    # it was left by an older version of the bag), so try again from
+    # scratch.  We don't leave a bad resumed file on disk, even if the
+    # caller isn't verifying the download.
+    if offset and not verification.is_valid:
+        verification = _download_and_verify(
+            replicas, out_dir, manifest_file, checksum_algorithm, 0, listener
+        )
+        if not verification.is_valid:
+            raise FixityError(verification)
+
+    return verification
 
-def download_bag(storage_manifest, out_dir):
+
+def _download_file(
+    replicas,
+    out_dir,
+    manifest_file,
+    checksum_algorithm=None,
+    fail_fast=False,
+    journal=None,
+    listener=None,
+    cache=None,
+):
+    """
+    Download a single file.  If ``checksum_algorithm`` is set, the file is
+    hashed as it's written to disk, and we return a ``FileVerification``.
+
+    If there's a ``journal``, files it records as complete are skipped,
+    partially downloaded files are resumed from where they stopped, and
+    newly completed files are added to it.  If a resumed file doesn't match
+    the manifest, we download it again from the start, and raise a
+    ``FixityError`` if that doesn't match either.
+
+    If there's a ``cache``, files in it are copied from the cache rather
+    than downloaded, and newly downloaded files are added to it if they
+    match the checksum in the manifest.  This needs ``checksum_algorithm``.
+    """
+    if checksum_algorithm is None:
+        replicas.download(
+            out_dir=out_dir, manifest_file=manifest_file, listener=listener
+        )
+        return
+
+    offset = 0
+    out_path = os.path.join(out_dir, manifest_file["name"])
+
+    if journal is not None:
+        entry = journal.get_completed(out_path, manifest_file)
+        if entry is not None:
+            return FileVerification(
+                manifest_file=manifest_file,
+                checksum_algorithm=checksum_algorithm,
+                actual_checksum=entry["checksum"],
+                actual_size=entry["size"],
+            )
+
+        offset = _resume_offset(out_path, manifest_file)
+
+    if cache is not None and cache.get(
+        checksum_algorithm, manifest_file["checksum"], out_path
+    ):
+        verification = FileVerification(
+            manifest_file=manifest_file,
+            checksum_algorithm=checksum_algorithm,
+            actual_checksum=manifest_file["checksum"],
+            actual_size=os.path.getsize(out_path),
+        )
+
+        if journal is not None:
+            journal.record(verification)
+
+        return verification
+
+    verification = _download_and_verify(
+        replicas, out_dir, manifest_file, checksum_algorithm, offset, listener
+    )
+
+    if journal is not None and verification.is_valid:
+        journal.record(verification)
+
+    if cache is not None and verification.is_valid:
+        cache.put(checksum_algorithm, manifest_file["checksum"], out_path)
+
+    if fail_fast and not verification.is_valid:
+        raise FixityError(verification)
+
+    return verification
+
+
+class _Replica(object):
+    """
+    One copy of a bag, and how well downloading from it has gone so far.
+    """
+
+    def __init__(self, location, provider):
+        self.location = location
+        self.provider = provider
+
+        # Bytes per second, as an exponentially weighted moving average, so
+        # a single slow file doesn't count against a replica forever.
+        self.throughput = None
+        self.failures = 0
+
+    def record_success(self, size, elapsed):
+        throughput = size / max(elapsed, 0.000001)
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput = 0.7 * self.throughput + 0.3 * throughput
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+
+
+class _Replicas(object):
+    """
+    The copies of a bag we can download from.
+
+    By default this is just the bag's primary location.  With
+    ``use_replicas``, it also includes every replica we have a provider for.
+    We try each replica at least once, then prefer whichever has had the
+    best throughput; if a download fails, we fall back to the next replica.
+
+    With a ``HedgingPolicy``, if a request for a small file is slow to
+    respond, we send a second request to the next replica (or the same one,
+    if there's only one), and use whichever responds first.
+    """
+
+    def __init__(
+        self, storage_manifest, use_replicas=False, hedging=None, max_workers=1
+    ):
+        self.replicas = []
+        self.hedging = hedging
+        self._lock = threading.Lock()
+
+        if use_replicas:
+            replica_locations = storage_manifest.get("replicaLocations", [])
+        else:
+            replica_locations = []
+
+        for location in replica_locations:
+            # Bags often have replicas in storage we can't read directly
+            # (e.g. Glacier), or for which the SDK isn't installed.
+            try:
+                provider = _choose_provider(location)
+            except (ImportError, RuntimeError):
+                continue
+            self.replicas.append(_Replica(location, provider))
+
+        primary_location = storage_manifest["location"]
+        try:
+            primary_provider = _choose_provider(primary_location)
+        except (ImportError, RuntimeError):
+            if not self.replicas:
+                raise
+        else:
+            self.replicas.insert(0, _Replica(primary_location, primary_provider))
+
+        self.set_max_workers(max_workers)
+
+    def set_max_workers(self, max_workers):
+        # With hedging, each download thread can have two requests in flight.
+        if self.hedging is not None:
+            self.hedging.set_max_workers(max_workers)
+            max_requests = 2 * max_workers
+        else:
+            max_requests = max_workers
+
+        for replica in self.replicas:
+            if isinstance(replica.provider, AbstractProvider):
+                replica.provider.set_max_workers(max_requests)
+
+    def _ordered(self):
+        # Replicas we haven't measured yet come first, so we measure every
+        # replica; after that, the fastest replica that's working.
+        with self._lock:
+            return sorted(
+                self.replicas,
+                key=lambda r: (
+                    r.failures,
+                    r.throughput is not None,
+                    -(r.throughput or 0),
+                ),
+            )
+
+    def download(self, out_dir, manifest_file, hasher=None, offset=0, listener=None):
+        """
+        Download a file, trying each replica in turn until one succeeds.
+
+        Returns the size of the file and the hasher (if any) -- every attempt
+        starts from a copy of ``hasher``, so a failed attempt can't leave
+        partial data in the hash.
+        """
+        if listener is None:
+            listener = DownloadListener()
+
+        listener.file_started(manifest_file)
+        last_error = None
+
+        for replica in self._ordered():
+            if last_error is not None:
+                listener.file_retried(manifest_file, last_error)
+
+            attempt_hasher = hasher.copy() if hasher is not None else None
+            start = time.time()
+
+            try:
+                if self.hedging is not None and self.hedging.applies_to(manifest_file):
+                    size, replica = self._download_hedged(
+                        replica,
+                        out_dir=out_dir,
+                        manifest_file=manifest_file,
+                        hasher=attempt_hasher,
+                        offset=offset,
+                        listener=listener,
+                    )
+                else:
+                    size = replica.provider.download(
+                        out_dir=out_dir,
+                        location=replica.location,
+                        manifest_file=manifest_file,
+                        hasher=attempt_hasher,
+                        offset=offset,
+                        listener=listener,
+                    )
+            except Exception as err:
+                with self._lock:
+                    replica.record_failure()
+                last_error = err
+                continue
+
+            with self._lock:
+                replica.record_success(size - offset, time.time() - start)
+
+            listener.file_finished(manifest_file, size)
+            return size, attempt_hasher
+
+        listener.file_failed(manifest_file, last_error)
+        raise last_error
+
+    def _hedge_for(self, replica):
+        for other in self._ordered():
+            if other is not replica:
+                return other
+
+        return replica
+
+    def _download_hedged(
+        self, replica, out_dir, manifest_file, hasher, offset, listener
+    ):
+        """
+        Download a file from ``replica``, hedging the request if it's slow.
+
+        Returns the size of the file, and the replica we downloaded it from.
+        """
+        hedge = self._hedge_for(replica)
+        chosen = {}
+
+        def _opener(r, offset):
+            if offset:
+                return lambda: r.provider.get_fileobj_from(
+                    location=r.location, manifest_file=manifest_file, offset=offset
+                )
+            else:
+                return lambda: r.provider.get_fileobj(
+                    location=r.location, manifest_file=manifest_file
+                )
+
+        def open_from(offset):
+            read_file_obj, hedge_won = self.hedging.open(
+                _opener(replica, offset),
+                _opener(hedge, offset),
+                on_hedge=lambda: listener.file_hedged(manifest_file),
+            )
+            chosen["replica"] = hedge if hedge_won else replica
+            return read_file_obj
+
+        size = _download_to_path(
+            open_from,
+            out_path=os.path.join(out_dir, manifest_file["name"]),
+            hasher=hasher,
+            offset=offset,
+            on_chunk=_chunk_callback(listener, manifest_file),
+        )
+
+        return size, chosen["replica"]
+
+    def close(self):
+        if self.hedging is not None:
+            self.hedging.close()
+
+        for replica in self.replicas:
+            if isinstance(replica.provider, AbstractProvider):
+                replica.provider.close()
+
+    def get_fileobj(self, manifest_file):
+        """
+        Open a file from the first replica that will serve it.
+        """
+        last_error = None
+
+        for replica in self._ordered():
+            try:
+                return replica.provider.get_fileobj(
+                    location=replica.location, manifest_file=manifest_file
+                )
+            except Exception as err:
+                with self._lock:
+                    replica.record_failure()
+                last_error = err
+
+        raise last_error
+
+
+class _InFlightLimiter(object):
+    """
+    Limits the number and total size of files that are queued or being
+    downloaded at once.
+
+    A file which is bigger than the whole byte budget is still allowed
+    through when nothing else is in flight, so it can't block the download.
+    """
+
+    def __init__(self, max_files, max_bytes=None):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+
+        self.files_in_flight = 0
+        self.bytes_in_flight = 0
+        self._condition = threading.Condition()
+
+    def _is_full(self, size):
+        if self.files_in_flight == 0:
+            return False
+        elif self.files_in_flight >= self.max_files:
+            return True
+        elif self.max_bytes is not None:
+            return self.bytes_in_flight + size > self.max_bytes
+        else:
+            return False
+
+    def acquire(self, size):
+        with self._condition:
+            while self._is_full(size):
+                self._condition.wait()
+
+            self.files_in_flight += 1
+            self.bytes_in_flight += size
+
+    def try_acquire(self, size):
+        """
+        Like ``acquire()``, but returns False rather than waiting if there's
+        no room.  For callers that release files from the same thread.
+        """
+        with self._condition:
+            if self._is_full(size):
+                return False
+
+            self.files_in_flight += 1
+            self.bytes_in_flight += size
+            return True
+
+    def release(self, size):
+        with self._condition:
+            self.files_in_flight -= 1
+            self.bytes_in_flight -= size
+            self._condition.notify_all()
+
+
+def _download_concurrently(download, files, max_workers, max_in_flight_bytes):
+    """
+    Call ``download(manifest_file, checksum_algorithm)`` for every pair in
+    ``files`` on a pool of threads, and return the results.
+    """
+    # Start with the biggest files, so a single slow object doesn't get
+    # left until the end and become the only thing we're waiting for.
+    files = sorted(files, key=lambda f: f[0].get("size", 0), reverse=True)
+
+    # We keep a couple of files queued behind each worker, so they never
+    # go idle, but we don't create a future for every file in a large bag.
+    limiter = _InFlightLimiter(max_files=max_workers * 2, max_bytes=max_in_flight_bytes)
+    results = []
+    failures = []
+    fixity_errors = []
+
+    def _download(manifest_file, checksum_algorithm):
+        try:
+            results.append(download(manifest_file, checksum_algorithm))
+        except FixityError as err:
+            fixity_errors.append(err)
+        except Exception as err:
+            failures.append((manifest_file, err))
+        finally:
+            limiter.release(manifest_file.get("size", 0))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for manifest_file, checksum_algorithm in files:
+            # A fixity error is only raised if we're failing fast, so stop
+            # scheduling more work as soon as we see one.
+            if fixity_errors:
+                break
+
+            limiter.acquire(manifest_file.get("size", 0))
+            executor.submit(_download, manifest_file, checksum_algorithm)
+
+    if fixity_errors:
+        raise fixity_errors[0]
+
+    if failures:
+        raise BagDownloadError(failures)
+
+    return results
+
+
+def download_bag(
+    storage_manifest,
+    out_dir,
+    max_workers=None,
+    max_in_flight_bytes=None,
+    verify=False,
+    fail_fast=False,
+    resume=False,
+    file_filter=None,
+    use_replicas=False,
+    listener=None,
+    cache=None,
+    hedging=None,
+):
     """
     Download all the files in a bag to a given directory.
 
     :param storage_manifest: A storage manifest returned from the storage
         service, as retrieved with ``get_bag()``.
     :param out_dir: The directory to download the bag to.
+    :param max_workers: If set, download up to this many files at once.
+        Files are fetched largest-first, and if any of them fail, the rest
+        of the bag is still downloaded before raising a ``BagDownloadError``.
+    :param max_in_flight_bytes: If set, limit the total size of the files
+        being downloaded at once.  Only used with ``max_workers``.
+    :param verify: If True, hash every file as it's downloaded, and return
+        a list of ``FileVerification`` results comparing each file to the
+        checksum and size in the storage manifest.
+    :param fail_fast: If True, raise a ``FixityError`` as soon as a file
+        fails verification, rather than downloading the rest of the bag.
+        Only used with ``verify``.
+    :param resume: If True, keep a journal of completed files in ``out_dir``.
+        If a previous download was interrupted, files it completed and
+        verified are skipped, and partially downloaded files are resumed
+        from where they stopped.  A resumed file that doesn't match the
+        manifest is downloaded again from the start, and if that doesn't
+        match either, we raise a ``FixityError``.
+    :param file_filter: If set, a ``FileFilter`` that chooses which files
+        to download, rather than the whole bag.
+    :param use_replicas: If True, download from any of the bag's replicas
+        (e.g. in Azure) as well as its primary location, preferring the
+        fastest, and falling back to another replica if a download fails.
+    :param listener: A ``DownloadListener`` that gets events as each file is
+        downloaded, e.g. a ``DownloadStats`` to measure the download.
+        Files copied from ``cache`` don't get any events.
+    :param cache: If set, a ``ContentCache`` to check before downloading
+        each file.  Files that aren't in the cache are hashed as they're
+        downloaded, and added to the cache if they match the manifest.
+    :param hedging: If set, a ``HedgingPolicy``.  If a request for a small
+        file is slow to respond, we send a second request -- to another
+        replica, with ``use_replicas`` -- and use whichever responds first.
+        The listener gets a ``file_hedged`` event for each hedged request.
 
     """
-    location = storage_manifest["location"]
-    provider = _choose_provider(location)
+    replicas = _Replicas(
+        storage_manifest,
+        use_replicas=use_replicas,
+        hedging=hedging,
+        max_workers=max_workers or 1,
+    )
 
-    for manifest_file in _all_files(storage_manifest):
-        provider.download(
-            out_dir=out_dir, location=location, manifest_file=manifest_file
+    # We need checksums to know which files in the journal are complete,
+    # and which files can go in the cache.
+    files = _select_files(
+        storage_manifest,
+        file_filter=file_filter,
+        with_checksums=bool(verify or resume or cache),
+    )
+
+    journal = _DownloadJournal(out_dir) if resume else None
+
+    def _download(manifest_file, checksum_algorithm):
+        return _download_file(
+            replicas=replicas,
+            out_dir=out_dir,
+            manifest_file=manifest_file,
+            checksum_algorithm=checksum_algorithm,
+            fail_fast=fail_fast,
+            journal=journal,
+            listener=listener,
+            cache=cache,
         )
 
+    try:
+        if max_workers is None:
+            results = [_download(*f) for f in files]
+        else:
+            results = _download_concurrently(
+                download=_download,
+                files=files,
+                max_workers=max_workers,
+                max_in_flight_bytes=max_in_flight_bytes,
+            )
+    finally:
+        replicas.close()
+
+    if verify:
+        return results
+
+
+def _archive_mtime(storage_manifest):
+    """
+    Returns the modified time for entries in a compressed bag, which is the
+    creation date of the storage manifest.
+    """
+    try:
+        created_date = storage_manifest["createdDate"]
+    except KeyError:
+        return time.time()
+
+    # e.g. 2019-09-12T20:26:53.094757Z
+    created = datetime.datetime.strptime(created_date[:19], "%Y-%m-%dT%H:%M:%S")
+    return calendar.timegm(created.timetuple())
+
+
+def _tar_directory(name, mtime):
+    tarinfo = tarfile.TarInfo(name=name)
+    tarinfo.type = tarfile.DIRTYPE
+    tarinfo.mode = 0o755
+    tarinfo.mtime = mtime
+    return tarinfo
+
 
-def download_compressed_bag(storage_manifest, out_path, top_level_dir=None):
+def download_compressed_bag(
+    storage_manifest,
+    out_path=None,
+    top_level_dir=None,
+    fileobj=None,
+    file_filter=None,
+    use_replicas=False,
+    listener=None,
+    cache=None,
+    compression="gzip",
+    compression_level=None,
+    threads=None,
+    skip_compressed=False,
+):
     """
     Download all the files in a bag to a compressed archive.
 
+    The archive is built by streaming each file from the storage provider
+    straight into the tar.gz, so the bag is never written to disk uncompressed.
+
     :param storage_manifest: A storage manifest returned from the storage
         service, as retrieved with ``get_bag()``.
-    :param out_path: The path to download the tar.gz to.
+    :param out_path: The path to download the tar.gz to.  If the download
+        fails, we delete the partial archive.
     :param top_level_dir: Name of top level directory in archive (defaults to
         the bag's external identifier).
+    :param fileobj: A writable binary file object to write the tar.gz to,
+        instead of ``out_path``, e.g. ``sys.stdout.buffer``.  It doesn't
+        need to be seekable.
+    :param file_filter: If set, a ``FileFilter`` that chooses which files
+        to put in the archive, rather than the whole bag.
+    :param use_replicas: If True, read each file from the first of the bag's
+        locations (primary or replica) that will serve it.
+    :param listener: A ``DownloadListener`` that gets events as each file is
+        added to the archive.  Time spent compressing counts as writing.
+    :param cache: If set, a ``ContentCache`` to read files from, rather than
+        downloading them, if they're in it.
+    :param compression: How to compress the archive: ``gzip`` for a tar.gz,
+        ``zstd`` for a tar.zst (this needs the ``zstd`` extra), or ``none``
+        for a plain tar.  You can add more with ``register_compression()``.
+    :param compression_level: The compression level, if not the default for
+        the backend (9 for gzip, 3 for zstd).
+    :param threads: If set, compress on this many threads.  With gzip, the
+        output is a series of gzip members, which any gzip reader can read.
+    :param skip_compressed: If True, don't try to compress files that are
+        already compressed, going by their extension (e.g. ``.jp2``, ``.zip``).
 
     """
     if top_level_dir is None:
         top_level_dir = storage_manifest["info"]["externalIdentifier"]
 
-    temp_dir = tempfile.mkdtemp()
-    download_bag(storage_manifest=storage_manifest, out_dir=temp_dir)
+    if out_path is None and fileobj is None:
+        raise ValueError("download_compressed_bag() needs an out_path or a fileobj")
+
+    replicas = _Replicas(storage_manifest, use_replicas=use_replicas)
+
+    if fileobj is None:
+        out_file = fileobj = open(out_path, "wb")
+    else:
+        out_file = None
+
+    try:
+        compressed = _open_compressed(
+            compression, fileobj, level=compression_level, threads=threads
+        )
+
+        with closing(compressed):
+            with tarfile.open(fileobj=compressed, mode="w|") as tf:
+                _add_bag_to_archive(
+                    tf,
+                    storage_manifest=storage_manifest,
+                    top_level_dir=top_level_dir,
+                    files=_select_files(
+                        storage_manifest,
+                        file_filter=file_filter,
+                        with_checksums=cache is not None,
+                    ),
+                    open_file=functools.partial(_open_file, replicas, cache),
+                    listener=listener,
+                    set_compressible=(
+                        getattr(compressed, "set_compressible", None)
+                        if skip_compressed
+                        else None
+                    ),
+                )
+    except Exception:
+        # Don't leave a truncated archive that looks like a complete one.
+        if out_file is not None:
+            out_file.close()
+            remove_if_exists(out_path)
+        raise
+    finally:
+        replicas.close()
+        if out_file is not None:
+            out_file.close()
+
+
+def _add_bag_to_archive(
+    tf, storage_manifest, top_level_dir, files, open_file, listener, set_compressible
+):
+    mtime = _archive_mtime(storage_manifest)
 
-    with tarfile.open(out_path, "w:gz") as tf:
-        tf.add(temp_dir, arcname=top_level_dir)
+    tf.addfile(_tar_directory(top_level_dir, mtime=mtime))
+    seen_directories = set()
 
-    shutil.rmtree(temp_dir)
+    for manifest_file, checksum_algorithm in sorted(files, key=lambda f: f[0]["name"]):
+        # Add an entry for every directory above this file, the first
+        # time we see it.  Sorting by name means every directory appears
+        # in the archive before its contents.
+        parts = manifest_file["name"].split("/")
+        for i in range(1, len(parts)):
+            directory = "/".join(parts[:i])
+            if directory not in seen_directories:
+                seen_directories.add(directory)
+                tf.addfile(
+                    _tar_directory("%s/%s" % (top_level_dir, directory), mtime=mtime)
+                )
+
+        tarinfo = tarfile.TarInfo(name="%s/%s" % (top_level_dir, manifest_file["name"]))
+        tarinfo.size = manifest_file["size"]
+        tarinfo.mode = 0o644
+        tarinfo.mtime = mtime
+
+        # tarfile buffers up to a record (10KB) before passing it on, so a
+        # little of the previous file may be compressed as if it were this
+        # one; that only affects the size of the archive, not what's in it.
+        if set_compressible is not None:
+            set_compressible(not is_compressed(manifest_file["name"]))
+
+        _add_file_to_archive(
+            tf,
+            tarinfo,
+            open_file=functools.partial(
+                open_file,
+                manifest_file=manifest_file,
+                checksum_algorithm=checksum_algorithm,
+            ),
+            manifest_file=manifest_file,
+            listener=listener,
+        )
+
+
+class _TimedReader(object):
+    """
+    Wraps a readable file, and reports every chunk read from it to a
+    ``DownloadListener``.  The time between reads is counted as time spent
+    writing the previous chunk.
+    """
+
+    def __init__(self, read_file_obj, manifest_file, listener):
+        self.read_file_obj = read_file_obj
+        self.manifest_file = manifest_file
+        self.listener = listener
+        self._last_read = time.time()
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.read_file_obj.read(size)
+        end = time.time()
+
+        self.listener.bytes_transferred(
+            self.manifest_file,
+            size=len(data),
+            read_seconds=end - start,
+            write_seconds=start - self._last_read,
+        )
+        self._last_read = end
+        return data
+
+
+def _open_file(replicas, cache, manifest_file, checksum_algorithm):
+    if cache is not None:
+        read_file_obj = cache.open(checksum_algorithm, manifest_file["checksum"])
+        if read_file_obj is not None:
+            return read_file_obj
+
+    return replicas.get_fileobj(manifest_file)
+
+
+def _add_file_to_archive(tf, tarinfo, open_file, manifest_file, listener):
+    if listener is None:
+        listener = DownloadListener()
+
+    listener.file_started(manifest_file)
+
+    try:
+        read_file_obj = open_file()
+        with closing(read_file_obj):
+            tf.addfile(
+                tarinfo,
+                fileobj=_TimedReader(read_file_obj, manifest_file, listener),
+            )
+    except Exception as err:
+        listener.file_failed(manifest_file, err)
+        raise
+
+    listener.file_finished(manifest_file, tarinfo.size)
 
 
 class AbstractProvider(object):
@@ -88,39 +1115,520 @@ class AbstractProvider(object):
         """
         pass
 
-    def download(self, out_dir, location, manifest_file):
-        out_path = os.path.join(out_dir, manifest_file["name"])
+    def set_max_workers(self, max_workers):
+        """
+        Called before a download with the number of files we'll download at
+        once, so subclasses can size their connection pools to match.
+        """
+        pass
 
-        mkdir_p(os.path.dirname(out_path))
+    def close(self):
+        """
+        Called when a download is done, so subclasses can release any
+        threads or connections they're holding.
+        """
+        pass
+
+    def get_fileobj_from(self, location, manifest_file, offset):
+        """
+        Return a binary file that starts ``offset`` bytes into the file.
+
+        Subclasses should override this if their storage supports range
+        requests; by default we read and discard the bytes before ``offset``.
+        """
+        read_file_obj = self.get_fileobj(location=location, manifest_file=manifest_file)
+        _copy_chunks(read_file_obj, _NullWriter(), length=offset)
+        return read_file_obj
+
+    def get_range(self, location, manifest_file, start, end):
+        """
+        Return the bytes from ``start`` to ``end`` (inclusive) of a file.
+
+        Subclasses should override this if their storage can serve a range
+        without sending the rest of the file.
+        """
+        read_file_obj = self.get_fileobj_from(
+            location=location, manifest_file=manifest_file, offset=start
+        )
+        with closing(read_file_obj):
+            buf = io.BytesIO()
+            _copy_chunks(read_file_obj, buf, length=end - start + 1)
+            return buf.getvalue()
+
+    def download(
+        self, out_dir, location, manifest_file, hasher=None, offset=0, listener=None
+    ):
+        """
+        Download a file to ``out_dir``, and return the size of the file.
+
+        If ``hasher`` is set, it's updated with the contents of the file.
+        If ``offset`` is set, the first ``offset`` bytes already on disk
+        are kept, and we only fetch the rest of the file.
+        If ``listener`` is set, it's told about every chunk we copy.
+        """
+
+        def open_from(offset):
+            if offset:
+                return self.get_fileobj_from(
+                    location=location, manifest_file=manifest_file, offset=offset
+                )
+            else:
+                return self.get_fileobj(location=location, manifest_file=manifest_file)
+
+        return _download_to_path(
+            open_from,
+            out_path=os.path.join(out_dir, manifest_file["name"]),
+            hasher=hasher,
+            offset=offset,
+            on_chunk=_chunk_callback(listener, manifest_file),
+        )
 
+
+def _download_to_path(open_from, out_path, hasher=None, offset=0, on_chunk=None):
+    """
+    Write a file to ``out_path``, and return its size.
+
+    ``open_from(offset)`` should return a binary file that starts ``offset``
+    bytes into the file; if ``offset`` is set, we keep the first ``offset``
+    bytes already on disk, and only fetch the rest of the file.
+    """
+    mkdir_p(os.path.dirname(out_path))
+
+    if not offset:
+        # Replace any existing file rather than truncating it, in case
+        # it's hard linked to another file, e.g. in a ``ContentCache``.
+        remove_if_exists(out_path)
         with open(out_path, "wb") as write_file_obj:
-            read_file_obj = self.get_fileobj(
-                location=location, manifest_file=manifest_file
+            read_file_obj = open_from(0)
+            with closing(read_file_obj):
+                return _copy_chunks(
+                    read_file_obj, write_file_obj, hasher=hasher, on_chunk=on_chunk
+                )
+
+    with open(out_path, "r+b") as write_file_obj:
+        if hasher is not None:
+            _copy_chunks(write_file_obj, _NullWriter(), hasher=hasher, length=offset)
+
+        write_file_obj.seek(offset)
+        write_file_obj.truncate()
+
+        read_file_obj = open_from(offset)
+        with closing(read_file_obj):
+            return offset + _copy_chunks(
+                read_file_obj, write_file_obj, hasher=hasher, on_chunk=on_chunk
             )
 
-            # This process is deliberately chunked to avoid loading the
-            # whole contents of a file into memory at once, when we can
-            # stream lazily and keep the memory footprint down.
-            while True:
-                next_chunk = read_file_obj.read(8096)
-                if not next_chunk:
-                    break
-                write_file_obj.write(next_chunk)
+
+def _chunk_callback(listener, manifest_file):
+    """
+    Returns an ``on_chunk`` function for ``_copy_chunks`` that reports to
+    a ``DownloadListener``, or None if there's no listener.
+    """
+    if listener is None:
+        return None
+
+    def on_chunk(size, read_seconds, write_seconds):
+        listener.bytes_transferred(
+            manifest_file,
+            size=size,
+            read_seconds=read_seconds,
+            write_seconds=write_seconds,
+        )
+
+    return on_chunk
+
+
+def _copy_chunks(
+    read_file_obj, write_file_obj, hasher=None, length=None, on_chunk=None
+):
+    # This process is deliberately chunked to avoid loading the
+    # whole contents of a file into memory at once, when we can
+    # stream lazily and keep the memory footprint down.
+    bytes_written = 0
+    while length is None or bytes_written < length:
+        read_start = time.time()
+        if length is None:
+            next_chunk = read_file_obj.read(CHUNK_SIZE)
+        else:
+            next_chunk = read_file_obj.read(min(CHUNK_SIZE, length - bytes_written))
+        if not next_chunk:
+            break
+
+        write_start = time.time()
+        if hasher is not None:
+            hasher.update(next_chunk)
+        write_file_obj.write(next_chunk)
+        bytes_written += len(next_chunk)
+
+        if on_chunk is not None:
+            on_chunk(
+                len(next_chunk),
+                read_seconds=write_start - read_start,
+                write_seconds=time.time() - write_start,
+            )
+
+    return bytes_written
+
+
+class _NullWriter(object):
+    def write(self, data):
+        pass
+
+
+class _TeeWriter(object):
+    """
+    Writes everything to several files at once.
+    """
+
+    def __init__(self, *file_objs):
+        self.file_objs = file_objs
+
+    def write(self, data):
+        for file_obj in self.file_objs:
+            file_obj.write(data)
 
 
 class S3InfrequentAccessProvider(AbstractProvider):
-    def __init__(self):
+    """
+    Downloads files from S3.
+
+    Objects bigger than ``multipart_threshold`` bytes are split into parts
+    of ``part_size`` bytes, which are fetched with concurrent Range GETs and
+    written straight into place in the output file.  This gets us more than
+    one TCP stream's worth of throughput on large files.
+
+    :param multipart_threshold: Objects at least this big are fetched in parts.
+    :param part_size: Size of each part, in bytes.
+    :param max_concurrency: How many parts of a single object to fetch at once.
+    :param max_pool_connections: The size of the S3 client's connection pool.
+        If not set, it's big enough for every download thread to fetch
+        ``max_concurrency`` parts at once.
+    """
+
+    def __init__(
+        self,
+        multipart_threshold=64 * 1024 * 1024,
+        part_size=16 * 1024 * 1024,
+        max_concurrency=8,
+        max_pool_connections=None,
+    ):
         import boto3
 
-        self.s3_client = boto3.client("s3")
+        self._boto3 = boto3
+        self._s3_client = None
+        self._lock = threading.Lock()
+
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.max_pool_connections = max_pool_connections
+        self.max_workers = 1
+        self._part_executor = None
         super(S3InfrequentAccessProvider, self).__init__()
 
-    def get_fileobj(self, location, manifest_file):
+    def set_max_workers(self, max_workers):
+        self.max_workers = max_workers
+
+    def _pool_size(self):
+        if self.max_pool_connections is not None:
+            return self.max_pool_connections
+
+        # Each download thread needs a connection, and so does each of the
+        # ``max_concurrency`` threads fetching parts of large files.
+        # botocore's default pool has 10 connections; any fewer and threads
+        # wait for a connection, or reconnect.
+        return max(10, self.max_workers + self.max_concurrency)
+
+    def _get_part_executor(self):
+        # Every large file shares one pool of threads for fetching parts,
+        # however many files we're downloading at once.
+        with self._lock:
+            if self._part_executor is None:
+                self._part_executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency
+                )
+
+            return self._part_executor
+
+    def close(self):
+        with self._lock:
+            if self._part_executor is not None:
+                self._part_executor.shutdown()
+                self._part_executor = None
+
+    def _new_s3_client(self, config):
+        return self._boto3.client("s3", config=config)
+
+    @property
+    def s3_client(self):
+        # We create the client when it's first used, so ``set_max_workers()``
+        # can size its connection pool.
+        with self._lock:
+            if self._s3_client is None:
+                from botocore.config import Config
+
+                self._s3_client = self._new_s3_client(
+                    config=Config(max_pool_connections=self._pool_size())
+                )
+
+            return self._s3_client
+
+    @s3_client.setter
+    def s3_client(self, s3_client):
+        self._s3_client = s3_client
+
+    def _s3_location(self, location, manifest_file):
         assert location["provider"]["id"] == "amazon-s3"
 
         bucket = location["bucket"]
         path_prefix = location["path"]
 
         s3_key = os.path.join(path_prefix, manifest_file["path"])
+        return bucket, s3_key
+
+    def get_fileobj(self, location, manifest_file):
+        bucket, s3_key = self._s3_location(location, manifest_file)
         s3_obj = self.s3_client.get_object(Bucket=bucket, Key=s3_key)
         return s3_obj["Body"]
+
+    def get_fileobj_from(self, location, manifest_file, offset):
+        bucket, s3_key = self._s3_location(location, manifest_file)
+        s3_obj = self.s3_client.get_object(
+            Bucket=bucket, Key=s3_key, Range="bytes=%d-" % offset
+        )
+        return s3_obj["Body"]
+
+    def get_range(self, location, manifest_file, start, end):
+        bucket, s3_key = self._s3_location(location, manifest_file)
+        s3_obj = self.s3_client.get_object(
+            Bucket=bucket, Key=s3_key, Range="bytes=%d-%d" % (start, end)
+        )
+        with closing(s3_obj["Body"]):
+            return s3_obj["Body"].read()
+
+    def download(
+        self, out_dir, location, manifest_file, hasher=None, offset=0, listener=None
+    ):
+        size = manifest_file.get("size")
+
+        # If we're resuming a partial download, the start of the file was
+        # written in order, so we carry on with a single stream.
+        if size is None or size < self.multipart_threshold or offset:
+            return super(S3InfrequentAccessProvider, self).download(
+                out_dir=out_dir,
+                location=location,
+                manifest_file=manifest_file,
+                hasher=hasher,
+                offset=offset,
+                listener=listener,
+            )
+
+        bucket, s3_key = self._s3_location(location, manifest_file)
+        out_path = os.path.join(out_dir, manifest_file["name"])
+
+        mkdir_p(os.path.dirname(out_path))
+
+        # Allocate the whole file up front, so each part can be written
+        # at its own offset as soon as it arrives.
+        remove_if_exists(out_path)
+        with open(out_path, "wb") as write_file_obj:
+            write_file_obj.truncate(size)
+
+        def _download_part(start):
+            end = min(start + self.part_size, size) - 1
+            s3_obj = self.s3_client.get_object(
+                Bucket=bucket, Key=s3_key, Range="bytes=%d-%d" % (start, end)
+            )
+
+            # If we're hashing the file, we keep each part in memory until
+            # all the parts before it have been hashed.
+            part = io.BytesIO() if hasher is not None else None
+
+            with open(out_path, "r+b") as write_file_obj:
+                write_file_obj.seek(start)
+                out = (
+                    write_file_obj if part is None else _TeeWriter(write_file_obj, part)
+                )
+                part_size = _copy_chunks(
+                    s3_obj["Body"],
+                    out,
+                    on_chunk=_chunk_callback(listener, manifest_file),
+                )
+
+            return part_size, part
+
+        return self._download_parts(_download_part, size=size, hasher=hasher)
+
+    def _download_parts(self, download_part, size, hasher):
+        """
+        Fetch every part of a file with ``download_part(start)``, and return
+        the total size of the parts.
+
+        The parts arrive out of order, but we hash them in order as soon as
+        we can.  We only fetch a few parts ahead of the next one to hash, so
+        we don't hold too many parts in memory.
+        """
+        executor = self._get_part_executor()
+        window = self.max_concurrency * 2
+        pending = collections.deque()
+        total = [0]
+
+        def _consume(future):
+            # Consuming the results means we re-raise the error from any
+            # part which failed.
+            part_size, part = future.result()
+            total[0] += part_size
+            if part is not None:
+                hasher.update(part.getvalue())
+
+        try:
+            for start in range(0, size, self.part_size):
+                if len(pending) >= window:
+                    _consume(pending.popleft())
+                pending.append(executor.submit(download_part, start))
+
+            while pending:
+                _consume(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+
+        return total[0]
+
+
+class _ChunkedReader(object):
+    """
+    Wraps an iterator of byte strings as a readable binary file.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+        # Chunks can be several MiB, so rather than cutting the bytes we've
+        # read off the front of the chunk, we remember how far we've got.
+        self._chunk = b""
+        self._position = 0
+
+    def read(self, size=-1):
+        parts = []
+
+        while size != 0:
+            if self._position == len(self._chunk):
+                try:
+                    self._chunk = next(self._chunks)
+                except StopIteration:
+                    break
+                self._position = 0
+                continue
+
+            if size < 0:
+                end = len(self._chunk)
+            else:
+                end = min(len(self._chunk), self._position + size)
+                size -= end - self._position
+
+            parts.append(self._chunk[self._position : end])
+            self._position = end
+
+        return b"".join(parts)
+
+    def close(self):
+        pass
+
+
+class AzureBlobProvider(AbstractProvider):
+    """
+    Downloads files from Azure Blob Storage.
+
+    The storage manifest only tells us the container for a replica, so we
+    look up the storage account in ``account_urls``, which maps container
+    names to account URLs.  It defaults to the accounts used by the
+    Wellcome storage service.
+
+    This needs the Azure SDK; install it with the ``azure`` extra.
+
+    :param credential: A credential for the Azure SDK.  If not set, we use
+        ``DefaultAzureCredential``, which looks for credentials in the
+        environment, e.g. from ``az login``.
+    :param account_urls: A dict from container name to account URL.
+    """
+
+    default_account_urls = {
+        "wellcomecollection-storage-replica-netherlands": "https://wecostorageprod.blob.core.windows.net",
+        "wellcomecollection-storage-staging-replica-netherlands": "https://wecostoragestage.blob.core.windows.net",
+    }
+
+    def __init__(self, credential=None, account_urls=None):
+        self.credential = credential
+        self.account_urls = account_urls or self.default_account_urls
+        self._service_clients = {}
+        self._lock = threading.Lock()
+        super(AzureBlobProvider, self).__init__()
+
+    def _service_client(self, container):
+        from azure.storage.blob import BlobServiceClient
+
+        with self._lock:
+            if self.credential is None:
+                from azure.identity import DefaultAzureCredential
+
+                self.credential = DefaultAzureCredential()
+
+            account_url = self.account_urls[container]
+            if account_url not in self._service_clients:
+                self._service_clients[account_url] = BlobServiceClient(
+                    account_url=account_url, credential=self.credential
+                )
+
+            return self._service_clients[account_url]
+
+    def _blob_client(self, location, manifest_file):
+        assert location["provider"]["id"] == "azure-blob-storage"
+
+        container = location["bucket"]
+        blob_name = os.path.join(location["path"], manifest_file["path"])
+
+        return self._service_client(container).get_blob_client(
+            container=container, blob=blob_name
+        )
+
+    def get_fileobj(self, location, manifest_file):
+        blob_client = self._blob_client(location, manifest_file)
+        return _ChunkedReader(blob_client.download_blob().chunks())
+
+    def get_fileobj_from(self, location, manifest_file, offset):
+        blob_client = self._blob_client(location, manifest_file)
+        return _ChunkedReader(blob_client.download_blob(offset=offset).chunks())
+
+    def get_range(self, location, manifest_file, start, end):
+        blob_client = self._blob_client(location, manifest_file)
+        return blob_client.download_blob(offset=start, length=end - start + 1).readall()
+
+
+class LocalFilesystemProvider(AbstractProvider):
+    """
+    Reads files from a copy of a bag in a local directory, laid out in the
+    same way as the bucket: ``{bucket}/{path}/{file path}``.
+
+    The storage service never uses this, but it's useful for tests, and for
+    reading from a copy of the storage on a mounted disk.  Locations use the
+    provider ID ``local-filesystem``, and the ``bucket`` is a directory.
+    """
+
+    def _local_path(self, location, manifest_file):
+        assert location["provider"]["id"] == "local-filesystem"
+
+        return os.path.join(location["bucket"], location["path"], manifest_file["path"])
+
+    def get_fileobj(self, location, manifest_file):
+        return open(self._local_path(location, manifest_file), "rb")
+
+    def get_fileobj_from(self, location, manifest_file, offset):
+        read_file_obj = self.get_fileobj(location=location, manifest_file=manifest_file)
+        read_file_obj.seek(offset)
+        return read_file_obj
+
+
+register_provider("amazon-s3", S3InfrequentAccessProvider)
+register_provider("azure-blob-storage", AzureBlobProvider)
+register_provider("local-filesystem", LocalFilesystemProvider)
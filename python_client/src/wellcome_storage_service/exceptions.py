@@ -29,3 +29,54 @@ class UserError(StorageServiceException):
     """Raised if we get a 4xx User Error from the storage service."""
 
     pass
+
+
+class FilesNotInBag(StorageServiceException):
+    """
+    Raised if you ask to download files by name that aren't in the bag.
+
+    The ``names`` attribute is a list of the missing names.
+    """
+
+    def __init__(self, names):
+        self.names = names
+        super(FilesNotInBag, self).__init__("Files not in bag: %s" % ", ".join(names))
+
+
+class BagDownloadError(StorageServiceException):
+    """
+    Raised if we couldn't download some of the files in a bag.
+
+    The ``failures`` attribute is a list of ``(manifest_file, exception)``
+    pairs, one for each file that couldn't be downloaded.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super(BagDownloadError, self).__init__(
+            "Failed to download %d file(s) from bag: %s"
+            % (len(failures), ", ".join(f["name"] for f, _ in failures))
+        )
+
+
+class FixityError(StorageServiceException):
+    """
+    Raised if a downloaded file doesn't match the checksum or size in the
+    storage manifest.
+
+    The ``verification`` attribute is the ``FileVerification`` for the file.
+    """
+
+    def __init__(self, verification):
+        self.verification = verification
+        super(FixityError, self).__init__(
+            "Fixity check failed for %s: expected %s %s (%s bytes), got %s (%s bytes)"
+            % (
+                verification.manifest_file["name"],
+                verification.checksum_algorithm,
+                verification.expected_checksum,
+                verification.expected_size,
+                verification.actual_checksum,
+                verification.actual_size,
+            )
+        )
@@ -0,0 +1,262 @@
+# -*- encoding: utf-8
+"""
+Check a bag on disk against its own BagIt manifests.
+
+This reads the ``manifest-*.txt`` and ``tagmanifest-*.txt`` files in the
+bag, and checks that every file they list is present with the right
+checksums.  It works on a bag you're about to upload, or one you've just
+fetched with ``download_bag()``.
+
+Each file is read once, however many manifests it appears in: we feed
+every chunk to a hasher for each algorithm.  Files are spread across a
+pool of processes, so hashing a large bag can use every core.
+"""
+
+import collections
+import hashlib
+import os
+import posixpath
+import re
+
+from concurrent.futures import as_completed, ProcessPoolExecutor
+
+from .downloader import _hashlib_name, FileVerification
+
+# How much of a file to read at once.  Big reads mean fewer system calls
+# and less time in the interpreter for each byte we hash.
+READ_SIZE = 1024 * 1024
+
+# Small files are sent to the worker processes in batches, so we don't pay
+# for a round trip to the pool for every file.  Each batch holds up to this
+# many files or bytes, whichever comes first.
+BATCH_FILES = 256
+BATCH_BYTES = 64 * 1024 * 1024
+
+MANIFEST_RE = re.compile(r"^(tag)?manifest-([A-Za-z0-9]+)\.txt$")
+
+
+class BagVerificationResult(
+    collections.namedtuple(
+        "BagVerificationResult", ["verified", "mismatched", "missing", "extra"]
+    )
+):
+    """
+    The result of ``verify_bag_directory()``.
+
+    ``verified`` is a list of the names of files that matched every checksum
+    we have for them.  ``mismatched`` is a list of ``FileVerification``
+    results, one for each checksum that didn't match.  ``missing`` is a list
+    of files named in a manifest that aren't on disk, and ``extra`` a list of
+    payload files (under ``data/``) that aren't in any payload manifest.
+    """
+
+    __slots__ = ()
+
+    @property
+    def is_valid(self):
+        return not (self.mismatched or self.missing or self.extra)
+
+
+def _decode_path(path):
+    # BagIt 1.0 percent-encodes these characters in manifest paths, so
+    # they don't break the line-based format.
+    return path.replace("%0A", "\n").replace("%0D", "\r").replace("%25", "%")
+
+
+def _parse_manifest(manifest_path):
+    """
+    Yields ``(name, checksum)`` for every line of a BagIt manifest.
+    """
+    with open(manifest_path, "rb") as manifest_file:
+        for line_number, line in enumerate(manifest_file, start=1):
+            line = line.decode("utf8").rstrip("\r\n")
+            if not line.strip():
+                continue
+
+            try:
+                checksum, path = line.split(None, 1)
+            except ValueError:
+                raise ValueError(
+                    "Malformed line in %s, line %d: %r"
+                    % (manifest_path, line_number, line)
+                )
+
+            name = posixpath.normpath(_decode_path(path.strip()))
+
+            if name.split("/")[0] == ".." or posixpath.isabs(name):
+                raise ValueError(
+                    "Path outside the bag in %s, line %d: %r"
+                    % (manifest_path, line_number, path)
+                )
+
+            yield name, checksum.lower()
+
+
+def _read_manifests(bag_dir):
+    """
+    Returns ``(expected, payload_names)``, where ``expected`` is a dict
+    ``{name: {checksum_algorithm: checksum}}`` covering every manifest in
+    the bag, and ``payload_names`` is the set of files in payload manifests.
+    """
+    expected = collections.defaultdict(dict)
+    payload_names = set()
+
+    for filename in sorted(os.listdir(bag_dir)):
+        match = MANIFEST_RE.match(filename)
+        if match is None:
+            continue
+
+        is_tag_manifest = match.group(1) is not None
+        checksum_algorithm = _hashlib_name(match.group(2))
+
+        for name, checksum in _parse_manifest(os.path.join(bag_dir, filename)):
+            expected[name][checksum_algorithm] = checksum
+            if not is_tag_manifest:
+                payload_names.add(name)
+
+    return dict(expected), payload_names
+
+
+def _local_files(bag_dir):
+    """
+    Returns a dict ``{name: size}`` of every file in the bag directory.
+    """
+    local_files = {}
+
+    for dirpath, _, filenames in os.walk(bag_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, bag_dir).replace(os.sep, "/")
+            local_files[name] = os.path.getsize(path)
+
+    return local_files
+
+
+def _hash_file(path, checksum_algorithms):
+    """
+    Read a file once, and return its checksum for every algorithm in
+    ``checksum_algorithms`` as a dict ``{checksum_algorithm: checksum}``.
+    """
+    hashers = [hashlib.new(alg) for alg in checksum_algorithms]
+
+    # We open the file unbuffered: our reads are already big, and this
+    # saves copying every byte through Python's buffer.
+    with open(path, "rb", 0) as infile:
+        while True:
+            chunk = infile.read(READ_SIZE)
+            if not chunk:
+                break
+            for hasher in hashers:
+                hasher.update(chunk)
+
+    return {
+        alg: hasher.hexdigest() for alg, hasher in zip(checksum_algorithms, hashers)
+    }
+
+
+def _hash_batch(batch):
+    """
+    Hash a batch of ``(name, path, checksum_algorithms)``, and return a list
+    of ``(name, checksums)``.  This runs in the worker processes.
+    """
+    return [
+        (name, _hash_file(path, checksum_algorithms))
+        for name, path, checksum_algorithms in batch
+    ]
+
+
+def _make_batches(jobs):
+    """
+    Group ``(size, job)`` pairs into batches.  The biggest files go first,
+    so a large file doesn't start just as every other worker is finishing.
+    """
+    batch = []
+    batch_bytes = 0
+
+    for size, job in sorted(jobs, key=lambda j: j[0], reverse=True):
+        batch.append(job)
+        batch_bytes += size
+
+        if len(batch) >= BATCH_FILES or batch_bytes >= BATCH_BYTES:
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+    if batch:
+        yield batch
+
+
+def _hash_all(jobs, max_workers):
+    """
+    Yields ``(name, checksums)`` for every job, in the order they finish.
+    """
+    batches = _make_batches(jobs)
+
+    if max_workers == 1:
+        for batch in batches:
+            for result in _hash_batch(batch):
+                yield result
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_hash_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            for result in future.result():
+                yield result
+
+
+def verify_bag_directory(bag_dir, max_workers=None):
+    """
+    Check the files in a bag directory against the bag's manifests, and
+    return a ``BagVerificationResult``.
+
+    :param bag_dir: The directory containing the bag, i.e. the directory with
+        ``bagit.txt`` and the manifests in it.
+    :param max_workers: The number of processes to hash files with.  The
+        default is one for every CPU; if 1, we hash everything in this process.
+
+    """
+    expected, payload_names = _read_manifests(bag_dir)
+    local_files = _local_files(bag_dir)
+
+    missing = sorted(name for name in expected if name not in local_files)
+    extra = sorted(
+        name
+        for name in local_files
+        if name.startswith("data/") and name not in payload_names
+    )
+
+    jobs = [
+        (
+            local_files[name],
+            (name, os.path.join(bag_dir, name), sorted(checksums)),
+        )
+        for name, checksums in expected.items()
+        if name in local_files
+    ]
+
+    verified = []
+    mismatched = []
+
+    for name, actual_checksums in _hash_all(jobs, max_workers=max_workers):
+        results = [
+            FileVerification(
+                manifest_file={"name": name, "checksum": expected_checksum},
+                checksum_algorithm=checksum_algorithm,
+                actual_checksum=actual_checksums[checksum_algorithm],
+                actual_size=local_files[name],
+            )
+            for checksum_algorithm, expected_checksum in sorted(expected[name].items())
+        ]
+
+        if all(r.is_valid for r in results):
+            verified.append(name)
+        else:
+            mismatched.extend(r for r in results if not r.is_valid)
+
+    return BagVerificationResult(
+        verified=sorted(verified),
+        mismatched=sorted(mismatched, key=lambda r: r.manifest_file["name"]),
+        missing=missing,
+        extra=extra,
+    )
@@ -0,0 +1,223 @@
+# -*- encoding: utf-8
+"""
+Hedged requests, to cut the tail latency of downloading lots of small files.
+
+Most GETs from S3 start returning data quickly, but a few take much longer,
+and when a bag has thousands of small files, those few dominate the time
+it takes to download.  With a ``HedgingPolicy``, if a request hasn't got
+a response by the time most requests would have done, we send a second
+request for the same file -- to another replica, if we can -- and use
+whichever responds first.
+"""
+
+import collections
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing
+
+from .progress import _percentiles
+
+
+def _close_result(future):
+    if not future.cancelled() and future.exception() is None:
+        with closing(future.result()):
+            pass
+
+
+class HedgingPolicy(object):
+    """
+    Decides when to send a second, "hedged" request for a file, and keeps
+    count of how often we do.
+
+    We time how long it takes each request to open a file (for S3, until we
+    get the response headers).  If a request takes longer than the
+    ``percentile`` of the recent timings, we hedge it.  Pass the same policy
+    to several downloads to keep what it's learnt about the timings.
+
+    ``requests``, ``hedged`` and ``hedge_wins`` count the files we've opened,
+    how many of them we hedged, and how many times the hedged request won;
+    ``summary()`` returns them as a dict, to help you tune ``percentile``.
+
+    Requests run on a pool of threads, two for each download thread.
+    ``download_bag()`` sizes the pool, and calls ``close()`` to stop the
+    threads when it's done; the policy keeps its timings, and starts new
+    threads if you use it again.  If you call ``open()`` yourself, call
+    ``set_max_workers()`` first, and use the policy as a context manager
+    or call ``close()`` when you're done.
+
+    :param percentile: Hedge requests that take longer than this percentile
+        of the recent timings.  A lower percentile hedges more requests.
+    :param min_samples: Don't hedge until we've timed this many requests.
+    :param min_delay: Never hedge a request sooner than this many seconds.
+    :param max_size: Only hedge files up to this many bytes.  For bigger
+        files, the time to first byte is a small part of the download.
+    :param window: How many of the most recent timings to use.
+
+    """
+
+    def __init__(
+        self,
+        percentile=95,
+        min_samples=20,
+        min_delay=0.01,
+        max_size=16 * 1024 * 1024,
+        window=1000,
+    ):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_size = max_size
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+        self.max_workers = 1
+
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def set_max_workers(self, max_workers):
+        """
+        Tell the policy how many threads will call ``open()`` at once.
+        """
+        with self._lock:
+            self.max_workers = max_workers
+
+    def close(self):
+        """
+        Stop the threads that make requests.  Requests that are still
+        running (e.g. ones that lost the race) are left to finish.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def applies_to(self, manifest_file):
+        size = manifest_file.get("size")
+        return size is None or size <= self.max_size
+
+    def delay(self):
+        """
+        Returns how long to wait before hedging a request, in seconds, or None
+        if we don't have enough timings to know yet.
+        """
+        with self._lock:
+            latencies = list(self._latencies)
+
+        if not latencies or len(latencies) < self.min_samples:
+            return None
+
+        key = "p%d" % self.percentile
+        return max(
+            self.min_delay, _percentiles(latencies, percentiles=[self.percentile])[key]
+        )
+
+    def _submit(self, open_file):
+        """
+        Start a request on the pool, and return its future and an event
+        that's set when the request actually starts.
+        """
+        started = threading.Event()
+
+        with self._lock:
+            if self._executor is None:
+                # Each download thread can have two requests in flight.
+                self._executor = ThreadPoolExecutor(max_workers=2 * self.max_workers)
+
+            # We submit while holding the lock, so ``close()`` can't shut
+            # down the pool in between.
+            future = self._executor.submit(self._timed, open_file, started)
+
+        return future, started
+
+    def _timed(self, open_file, started):
+        started.set()
+        start = time.time()
+        read_file_obj = open_file()
+
+        # We time every request that succeeds, including the ones that lose
+        # the race, so slow requests still count towards the percentile.
+        with self._lock:
+            self._latencies.append(time.time() - start)
+
+        return read_file_obj
+
+    def open(self, open_primary, open_hedge, on_hedge=None):
+        """
+        Call ``open_primary()`` to open a file; if it's slow, call
+        ``open_hedge()`` too.  Returns the file object from whichever returns
+        first, and True if that was ``open_hedge()``; we close the other file
+        object when it arrives.
+
+        If we hedge, we call ``on_hedge()`` first.  If both requests fail,
+        we raise the error from ``open_primary()``.
+        """
+        with self._lock:
+            self.requests += 1
+
+        delay = self.delay()
+        primary, started = self._submit(open_primary)
+
+        # If the request is queued for a thread, that isn't the storage
+        # provider being slow, so we only start the clock when it starts.
+        if delay is not None:
+            started.wait()
+
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result(), False
+
+        with self._lock:
+            self.hedged += 1
+        if on_hedge is not None:
+            on_hedge()
+
+        hedge, _ = self._submit(open_hedge)
+        pending = [primary, hedge]
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in [f for f in pending if f in done]:
+                pending.remove(future)
+                if future.exception() is not None:
+                    continue
+
+                for loser in pending:
+                    if not loser.cancel():
+                        loser.add_done_callback(_close_result)
+
+                if future is hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+
+                return future.result(), future is hedge
+
+        raise primary.exception()
+
+    def summary(self):
+        """
+        Returns the counts of requests and hedges as a dict, which can be
+        serialised as JSON.
+        """
+        with self._lock:
+            requests, hedged, hedge_wins = self.requests, self.hedged, self.hedge_wins
+
+        return {
+            "requests": requests,
+            "hedged": hedged,
+            "hedge_wins": hedge_wins,
+            "hedge_rate": float(hedged) / requests if requests else None,
+            "delay": self.delay(),
+        }
@@ -0,0 +1,168 @@
+# -*- encoding: utf-8
+"""
+Helpers for watching ingests until they finish.
+
+An ingest for a large bag can spend hours verifying or replicating, so
+rather than polling every ingest at a fixed rate, we poll each one at a
+rate based on how recently something happened to it.  An ingest that just
+logged an event gets polled again soon; one that hasn't changed for an hour
+gets polled every ``max_interval`` seconds.
+"""
+
+import calendar
+import datetime
+import heapq
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .exceptions import ServerError
+
+TERMINAL_STATUSES = {"succeeded", "failed"}
+
+
+def _parse_date(date_string):
+    """
+    Returns a date from the ingests API as a Unix timestamp,
+    e.g. 2019-07-09T12:39:09.835662Z.
+    """
+    parsed = datetime.datetime.strptime(date_string[:19], "%Y-%m-%dT%H:%M:%S")
+    timestamp = calendar.timegm(parsed.timetuple())
+
+    fraction = date_string[19:].rstrip("Z")
+    if fraction.startswith("."):
+        timestamp += float(fraction)
+
+    return timestamp
+
+
+def _ingest_url(api_url, ingest):
+    """
+    Returns the URL for an ingest, given either its ID or its location.
+    """
+    if "://" in ingest:
+        return ingest
+    else:
+        return "%s/ingests/%s" % (api_url, ingest)
+
+
+def is_finished(ingest):
+    """
+    Returns True if an ingest has succeeded or failed.
+    """
+    return ingest["status"]["id"] in TERMINAL_STATUSES
+
+
+def ingest_stage_timings(ingest):
+    """
+    Returns a list of ``(description, seconds)`` for every event in an ingest,
+    where ``seconds`` is how long it took to get there from the previous
+    event (or from when the ingest was created, for the first event).
+
+    e.g. ``[("Unpacking started", 1.2), ("Unpacking succeeded", 35.8), ...]``
+    """
+    events = sorted(
+        ingest.get("events", []), key=lambda event: _parse_date(event["createdDate"])
+    )
+
+    timings = []
+    previous = _parse_date(ingest["createdDate"])
+
+    for event in events:
+        created = _parse_date(event["createdDate"])
+        timings.append((event["description"], created - previous))
+        previous = created
+
+    return timings
+
+
+def _last_activity(ingest):
+    dates = [ingest["createdDate"]] + [
+        e["createdDate"] for e in ingest.get("events", [])
+    ]
+    return max(_parse_date(d) for d in dates)
+
+
+def _next_poll_delay(ingest, now, min_interval, max_interval):
+    """
+    Returns how long to wait before polling an unfinished ingest again.
+
+    We wait a quarter of the time since its last event, so busy ingests are
+    checked often and quiet ones are left alone.
+    """
+    if ingest is None:
+        return max_interval
+
+    delay = (now - _last_activity(ingest)) / 4
+    return max(min_interval, min(delay, max_interval))
+
+
+class _PollSchedule(object):
+    """
+    A queue of ingest URLs, ordered by the time they're next due to be polled.
+    """
+
+    def __init__(self, ingest_urls):
+        self._heap = [(0, url) for url in ingest_urls]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, ingest_url, when):
+        heapq.heappush(self._heap, (when, ingest_url))
+
+    def pop_due(self, now, limit):
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            due.append(heapq.heappop(self._heap)[1])
+        return due
+
+    def time_until_next(self, now):
+        if self._heap:
+            return max(0, self._heap[0][0] - now)
+
+
+def _get_ingest_or_none(future):
+    # A 5xx from the API is likely to be temporary, so we try that ingest
+    # again later rather than giving up on every ingest we're watching.
+    try:
+        return future.result()
+    except ServerError:
+        return None
+
+
+def _wait_for_ingests(client, ingests, max_workers, min_interval, max_interval):
+    schedule = _PollSchedule(_ingest_url(client.api_url, i) for i in ingests)
+    in_flight = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while schedule or in_flight:
+            for ingest_url in schedule.pop_due(
+                time.time(), limit=max_workers - len(in_flight)
+            ):
+                future = executor.submit(client.get_ingest_from_location, ingest_url)
+                in_flight[future] = ingest_url
+
+            if not in_flight:
+                time.sleep(schedule.time_until_next(time.time()))
+                continue
+
+            # If there's room for another request, wake up when the next
+            # ingest is due; otherwise wait for a request to finish.
+            if len(in_flight) < max_workers:
+                timeout = schedule.time_until_next(time.time())
+            else:
+                timeout = None
+
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                ingest_url = in_flight.pop(future)
+                ingest = _get_ingest_or_none(future)
+
+                if ingest is not None and is_finished(ingest):
+                    yield ingest
+                else:
+                    now = time.time()
+                    delay = _next_poll_delay(ingest, now, min_interval, max_interval)
+                    schedule.push(ingest_url, when=now + delay)
@@ -0,0 +1,135 @@
+# -*- encoding: utf-8
+"""
+A cache for storage manifests.
+
+Once a version of a bag is stored, its storage manifest never changes, so
+we can keep a copy of every versioned manifest we fetch and skip the API
+next time.  Lookups for "the latest version" of a bag always go to the API.
+"""
+
+import collections
+import gzip
+import os
+import threading
+
+try:
+    from urllib.parse import quote
+except ImportError:  # Python 2
+    from urllib import quote
+
+from ._utils import mkdir_p
+
+
+class ManifestCache(object):
+    """
+    Caches the JSON of versioned storage manifests, in memory and optionally
+    on disk.
+
+    A cache hit saves the request to the API, but the client still parses
+    the JSON every time, so every caller gets its own copy of the manifest
+    that it can modify safely.
+
+    :param max_memory_bytes: The in-memory cache holds manifests up to this
+        total size (of their UTF-8 encoded JSON), and discards the least
+        recently used manifests when it's full.  Set to 0 to disable the
+        in-memory cache.
+    :param cache_dir: If set, manifests are also stored in this directory as
+        gzip-compressed files, so they can be reused by other processes.
+
+    """
+
+    def __init__(self, max_memory_bytes=256 * 1024 * 1024, cache_dir=None):
+        self.max_memory_bytes = max_memory_bytes
+        self.cache_dir = cache_dir
+
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def _disk_path(self, key):
+        # External identifiers can contain slashes, so we quote every part
+        # of the key to get a single path component.
+        space, external_identifier, version = [quote(part, safe="") for part in key]
+        return os.path.join(
+            self.cache_dir, space, external_identifier, version + ".json.gz"
+        )
+
+    # Both tiers store the manifest as UTF-8 encoded bytes, so the memory
+    # limit counts bytes rather than characters.
+
+    def _get_from_memory(self, key):
+        with self._lock:
+            try:
+                data = self._memory.pop(key)
+            except KeyError:
+                return None
+
+            # Re-insert the manifest to mark it as most recently used
+            self._memory[key] = data
+            return data
+
+    def _put_in_memory(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _get_from_disk(self, key):
+        try:
+            with gzip.open(self._disk_path(key), "rb") as cache_file:
+                return cache_file.read()
+        except IOError:
+            return None
+
+    def _put_on_disk(self, key, data):
+        out_path = self._disk_path(key)
+        mkdir_p(os.path.dirname(out_path))
+
+        # Write to a temporary file and rename it into place, so another
+        # process never sees a half-written manifest.
+        tmp_path = "%s.%d.%d.tmp" % (
+            out_path,
+            os.getpid(),
+            threading.current_thread().ident,
+        )
+        with gzip.open(tmp_path, "wb") as cache_file:
+            cache_file.write(data)
+
+        os.rename(tmp_path, out_path)
+
+    def get(self, space, external_identifier, version):
+        """
+        Returns the JSON of a storage manifest, or None if it isn't cached.
+        """
+        key = (space, external_identifier, version)
+
+        data = self._get_from_memory(key)
+
+        if data is None and self.cache_dir is not None:
+            data = self._get_from_disk(key)
+            if data is not None:
+                self._put_in_memory(key, data)
+
+        if data is not None:
+            return data.decode("utf8")
+
+    def put(self, space, external_identifier, version, body):
+        """
+        Store the JSON of a storage manifest.
+        """
+        key = (space, external_identifier, version)
+        data = body.encode("utf8")
+
+        self._put_in_memory(key, data)
+
+        if self.cache_dir is not None:
+            self._put_on_disk(key, data)
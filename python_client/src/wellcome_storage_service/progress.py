@@ -0,0 +1,209 @@
+# -*- encoding: utf-8
+"""
+Hooks for watching the progress of a download.
+
+Pass a ``DownloadListener`` to ``download_bag()`` or
+``download_compressed_bag()`` to get events as each file is downloaded.
+``DownloadStats`` is a listener that records timings for every file, and
+can summarise them once the download is done.
+"""
+
+import threading
+import time
+
+
+class DownloadListener(object):
+    """
+    Receives events as the files in a bag are downloaded.
+
+    Subclass this and override the methods you're interested in.  If you're
+    downloading files concurrently, the methods are called from several
+    threads at once, so they need to be thread-safe.
+    """
+
+    def file_started(self, manifest_file):
+        """
+        Called when we start downloading a file.
+        """
+        pass
+
+    def bytes_transferred(self, manifest_file, size, read_seconds, write_seconds):
+        """
+        Called every time we copy a chunk of a file.  ``read_seconds`` is how
+        long we spent waiting for the storage provider to give us the chunk,
+        and ``write_seconds`` is how long we spent writing it out.
+        """
+        pass
+
+    def file_retried(self, manifest_file, error):
+        """
+        Called if a file failed to download, and we're trying again
+        (e.g. from a different replica).
+        """
+        pass
+
+    def file_hedged(self, manifest_file):
+        """
+        Called if a request for a file was slow to respond, and we've sent
+        a second request for it (see ``HedgingPolicy``).
+        """
+        pass
+
+    def file_finished(self, manifest_file, size):
+        """
+        Called when a file has been downloaded successfully.
+        """
+        pass
+
+    def file_failed(self, manifest_file, error):
+        """
+        Called when a file couldn't be downloaded.
+        """
+        pass
+
+
+class _FileStats(object):
+    def __init__(self, manifest_file, started):
+        self.manifest_file = manifest_file
+        self.started = started
+        self.first_byte = None
+        self.finished = None
+        self.size = 0
+        self.read_seconds = 0
+        self.write_seconds = 0
+        self.retries = 0
+        self.hedges = 0
+        self.error = None
+
+    @property
+    def seconds(self):
+        return self.finished - self.started
+
+    @property
+    def time_to_first_byte(self):
+        if self.first_byte is not None:
+            return self.first_byte - self.started
+
+
+def _percentiles(values, percentiles=(50, 90, 99)):
+    """
+    Returns a dict of percentiles of a list of numbers, using the
+    nearest-rank method, e.g. ``{"p50": 1.5, "p90": 2.3, "p99": 2.9}``.
+    """
+    values = sorted(values)
+    if not values:
+        return {"p%d" % p: None for p in percentiles}
+
+    return {
+        "p%d" % p: values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+        for p in percentiles
+    }
+
+
+class DownloadStats(DownloadListener):
+    """
+    A listener that records the timings for every file in a download.
+
+    Call ``summary()`` when the download is done for throughput percentiles,
+    the slowest files, and where the time went.  This can help explain a
+    slow download: a long time to first byte points at the storage provider,
+    time spent reading at the network, and time spent writing at the disk.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.started = None
+        self._lock = threading.Lock()
+
+    def file_started(self, manifest_file):
+        now = time.time()
+        with self._lock:
+            if self.started is None:
+                self.started = now
+            self.files[manifest_file["name"]] = _FileStats(manifest_file, started=now)
+
+    def bytes_transferred(self, manifest_file, size, read_seconds, write_seconds):
+        now = time.time()
+        with self._lock:
+            file_stats = self.files[manifest_file["name"]]
+            if file_stats.first_byte is None:
+                file_stats.first_byte = now - write_seconds
+            file_stats.size += size
+            file_stats.read_seconds += read_seconds
+            file_stats.write_seconds += write_seconds
+
+    def file_retried(self, manifest_file, error):
+        with self._lock:
+            file_stats = self.files[manifest_file["name"]]
+            file_stats.retries += 1
+            file_stats.size = 0
+            file_stats.first_byte = None
+
+    def file_hedged(self, manifest_file):
+        with self._lock:
+            self.files[manifest_file["name"]].hedges += 1
+
+    def file_finished(self, manifest_file, size):
+        now = time.time()
+        with self._lock:
+            file_stats = self.files[manifest_file["name"]]
+            file_stats.finished = now
+            file_stats.size = size
+
+    def file_failed(self, manifest_file, error):
+        now = time.time()
+        with self._lock:
+            file_stats = self.files[manifest_file["name"]]
+            file_stats.finished = now
+            file_stats.error = error
+
+    def summary(self, slowest=5):
+        """
+        Returns a summary of the download as a dict, which can be serialised
+        as JSON.  Times are in seconds and throughputs in bytes per second.
+
+        :param slowest: How many of the slowest files to include.
+        """
+        with self._lock:
+            all_files = list(self.files.values())
+
+        finished = [f for f in all_files if f.finished is not None and f.error is None]
+        total_bytes = sum(f.size for f in finished)
+
+        if finished:
+            elapsed = max(f.finished for f in finished) - self.started
+        else:
+            elapsed = 0
+
+        slowest_files = sorted(finished, key=lambda f: f.seconds, reverse=True)
+
+        return {
+            "files": len(finished),
+            "failed": sum(1 for f in all_files if f.error is not None),
+            "retries": sum(f.retries for f in all_files),
+            "hedged": sum(f.hedges for f in all_files),
+            "bytes": total_bytes,
+            "elapsed_seconds": elapsed,
+            "throughput": total_bytes / elapsed if elapsed else None,
+            "file_throughput": _percentiles(
+                [f.size / f.seconds for f in finished if f.seconds > 0]
+            ),
+            "time_to_first_byte": _percentiles(
+                [
+                    f.time_to_first_byte
+                    for f in finished
+                    if f.time_to_first_byte is not None
+                ]
+            ),
+            "read_seconds": sum(f.read_seconds for f in finished),
+            "write_seconds": sum(f.write_seconds for f in finished),
+            "slowest_files": [
+                {
+                    "name": f.manifest_file["name"],
+                    "size": f.size,
+                    "seconds": f.seconds,
+                    "time_to_first_byte": f.time_to_first_byte,
+                }
+                for f in slowest_files[:slowest]
+            ],
+        }
@@ -0,0 +1,299 @@
+# -*- encoding: utf-8
+"""
+A compact, read-only representation of a storage manifest.
+
+The bags API returns every file in a bag as a JSON object, which costs
+roughly a kilobyte of Python dict per file.  For bags with hundreds of
+thousands of files, that adds up to gigabytes.  Here we keep the files in
+columns instead: the names in a list, the sizes in an array, the checksums
+as packed binary digests, and the paths as an interned prefix plus the name.
+"""
+
+import array
+import binascii
+import fnmatch
+import re
+
+from .downloader import _hashlib_name
+
+try:
+    array.array("q")
+    _INT64 = "q"
+except ValueError:  # Python 2
+    _INT64 = "l"
+
+FILE_LISTS = ("manifest", "tagManifest")
+
+
+class _FileColumns(object):
+    """
+    The files from one of the lists in a storage manifest.
+    """
+
+    def __init__(self, checksum_algorithm):
+        self.checksum_algorithm = checksum_algorithm
+        self.digest_size = None
+
+        self.names = []
+        self.sizes = array.array(_INT64)
+        self.digests = bytearray()
+
+        # Most paths are a version prefix followed by the name, e.g.
+        # "v1/" + "data/b12345.xml", so we store an index into a list of
+        # interned prefixes.  The rare path that isn't of that form is
+        # stored in full in ``odd_paths``, and gets prefix index -1.
+        self.path_prefix_ids = array.array("l")
+        self.odd_paths = {}
+
+    def append(self, manifest_file, path_prefixes):
+        name = manifest_file["name"]
+        path = manifest_file["path"]
+        digest = binascii.unhexlify(manifest_file["checksum"])
+
+        if self.digest_size is None:
+            self.digest_size = len(digest)
+        assert len(digest) == self.digest_size, manifest_file
+
+        if path.endswith(name):
+            self.path_prefix_ids.append(path_prefixes.intern(path[: -len(name)]))
+        else:
+            self.path_prefix_ids.append(-1)
+            self.odd_paths[len(self.names)] = path
+
+        self.names.append(name)
+        self.sizes.append(manifest_file["size"])
+        self.digests.extend(digest)
+
+    def get(self, index, path_prefixes):
+        name = self.names[index]
+
+        prefix_id = self.path_prefix_ids[index]
+        if prefix_id == -1:
+            path = self.odd_paths[index]
+        else:
+            path = path_prefixes.values[prefix_id] + name
+
+        start = index * self.digest_size
+        end = start + self.digest_size
+        digest = self.digests[start:end]
+
+        return {
+            "checksum": binascii.hexlify(bytes(digest)).decode("ascii"),
+            "name": name,
+            "path": path,
+            "size": self.sizes[index],
+            "type": "File",
+        }
+
+
+class _InternedStrings(object):
+    def __init__(self):
+        self.values = []
+        self._ids = {}
+
+    def intern(self, value):
+        try:
+            return self._ids[value]
+        except KeyError:
+            self._ids[value] = len(self.values)
+            self.values.append(value)
+            return self._ids[value]
+
+
+class _FileListView(object):
+    """
+    A re-iterable view of one of the file lists, which can stand in for the
+    ``files`` list of a storage manifest dict.
+    """
+
+    def __init__(self, storage_manifest, list_name):
+        self.storage_manifest = storage_manifest
+        self.list_name = list_name
+
+    def __iter__(self):
+        columns = self.storage_manifest._columns[self.list_name]
+        for index in range(len(columns.names)):
+            yield columns.get(index, self.storage_manifest._path_prefixes)
+
+    def __len__(self):
+        return len(self.storage_manifest._columns[self.list_name].names)
+
+
+class StorageManifest(object):
+    """
+    A compact, read-only storage manifest.
+
+    Create it from a manifest returned by ``get_bag()`` or ``stream_bag()``.
+    It gives O(1) lookup of files by name, queries by prefix or glob, and
+    total sizes, and uses a fraction of the memory of the original dicts.
+
+    Files are returned as dicts with the same keys as in the storage manifest.
+    The bag-level fields are available as attributes, e.g. ``location``, or
+    you can get a dict that can be passed to ``download_bag()`` with
+    ``to_dict()``.
+    """
+
+    def __init__(self, storage_manifest):
+        self._bag = {
+            key: value
+            for key, value in storage_manifest.items()
+            if key not in FILE_LISTS
+        }
+
+        self._path_prefixes = _InternedStrings()
+        self._columns = {}
+
+        # Maps each name to its index in the columns.  To avoid storing a
+        # tuple per file, tag files are stored as the bitwise inverse of
+        # their index, which is always negative.
+        self._index = {}
+
+        for list_name in FILE_LISTS:
+            manifest = storage_manifest[list_name]
+            columns = _FileColumns(checksum_algorithm=manifest["checksumAlgorithm"])
+
+            for manifest_file in manifest["files"]:
+                index = len(columns.names)
+                if list_name == "tagManifest":
+                    index = ~index
+                self._index[manifest_file["name"]] = index
+                columns.append(manifest_file, self._path_prefixes)
+
+            self._columns[list_name] = columns
+
+    def _lookup(self, name):
+        index = self._index[name]
+        if index >= 0:
+            return "manifest", index
+        else:
+            return "tagManifest", ~index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, name):
+        list_name, index = self._lookup(name)
+        return self._columns[list_name].get(index, self._path_prefixes)
+
+    def __iter__(self):
+        return iter(self.files())
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    @property
+    def id(self):
+        return self._bag["id"]
+
+    @property
+    def space(self):
+        return self._bag["space"]["id"]
+
+    @property
+    def external_identifier(self):
+        return self._bag["info"]["externalIdentifier"]
+
+    @property
+    def version(self):
+        return self._bag["version"]
+
+    @property
+    def info(self):
+        return self._bag["info"]
+
+    @property
+    def location(self):
+        return self._bag["location"]
+
+    @property
+    def replica_locations(self):
+        return self._bag.get("replicaLocations", [])
+
+    def checksum_algorithm(self, name):
+        """
+        Returns the hashlib name of the checksum algorithm for a file,
+        e.g. ``sha256``.
+        """
+        list_name, _ = self._lookup(name)
+        return _hashlib_name(self._columns[list_name].checksum_algorithm)
+
+    def is_tag_file(self, name):
+        """
+        Returns True if a file is in the tag manifest, e.g. ``bagit.txt``.
+        """
+        list_name, _ = self._lookup(name)
+        return list_name == "tagManifest"
+
+    def files(self, tag_files=True):
+        """
+        Yields every file in the bag, first the payload files, then the tag
+        files (unless ``tag_files`` is False).
+        """
+        list_names = FILE_LISTS if tag_files else ("manifest",)
+        for list_name in list_names:
+            for manifest_file in _FileListView(self, list_name):
+                yield manifest_file
+
+    def _matching_indexes(self, predicate):
+        for list_name in FILE_LISTS:
+            columns = self._columns[list_name]
+            for index, name in enumerate(columns.names):
+                if predicate(name):
+                    yield columns, index
+
+    def _matching(self, predicate):
+        for columns, index in self._matching_indexes(predicate):
+            yield columns.get(index, self._path_prefixes)
+
+    def with_prefix(self, prefix):
+        """
+        Yields every file whose name starts with ``prefix``,
+        e.g. ``data/objects/``.
+        """
+        return self._matching(lambda name: name.startswith(prefix))
+
+    def glob(self, pattern):
+        """
+        Yields every file whose name matches a shell-style glob pattern,
+        e.g. ``data/alto/*.xml``.  As in ``fnmatch``, ``*`` matches any
+        characters including ``/``.
+        """
+        regex = re.compile(fnmatch.translate(pattern))
+        return self._matching(lambda name: regex.match(name) is not None)
+
+    def total_size(self, prefix=None):
+        """
+        Returns the total size of the files in the bag, or of the files whose
+        names start with ``prefix``.
+        """
+        if prefix is None:
+            return sum(sum(columns.sizes) for columns in self._columns.values())
+        else:
+            return sum(
+                columns.sizes[index]
+                for columns, index in self._matching_indexes(
+                    lambda name: name.startswith(prefix)
+                )
+            )
+
+    def to_dict(self):
+        """
+        Returns a storage manifest dict, in the same shape as ``get_bag()``,
+        whose lists of files are read lazily from this manifest.
+        """
+        storage_manifest = dict(self._bag)
+
+        for list_name in FILE_LISTS:
+            storage_manifest[list_name] = {
+                "checksumAlgorithm": self._columns[list_name].checksum_algorithm,
+                "files": _FileListView(self, list_name),
+                "type": "BagManifest",
+            }
+
+        return storage_manifest
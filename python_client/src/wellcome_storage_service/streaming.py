@@ -0,0 +1,169 @@
+# -*- encoding: utf-8
+"""
+Parse a storage manifest incrementally, for bags with so many files that
+holding the whole manifest in memory isn't practical.
+
+This needs ijson; install it with the ``streaming`` extra.
+"""
+
+import json
+import os
+import tempfile
+
+from ._utils import remove_if_exists
+
+# The lists of files in a storage manifest.  In the bags API these come
+# before the location of the bag, so we spool the files to disk while we
+# wait for the bag-level fields.
+FILE_LISTS = ("manifest", "tagManifest")
+
+
+class SpooledFiles(object):
+    """
+    The ``files`` list from a manifest, kept in a temporary file with one
+    JSON object per line.
+
+    Iterating over it reads the entries back from disk one at a time, so you
+    can iterate as often as you like without holding every entry in memory.
+
+    The temporary file is deleted when you call ``close()``, or when this
+    object is garbage collected -- so it's safe to keep using the list after
+    you've dropped the manifest it came from.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._count = 0
+
+    def close(self):
+        remove_if_exists(self.path)
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        with open(self.path) as spool_file:
+            for line in spool_file:
+                yield json.loads(line)
+
+    def __len__(self):
+        return self._count
+
+    def _append(self, spool_file, manifest_file):
+        spool_file.write(json.dumps(manifest_file) + "\n")
+        self._count += 1
+
+
+class StreamingStorageManifest(dict):
+    """
+    A storage manifest whose lists of files are kept on disk.
+
+    This behaves like the dict returned by ``get_bag()``, and you can pass it
+    to ``download_bag()`` or ``download_compressed_bag()``.  The difference is
+    that ``["manifest"]["files"]`` and ``["tagManifest"]["files"]`` are
+    ``SpooledFiles``, which you can iterate over but not index.
+
+    Call ``close()`` or use it as a context manager to delete the temporary
+    files when you're done.  Otherwise each list of files deletes its own
+    temporary file when it's garbage collected.
+    """
+
+    def close(self):
+        for name in FILE_LISTS:
+            files = self.get(name, {}).get("files")
+            if isinstance(files, SpooledFiles):
+                files.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _spooled_file_list(prefix):
+    """
+    If ``prefix`` is inside an entry in one of the file lists, returns the
+    name of that list and whether ``prefix`` is the entry itself.
+    """
+    parts = prefix.split(".")
+    if len(parts) >= 3 and parts[0] in FILE_LISTS and parts[1:3] == ["files", "item"]:
+        return parts[0], len(parts) == 3
+    else:
+        return None, False
+
+
+class _Spooler(object):
+    """
+    Writes file entries to a ``SpooledFiles`` for each list of files.
+    """
+
+    def __init__(self):
+        self.spools = {}
+        self._spool_files = {}
+
+    def append(self, list_name, manifest_file):
+        if list_name not in self.spools:
+            fd, path = tempfile.mkstemp(suffix=".jsonl")
+            self._spool_files[list_name] = os.fdopen(fd, "w")
+            self.spools[list_name] = SpooledFiles(path)
+
+        self.spools[list_name]._append(self._spool_files[list_name], manifest_file)
+
+    def close(self):
+        for spool_file in self._spool_files.values():
+            spool_file.close()
+
+    def delete(self):
+        for spool in self.spools.values():
+            spool.close()
+
+
+def parse_storage_manifest(stream):
+    """
+    Parse a storage manifest from a binary file object, and return a
+    ``StreamingStorageManifest``.
+
+    The bag-level fields are built in memory as usual, but every file entry
+    is written to a temporary file as soon as it's parsed, so memory use
+    stays flat however many files are in the bag.
+    """
+    import ijson
+    from ijson.common import ObjectBuilder
+
+    # The top-level builder sees everything except the file entries, so it
+    # ends up with empty "files" lists that we replace with the spools.
+    builder = ObjectBuilder()
+    file_builder = None
+    spooler = _Spooler()
+
+    try:
+        for prefix, event, value in ijson.parse(stream):
+            list_name, is_entry = _spooled_file_list(prefix)
+
+            if list_name is None:
+                builder.event(event, value)
+                continue
+
+            if is_entry and event == "start_map":
+                file_builder = ObjectBuilder()
+
+            file_builder.event(event, value)
+
+            if is_entry and event == "end_map":
+                spooler.append(list_name, file_builder.value)
+    except Exception:
+        spooler.close()
+        spooler.delete()
+        raise
+
+    spooler.close()
+
+    storage_manifest = StreamingStorageManifest(builder.value)
+
+    for name in FILE_LISTS:
+        if name in storage_manifest:
+            # If a list has no files, we never created a spool for it
+            storage_manifest[name]["files"] = spooler.spools.get(name, [])
+
+    return storage_manifest
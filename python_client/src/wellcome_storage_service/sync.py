@@ -0,0 +1,322 @@
+# -*- encoding: utf-8
+"""
+Bring a local copy of a bag up-to-date with a new version of the bag.
+
+Most files don't change between versions of a bag, so rather than
+downloading the whole of the new version, we compare the files on disk
+to the new storage manifest by name and checksum.  We keep files that
+haven't changed, move files that have only been renamed, delete files
+that have gone, and only download what's left.
+"""
+
+import collections
+import hashlib
+import os
+import shutil
+
+from ._utils import imap_unordered, mkdir_p
+from .downloader import (
+    _all_files_with_checksum_algorithm,
+    _copy_chunks,
+    _DownloadJournal,
+    _NullWriter,
+    download_bag,
+    FileFilter,
+)
+
+SyncResult = collections.namedtuple(
+    "SyncResult", ["downloaded", "renamed", "deleted", "unchanged"]
+)
+SyncResult.__doc__ = """
+The changes made by ``sync_bag()``.  ``downloaded``, ``deleted`` and
+``unchanged`` are lists of file names; ``renamed`` is a list of
+``(old_name, new_name)`` pairs for files we copied or moved into place
+rather than downloading.
+"""
+
+# Files that are being moved are put here first, so we can swap files
+# around without overwriting one before we've read it.
+STAGING_DIR = ".sync-staging"
+
+
+def _local_files(out_dir):
+    """
+    Returns a dict ``{name: size}`` of the files in a directory, with names
+    written the same way as in a storage manifest, e.g. ``data/b1234.xml``.
+    """
+    local_files = {}
+
+    for dirpath, dirnames, filenames in os.walk(out_dir):
+        if dirpath == out_dir and STAGING_DIR in dirnames:
+            dirnames.remove(STAGING_DIR)
+
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, out_dir).replace(os.sep, "/")
+            if name != _DownloadJournal.filename:
+                local_files[name] = os.path.getsize(path)
+
+    return local_files
+
+
+def _hash_file(path, checksum_algorithm):
+    hasher = hashlib.new(checksum_algorithm)
+    with open(path, "rb") as read_file_obj:
+        _copy_chunks(read_file_obj, _NullWriter(), hasher=hasher)
+    return hasher.hexdigest()
+
+
+class _LocalChecksums(object):
+    """
+    Works out the checksums of files on disk.
+
+    If we know what version of the bag is on disk, we trust the checksums
+    in its manifest for any file that's still the right size; otherwise we
+    read the file and hash it.
+    """
+
+    def __init__(self, out_dir, previous_manifest, max_workers):
+        self.out_dir = out_dir
+        self.max_workers = max_workers
+        self.known = {}
+
+        if previous_manifest is not None:
+            for manifest_file, checksum_algorithm in _all_files_with_checksum_algorithm(
+                previous_manifest
+            ):
+                self.known[(manifest_file["name"], checksum_algorithm)] = (
+                    manifest_file.get("size"),
+                    manifest_file["checksum"],
+                )
+
+    def _checksum(self, name_and_algorithm):
+        name, checksum_algorithm = name_and_algorithm
+        path = os.path.join(self.out_dir, name)
+
+        try:
+            expected_size, checksum = self.known[name_and_algorithm]
+        except KeyError:
+            pass
+        else:
+            if expected_size in (None, os.path.getsize(path)):
+                return name_and_algorithm, checksum
+
+        return name_and_algorithm, _hash_file(path, checksum_algorithm)
+
+    def get(self, names_and_algorithms):
+        """
+        Returns a dict ``{(name, checksum_algorithm): checksum}``.
+        """
+        if self.max_workers is None:
+            results = map(self._checksum, names_and_algorithms)
+        else:
+            results = imap_unordered(
+                self._checksum, names_and_algorithms, max_workers=self.max_workers
+            )
+
+        return dict(results)
+
+
+def _is_same_size(manifest_file, local_files):
+    try:
+        local_size = local_files[manifest_file["name"]]
+    except KeyError:
+        return False
+    else:
+        return manifest_file.get("size", local_size) == local_size
+
+
+def _plan_sync(storage_manifest, local_files, local_checksums):
+    """
+    Compare the files on disk to a storage manifest.
+
+    Returns ``(unchanged, renamed, to_download)``, where ``renamed`` is a
+    list of ``(local_name, name)`` pairs for files we already have under
+    a different name.
+    """
+    target_files = list(_all_files_with_checksum_algorithm(storage_manifest))
+
+    # First look for files that are already in the right place.  We only
+    # need to hash files that are the right size.
+    same_size = [
+        (f["name"], checksum_algorithm)
+        for f, checksum_algorithm in target_files
+        if _is_same_size(f, local_files)
+    ]
+    checksums = local_checksums.get(same_size)
+
+    unchanged = []
+    wanted = []
+    for manifest_file, checksum_algorithm in target_files:
+        key = (manifest_file["name"], checksum_algorithm)
+        if checksums.get(key) == manifest_file["checksum"]:
+            unchanged.append(manifest_file["name"])
+        else:
+            wanted.append((manifest_file, checksum_algorithm))
+
+    # Then look for the files we still need under other names, hashing
+    # any local file which is the same size as one of them.  An unchanged
+    # file can be copied to a new name, so we include those too.
+    wanted_sizes = collections.defaultdict(set)
+    for manifest_file, checksum_algorithm in wanted:
+        wanted_sizes[manifest_file.get("size")].add(checksum_algorithm)
+
+    candidates = [
+        (name, checksum_algorithm)
+        for name, size in local_files.items()
+        for checksum_algorithm in wanted_sizes.get(size, ())
+        if (name, checksum_algorithm) not in checksums
+    ]
+    checksums.update(local_checksums.get(candidates))
+
+    by_checksum = {}
+    for (name, checksum_algorithm), checksum in checksums.items():
+        by_checksum[(checksum_algorithm, checksum)] = name
+
+    renamed = []
+    to_download = []
+    for manifest_file, checksum_algorithm in wanted:
+        try:
+            local_name = by_checksum[(checksum_algorithm, manifest_file["checksum"])]
+        except KeyError:
+            to_download.append(manifest_file["name"])
+        else:
+            renamed.append((local_name, manifest_file["name"]))
+
+    return unchanged, renamed, to_download
+
+
+def _remove_empty_directories(out_dir):
+    for dirpath, _, _ in sorted(os.walk(out_dir), reverse=True):
+        if dirpath != out_dir and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+
+def _apply_renames(out_dir, renamed, to_remove):
+    """
+    Put the files in ``renamed`` under their new names, and remove the files
+    in ``to_remove``.
+
+    Every source file is moved (or copied, if we're keeping it) into a
+    staging directory before we touch anything else, so it doesn't matter
+    if one file is renamed to another's old name.
+    """
+    staging_dir = os.path.join(out_dir, STAGING_DIR)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    mkdir_p(staging_dir)
+
+    staged = {}
+    for local_name, _ in renamed:
+        if local_name in staged:
+            continue
+
+        staged_path = os.path.join(staging_dir, str(len(staged)))
+        local_path = os.path.join(out_dir, local_name)
+        if local_name in to_remove:
+            os.rename(local_path, staged_path)
+        else:
+            shutil.copyfile(local_path, staged_path)
+        staged[local_name] = staged_path
+
+    for name in to_remove:
+        if name not in staged:
+            os.unlink(os.path.join(out_dir, name))
+
+    # If the same file is needed under more than one name, we copy it for
+    # all but the last, which can have the staged file.
+    remaining_uses = collections.Counter(local_name for local_name, _ in renamed)
+
+    for local_name, name in renamed:
+        out_path = os.path.join(out_dir, name)
+        mkdir_p(os.path.dirname(out_path))
+
+        remaining_uses[local_name] -= 1
+        if remaining_uses[local_name]:
+            shutil.copyfile(staged[local_name], out_path)
+        else:
+            os.rename(staged[local_name], out_path)
+
+    os.rmdir(staging_dir)
+
+
+def sync_bag(
+    storage_manifest,
+    out_dir,
+    previous_manifest=None,
+    delete=True,
+    max_workers=None,
+    use_replicas=False,
+    listener=None,
+    cache=None,
+):
+    """
+    Update a local copy of a bag to match a storage manifest, downloading
+    only the files that aren't already on disk, and return a ``SyncResult``.
+
+    Files are compared by name and checksum: any file that's unchanged is
+    left alone, and any file whose contents are already on disk under a
+    different name is copied or moved into place rather than downloaded.
+
+    :param storage_manifest: A storage manifest returned from the storage
+        service, as retrieved with ``get_bag()``.
+    :param out_dir: The directory with the local copy of the bag.  It
+        doesn't need to exist yet.
+    :param previous_manifest: The storage manifest for the version of the bag
+        that's currently in ``out_dir``, if known.  We use its checksums
+        rather than reading the files on disk, so it must be accurate.
+        Files that aren't in it, or are the wrong size, are hashed.
+    :param delete: If True, delete files in ``out_dir`` that aren't in the
+        bag, and remove any directories left empty.
+    :param max_workers: If set, hash and download up to this many files
+        at once.
+    :param use_replicas: Passed to ``download_bag()``.
+    :param listener: A ``DownloadListener`` that gets events for the files
+        we download.
+    :param cache: Passed to ``download_bag()``.
+
+    """
+    mkdir_p(out_dir)
+
+    local_files = _local_files(out_dir)
+    local_checksums = _LocalChecksums(
+        out_dir, previous_manifest=previous_manifest, max_workers=max_workers
+    )
+
+    unchanged, renamed, to_download = _plan_sync(
+        storage_manifest, local_files=local_files, local_checksums=local_checksums
+    )
+
+    # Any file we're not keeping is removed: if its name is still in the bag,
+    # it'll be replaced by a renamed or downloaded file.
+    unchanged_names = set(unchanged)
+    target_names = unchanged_names | set(name for _, name in renamed) | set(to_download)
+    to_remove = set(
+        name
+        for name in local_files
+        if name not in unchanged_names and (delete or name in target_names)
+    )
+
+    _apply_renames(out_dir, renamed=renamed, to_remove=to_remove)
+
+    if to_download:
+        download_bag(
+            storage_manifest,
+            out_dir=out_dir,
+            max_workers=max_workers,
+            file_filter=FileFilter(names=to_download),
+            use_replicas=use_replicas,
+            listener=listener,
+            cache=cache,
+        )
+
+    if delete:
+        _remove_empty_directories(out_dir)
+
+    return SyncResult(
+        downloaded=sorted(to_download),
+        renamed=sorted(renamed),
+        deleted=sorted(
+            to_remove - target_names - set(local_name for local_name, _ in renamed)
+        ),
+        unchanged=sorted(unchanged),
+    )
@@ -0,0 +1,214 @@
+# -*- encoding: utf-8
+"""
+Upload a bag to S3, ready to be ingested.
+
+Rather than creating a tar.gz on disk and then uploading it, we stream the
+archive straight into an S3 multipart upload.  We never need scratch space
+for the archive, and memory use is bounded by the part size and the number
+of parts in flight.
+"""
+
+import os
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# S3 won't accept parts smaller than 5 MiB (except the last part), or an
+# upload with more than 10,000 parts.
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+
+class _MultipartUploadWriter(object):
+    """
+    A writable, non-seekable file object that uploads everything written to
+    it to S3, in parts of ``part_size`` bytes.
+
+    Parts are uploaded in the background, with at most ``max_concurrency``
+    in flight; if they're all busy, ``write()`` blocks until one finishes.
+    If less than one part is written in total, we use a single PutObject.
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size, max_concurrency):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._futures = []
+        self._error = None
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self._raise_if_failed()
+
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            self._upload_part(part)
+
+        return len(data)
+
+    def _raise_if_failed(self):
+        # If a part has failed, there's no point streaming the rest of
+        # the archive; stop as soon as we notice.
+        if self._error is not None:
+            raise self._error
+
+    def _record_failure(self, future):
+        # Called as each part finishes, so ``write()`` doesn't have to look
+        # at every part we've uploaded so far -- there can be thousands.
+        if not future.cancelled() and self._error is None:
+            self._error = future.exception()
+
+    def _upload_part(self, body):
+        if self._upload_id is None:
+            resp = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )
+            self._upload_id = resp["UploadId"]
+
+        part_number = len(self._futures) + 1
+
+        def _upload():
+            try:
+                resp = self.s3_client.upload_part(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    PartNumber=part_number,
+                    Body=body,
+                )
+                return {"ETag": resp["ETag"], "PartNumber": part_number}
+            finally:
+                self._slots.release()
+
+        self._slots.acquire()
+        future = self._executor.submit(_upload)
+        future.add_done_callback(self._record_failure)
+        self._futures.append(future)
+
+    def close(self):
+        """
+        Upload whatever is left in the buffer, and complete the upload.
+        """
+        if self._upload_id is None:
+            self._executor.shutdown()
+            self.s3_client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer)
+            )
+            return
+
+        try:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+                self._buffer = bytearray()
+
+            parts = [future.result() for future in self._futures]
+        except Exception:
+            self.abort()
+            raise
+
+        self._executor.shutdown()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+
+    def abort(self):
+        """
+        Cancel the upload, so S3 doesn't keep (and charge for) the parts.
+        """
+        self._executor.shutdown()
+
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+
+
+def _bag_files(bag_dir):
+    """
+    Yields ``(path, arcname, size)`` for every file in a bag directory,
+    sorted by name so the archive is the same every time.
+    """
+    for dirpath, dirnames, filenames in os.walk(bag_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            yield path, os.path.relpath(path, start=bag_dir), os.path.getsize(path)
+
+
+def _choose_part_size(total_size, part_size):
+    # The archive is compressed, so it's no bigger than the files that go
+    # into it (give or take the tar headers).  Make sure we won't run out
+    # of parts, leaving some headroom.
+    min_part_size = (total_size // (MAX_PARTS - 1000)) + 1
+    return max(part_size, min_part_size, MIN_PART_SIZE)
+
+
+def upload_bag(
+    bag_dir,
+    s3_bucket,
+    s3_key,
+    s3_client=None,
+    part_size=16 * 1024 * 1024,
+    max_concurrency=4,
+):
+    """
+    Upload a bag directory to S3 as a tar.gz, and return the size of the
+    archive.  The files in the bag are at the top level of the archive.
+
+    The archive is streamed into a multipart upload as it's created, so
+    nothing is written to disk, and at most ``(max_concurrency + 1)``
+    parts are held in memory.
+
+    :param bag_dir: The directory containing the bag, i.e. with
+        ``bagit.txt`` at the top level.
+    :param s3_client: A boto3 S3 client.  If not set, we create one.
+    :param part_size: Size of each part of the upload, in bytes.  This is
+        increased if the bag is so big it would need more than 10,000 parts.
+    :param max_concurrency: How many parts to upload at once.
+
+    """
+    if s3_client is None:
+        import boto3
+
+        s3_client = boto3.client("s3")
+
+    bag_files = list(_bag_files(bag_dir))
+    total_size = sum(size for _, _, size in bag_files)
+
+    writer = _MultipartUploadWriter(
+        s3_client=s3_client,
+        bucket=s3_bucket,
+        key=s3_key,
+        part_size=_choose_part_size(total_size, part_size),
+        max_concurrency=max_concurrency,
+    )
+
+    with writer:
+        with tarfile.open(fileobj=writer, mode="w|gz") as tf:
+            for path, arcname, _ in bag_files:
+                tf.add(path, arcname=arcname, recursive=False)
+
+    return writer.bytes_written
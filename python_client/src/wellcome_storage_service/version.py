@@ -1,4 +1,4 @@
 # -*- encoding: utf-8 -*-
 
-__version_info__ = (2, 3, 3)
+__version_info__ = (2, 28, 0)
 __version__ = ".".join(map(str, __version_info__))
@@ -1,7 +1,10 @@
 # -*- encoding: utf-8
 
+import hashlib
 import json
 import os
+import sys
+import threading
 
 import betamax
 from betamax.cassette import cassette
@@ -9,6 +12,12 @@ from betamax_serializers.pretty_json import PrettyJSONSerializer
 import pytest
 
 from wellcome_storage_service import RequestsOAuthStorageServiceClient
+from wellcome_storage_service import downloader
+
+
+# The async client uses syntax that doesn't exist in Python 2.
+if sys.version_info < (3,):
+    collect_ignore = ["test_async_client.py"]
 
 
 # Remove our OAuth authorization token from betamax recordings.  This is
@@ -68,3 +77,99 @@ def client(request):
     # See https://stackoverflow.com/q/17726954/1558022
     with betamax.Betamax(ss_client.sess).use_cassette(request.node.name):
         yield ss_client
+
+
+@pytest.fixture
+def make_local_bag(tmpdir):
+    """
+    Creates bags in a local directory, which the downloader can read using
+    the ``local-filesystem`` provider, and returns their storage manifests.
+
+    Files under ``data/`` go in the manifest, and the rest in the tag
+    manifest.  Pass ``replicas`` to store copies of the bag in other
+    directories, or ``checksums`` to put the wrong checksum in the manifest.
+    """
+
+    def _location(root):
+        return {
+            "provider": {"id": "local-filesystem"},
+            "bucket": str(tmpdir.join(root)),
+            "path": "space/b12345",
+        }
+
+    def _create_bag(files, version="v1", root="storage", replicas=(), checksums=None):
+        checksums = checksums or {}
+        manifests = {"manifest": [], "tagManifest": []}
+
+        for name, contents in sorted(files.items()):
+            path = "%s/%s" % (version, name)
+            for r in (root,) + tuple(replicas):
+                tmpdir.join(r, "space/b12345", path).write_binary(contents, ensure=True)
+
+            manifest_name = "manifest" if name.startswith("data/") else "tagManifest"
+            manifests[manifest_name].append(
+                {
+                    "name": name,
+                    "path": path,
+                    "size": len(contents),
+                    "checksum": checksums.get(
+                        name, hashlib.sha256(contents).hexdigest()
+                    ),
+                }
+            )
+
+        storage_manifest = {
+            "info": {"externalIdentifier": "b12345"},
+            "location": _location(root),
+            "manifest": {
+                "checksumAlgorithm": "SHA-256",
+                "files": manifests["manifest"],
+            },
+            "tagManifest": {
+                "checksumAlgorithm": "SHA-256",
+                "files": manifests["tagManifest"],
+            },
+        }
+
+        if replicas:
+            storage_manifest["replicaLocations"] = [_location(r) for r in replicas]
+
+        return storage_manifest
+
+    return _create_bag
+
+
+class RecordingProvider(downloader.LocalFilesystemProvider):
+    """
+    Reads bags from a local directory, and records which files we open and
+    every range we ask for.
+    """
+
+    def __init__(self):
+        super(RecordingProvider, self).__init__()
+        self.opened = []
+        self.ranges = []
+        self._lock = threading.Lock()
+
+    def get_fileobj(self, location, manifest_file):
+        with self._lock:
+            self.opened.append(manifest_file["name"])
+        return super(RecordingProvider, self).get_fileobj(location, manifest_file)
+
+    def get_range(self, location, manifest_file, start, end):
+        with self._lock:
+            self.ranges.append((manifest_file["name"], start, end))
+        return super(RecordingProvider, self).get_range(
+            location, manifest_file, start, end
+        )
+
+
+@pytest.fixture
+def recording_provider(monkeypatch):
+    """
+    A ``RecordingProvider``, which the downloader uses for every bag in
+    the ``local-filesystem`` provider.
+    """
+    provider = RecordingProvider()
+    monkeypatch.setitem(downloader.PROVIDERS, "local-filesystem", lambda: provider)
+    return provider
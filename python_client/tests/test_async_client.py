@@ -0,0 +1,270 @@
+# -*- encoding: utf-8
+
+import asyncio
+import collections
+import json
+
+import httpx
+import pytest
+
+from wellcome_storage_service.async_client import (
+    AsyncOAuthStorageServiceClient,
+    AsyncStorageServiceClient,
+)
+from wellcome_storage_service.exceptions import BagNotFound, IngestNotFound, UserError
+
+API_URL = "https://api.example.org/storage/v1"
+TOKEN_URL = "https://auth.example.org/oauth2/token"
+
+
+class FakeStorageService(object):
+    """
+    Handles requests for an httpx.MockTransport, recording how many token
+    requests it gets and how many API requests are in flight at once.
+    """
+
+    def __init__(self):
+        self.token_requests = 0
+        self.ingest_polls = collections.Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self, request):
+        if str(request.url) == TOKEN_URL:
+            self.token_requests += 1
+            await asyncio.sleep(0.01)
+            return httpx.Response(
+                200,
+                json={
+                    "access_token": "token-%d" % self.token_requests,
+                    "expires_in": 3600,
+                    "token_type": "Bearer",
+                },
+            )
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            return self._handle(request)
+        finally:
+            self.in_flight -= 1
+
+    def _handle(self, request):
+        path = request.url.path[len("/storage/v1") :]
+
+        if request.method == "POST" and path == "/ingests":
+            payload = json.loads(request.content)
+            if "/" in payload["space"]["id"]:
+                return httpx.Response(
+                    400,
+                    json={"label": "Bad Request", "description": "Invalid space"},
+                )
+            return httpx.Response(201, headers={"Location": API_URL + "/ingests/123"})
+        elif path == "/ingests/123":
+            return httpx.Response(
+                200,
+                json={
+                    "id": "123",
+                    "authorization": request.headers.get("Authorization"),
+                },
+            )
+        elif path.startswith("/ingests/finishes-after-"):
+            # e.g. /ingests/finishes-after-3 succeeds on the third poll
+            ingest_id = path.split("/")[-1]
+            self.ingest_polls[ingest_id] += 1
+            if self.ingest_polls[ingest_id] >= int(ingest_id.split("-")[-1]):
+                status = "succeeded"
+            else:
+                status = "processing"
+            return httpx.Response(
+                200,
+                json={
+                    "id": ingest_id,
+                    "status": {"id": status},
+                    "createdDate": "2019-07-09T12:00:00.000Z",
+                    "events": [],
+                },
+            )
+        elif path == "/bags/digitised/b12345":
+            return httpx.Response(
+                200,
+                json={
+                    "id": "digitised/b12345",
+                    "version": request.url.params.get("version", "v2"),
+                },
+            )
+        else:
+            return httpx.Response(404, json={})
+
+
+@pytest.fixture
+def service():
+    return FakeStorageService()
+
+
+def _client(service, **kwargs):
+    return AsyncOAuthStorageServiceClient(
+        api_url=API_URL,
+        client_id="client_id",
+        client_secret="client_secret",
+        token_url=TOKEN_URL,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(service)),
+        **kwargs
+    )
+
+
+def test_can_get_bag(service):
+    async def run():
+        async with _client(service) as client:
+            return await client.get_bag("digitised", "b12345", version="v1")
+
+    assert asyncio.run(run()) == {"id": "digitised/b12345", "version": "v1"}
+
+
+def test_missing_bag_is_error(service):
+    async def run():
+        async with _client(service) as client:
+            await client.get_bag("digitised", "doesnotexist")
+
+    with pytest.raises(BagNotFound):
+        asyncio.run(run())
+
+
+def test_can_create_and_retrieve_ingest(service):
+    async def run():
+        async with _client(service) as client:
+            location = await client.create_s3_ingest(
+                space="digitised",
+                external_identifier="b12345",
+                s3_bucket="testing-bucket",
+                s3_key="bagit.zip",
+            )
+            return await client.get_ingest_from_location(location)
+
+    ingest = asyncio.run(run())
+    assert ingest["id"] == "123"
+    assert ingest["authorization"] == "Bearer token-1"
+
+
+def test_can_wait_for_ingests(service):
+    async def run():
+        async with _client(service) as client:
+            return [
+                ingest["id"]
+                async for ingest in client.wait_for_ingests(
+                    ["finishes-after-3", "finishes-after-1", "finishes-after-2"],
+                    min_interval=0,
+                    max_interval=0.01,
+                )
+            ]
+
+    assert asyncio.run(run()) == [
+        "finishes-after-1",
+        "finishes-after-2",
+        "finishes-after-3",
+    ]
+    assert service.ingest_polls["finishes-after-3"] == 3
+
+
+def test_waiting_for_missing_ingest_is_error(service):
+    async def run():
+        async with _client(service) as client:
+            async for _ in client.wait_for_ingests(["doesnotexist"]):
+                pass
+
+    with pytest.raises(IngestNotFound):
+        asyncio.run(run())
+
+
+def test_4xx_creating_ingest_becomes_usererror(service):
+    async def run():
+        async with _client(service) as client:
+            await client.create_s3_ingest(
+                space="space/with/a/slash",
+                external_identifier="b12345",
+                s3_bucket="testing-bucket",
+                s3_key="bagit.zip",
+            )
+
+    with pytest.raises(UserError, match="Bad Request: Invalid space"):
+        asyncio.run(run())
+
+
+def test_missing_ingest_is_error(service):
+    async def run():
+        async with _client(service) as client:
+            await client.get_ingest("doesnotexist")
+
+    with pytest.raises(IngestNotFound):
+        asyncio.run(run())
+
+
+def test_concurrent_callers_share_one_token_refresh(service):
+    async def run():
+        async with _client(service) as client:
+            await asyncio.gather(*[client.get_ingest("123") for _ in range(20)])
+
+            # Now expire the token, and check it only gets refreshed once
+            client.token["expires_at"] -= 7200
+            await asyncio.gather(*[client.get_ingest("123") for _ in range(20)])
+
+    asyncio.run(run())
+    assert service.token_requests == 2
+
+
+def test_caps_concurrent_requests(service):
+    async def run():
+        async with _client(service, max_concurrency=5) as client:
+            await asyncio.gather(*[client.get_ingest("123") for _ in range(50)])
+
+    asyncio.run(run())
+    assert service.max_in_flight == 5
+
+
+def test_unauthenticated_client_sends_no_token(service):
+    async def run():
+        client = AsyncStorageServiceClient(
+            api_url=API_URL,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(service)),
+        )
+        try:
+            return await client.get_ingest("123")
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run())["authorization"] is None
+    assert service.token_requests == 0
+
+
+def test_can_get_async_client_from_path(tmpdir):
+    credentials_path = tmpdir / "oauth_credentials.json"
+    credentials_path.write(
+        json.dumps(
+            {
+                "client_id": "client_id",
+                "client_secret": "client_secret",
+                "token_url": TOKEN_URL,
+            }
+        )
+    )
+
+    client = AsyncOAuthStorageServiceClient.from_path(
+        api_url=API_URL, credentials_path=str(credentials_path), http2=False
+    )
+
+    assert client.client_id == "client_id"
+    assert client.token_url == TOKEN_URL
+    asyncio.run(client.aclose())
+
+
+def test_async_client_shares_token_cache(service, tmpdir):
+    cache_path = str(tmpdir.join("oauth-token-cache.json"))
+
+    async def run():
+        for _ in range(2):
+            async with _client(service, token_cache_path=cache_path) as client:
+                await client.get_ingest("123")
+
+    asyncio.run(run())
+    assert service.token_requests == 1
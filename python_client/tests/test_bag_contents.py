@@ -0,0 +1,116 @@
+# -*- encoding: utf-8
+
+import time
+
+import pytest
+
+from wellcome_storage_service import (
+    DownloadStats,
+    FileFilter,
+    FixityError,
+    iter_bag_contents,
+)
+
+BAG_FILES = [
+    ("data/b12345.xml", b"<mets/>"),
+    ("data/objects/b12345_0001.jp2", b"1" * 100),
+    ("data/objects/b12345_0002.jp2", b"2" * 100),
+    ("data/objects/b12345_0003.jp2", b"3" * 100),
+    ("data/objects/b12345_0004.jp2", b"4" * 100),
+    ("bagit.txt", b"BagIt-Version: 0.97\n"),
+]
+
+
+@pytest.fixture
+def storage_manifest(make_local_bag):
+    return make_local_bag(dict(BAG_FILES))
+
+
+def _wait_for_opened(provider, count):
+    deadline = time.time() + 5
+    while len(provider.opened) < count and time.time() < deadline:
+        time.sleep(0.01)
+
+    # Give any fetches that shouldn't happen a chance to start
+    time.sleep(0.05)
+    return list(provider.opened)
+
+
+def test_yields_every_file_in_order(storage_manifest, recording_provider):
+    contents = [
+        (manifest_file["name"], data)
+        for manifest_file, data in iter_bag_contents(storage_manifest)
+    ]
+
+    assert contents == BAG_FILES
+
+
+def test_uses_file_filter(storage_manifest, recording_provider):
+    names = [
+        manifest_file["name"]
+        for manifest_file, _ in iter_bag_contents(
+            storage_manifest, file_filter=FileFilter(include="*.xml")
+        )
+    ]
+
+    assert names == ["data/b12345.xml"]
+
+
+def test_fetches_the_next_files_while_you_process_one(
+    storage_manifest, recording_provider
+):
+    contents = iter_bag_contents(storage_manifest, prefetch=2)
+    next(contents)
+
+    assert _wait_for_opened(recording_provider, 3) == [
+        name for name, _ in BAG_FILES[:3]
+    ]
+
+    assert [name for name, _ in BAG_FILES[1:]] == [f["name"] for f, _ in contents]
+
+
+def test_prefetch_stays_within_the_memory_budget(storage_manifest, recording_provider):
+    contents = iter_bag_contents(storage_manifest, prefetch=10, max_in_flight_bytes=250)
+    next(contents)
+    next(contents)
+
+    # We're holding the 100 byte file 0001, so there's only room to fetch
+    # one more 100 byte file.
+    assert _wait_for_opened(recording_provider, 3) == [
+        name for name, _ in BAG_FILES[:3]
+    ]
+
+
+def test_verify_raises_for_a_corrupted_file(
+    storage_manifest, recording_provider, tmpdir
+):
+    tmpdir.join("storage/space/b12345/v1/data/objects/b12345_0002.jp2").write_binary(
+        b"X" * 100
+    )
+
+    names = []
+    with pytest.raises(FixityError):
+        for manifest_file, _ in iter_bag_contents(storage_manifest, verify=True):
+            names.append(manifest_file["name"])
+
+    assert names == ["data/b12345.xml", "data/objects/b12345_0001.jp2"]
+
+
+def test_failed_fetch_is_raised_in_order(storage_manifest, recording_provider, tmpdir):
+    tmpdir.join("storage/space/b12345/v1/data/objects/b12345_0003.jp2").remove()
+
+    names = []
+    with pytest.raises(IOError):
+        for manifest_file, _ in iter_bag_contents(storage_manifest):
+            names.append(manifest_file["name"])
+
+    assert names == [name for name, _ in BAG_FILES[:3]]
+
+
+def test_reports_to_listener(storage_manifest, recording_provider):
+    stats = DownloadStats()
+
+    list(iter_bag_contents(storage_manifest, listener=stats))
+
+    assert stats.summary()["files"] == len(BAG_FILES)
+    assert stats.summary()["bytes"] == sum(len(c) for _, c in BAG_FILES)
@@ -0,0 +1,192 @@
+# -*- encoding: utf-8
+
+import errno
+import hashlib
+import io
+
+import pytest
+
+from wellcome_storage_service import BagFilesystem, StorageManifest
+from wellcome_storage_service.bag_filesystem import FileStat
+
+BAG_FILES = {
+    "bagit.txt": b"BagIt-Version: 0.97\n",
+    "data/b12345.xml": b"<mets/>",
+    "data/objects/b12345_0001.jp2": bytes(bytearray(range(256))) * 4,
+    "data/objects/b12345_0002.jp2": b"2" * 100,
+}
+
+
+@pytest.fixture
+def storage_manifest(make_local_bag):
+    return make_local_bag(BAG_FILES)
+
+
+@pytest.fixture
+def fs(storage_manifest, recording_provider):
+    fs = BagFilesystem(storage_manifest, block_size=100, readahead=2)
+    fs.provider = recording_provider
+    return fs
+
+
+class TestListing(object):
+    def test_listdir(self, fs):
+        assert fs.listdir() == ["bagit.txt", "data"]
+        assert fs.listdir("data") == ["b12345.xml", "objects"]
+        assert fs.listdir("/data/objects/") == [
+            "b12345_0001.jp2",
+            "b12345_0002.jp2",
+        ]
+
+    def test_listdir_of_a_file_is_error(self, fs):
+        with pytest.raises(OSError) as err:
+            fs.listdir("bagit.txt")
+
+        assert err.value.errno == errno.ENOTDIR
+
+    def test_listdir_of_missing_directory_is_error(self, fs):
+        with pytest.raises(OSError) as err:
+            fs.listdir("metadata")
+
+        assert err.value.errno == errno.ENOENT
+
+    def test_walk(self, fs):
+        assert list(fs.walk()) == [
+            ("", ["data"], ["bagit.txt"]),
+            ("data", ["objects"], ["b12345.xml"]),
+            ("data/objects", [], ["b12345_0001.jp2", "b12345_0002.jp2"]),
+        ]
+
+    def test_exists_isdir_isfile(self, fs):
+        assert fs.isdir("data") and not fs.isfile("data")
+        assert fs.isfile("data/b12345.xml") and not fs.isdir("data/b12345.xml")
+        assert fs.exists("data") and fs.exists("bagit.txt")
+        assert not fs.exists("data/missing.xml")
+
+    def test_stat_file(self, fs):
+        assert fs.stat("data/b12345.xml") == FileStat(
+            name="data/b12345.xml",
+            size=7,
+            is_dir=False,
+            checksum_algorithm="sha256",
+            checksum=hashlib.sha256(b"<mets/>").hexdigest(),
+        )
+
+    def test_stat_directory(self, fs):
+        stat = fs.stat("data/objects")
+
+        assert stat.is_dir
+        assert stat.size == 1124
+
+    def test_listing_makes_no_requests(self, fs):
+        list(fs.walk())
+        fs.stat("data/b12345.xml")
+
+        assert fs.provider.ranges == []
+
+    def test_accepts_a_storage_manifest(self, storage_manifest):
+        fs = BagFilesystem(StorageManifest(storage_manifest))
+
+        assert fs.listdir("data") == ["b12345.xml", "objects"]
+
+
+class TestOpen(object):
+    def test_can_read_a_file(self, fs):
+        with fs.open("data/objects/b12345_0001.jp2") as infile:
+            assert infile.read() == BAG_FILES["data/objects/b12345_0001.jp2"]
+
+    def test_empty_read_makes_no_requests(self, fs):
+        with fs.open("data/b12345.xml") as infile:
+            assert infile.read(0) == b""
+            assert fs.provider.ranges == []
+
+    def test_can_seek_and_read(self, fs):
+        contents = BAG_FILES["data/objects/b12345_0001.jp2"]
+
+        with fs.open("data/objects/b12345_0001.jp2") as infile:
+            infile.seek(250)
+            assert infile.read(10) == contents[250:260]
+            assert infile.tell() == 260
+
+            infile.seek(-4, io.SEEK_END)
+            assert infile.read() == contents[-4:]
+
+            infile.seek(-1000, io.SEEK_CUR)
+            assert infile.read(3) == contents[24:27]
+
+    def test_random_read_fetches_only_the_blocks_it_needs(self, fs):
+        with fs.open("data/objects/b12345_0001.jp2") as infile:
+            infile.seek(250)
+            infile.raw.readinto(bytearray(60))
+
+        assert fs.provider.ranges == [("data/objects/b12345_0001.jp2", 200, 399)]
+
+    def test_sequential_reads_read_ahead(self, fs):
+        with fs.open("data/objects/b12345_0001.jp2") as infile:
+            infile.raw.readinto(bytearray(50))
+            infile.raw.readinto(bytearray(100))
+            infile.raw.readinto(bytearray(100))
+
+        assert fs.provider.ranges == [
+            ("data/objects/b12345_0001.jp2", 0, 99),
+            ("data/objects/b12345_0001.jp2", 100, 399),
+        ]
+
+    def test_readahead_stops_at_the_end_of_the_file(self, fs):
+        with fs.open("data/objects/b12345_0001.jp2") as infile:
+            infile.raw.seek(850)
+            infile.raw.readinto(bytearray(100))
+            infile.raw.readinto(bytearray(100))
+
+        assert fs.provider.ranges[-1] == ("data/objects/b12345_0001.jp2", 1000, 1023)
+
+    def test_blocks_are_cached_between_files(self, fs):
+        for _ in range(3):
+            with fs.open("data/b12345.xml") as infile:
+                assert infile.read() == b"<mets/>"
+
+        assert fs.provider.ranges == [("data/b12345.xml", 0, 6)]
+        assert fs.requests == 1
+        assert fs.bytes_fetched == 7
+
+    def test_only_missing_blocks_are_fetched(self, fs):
+        contents = BAG_FILES["data/objects/b12345_0001.jp2"]
+
+        with fs.open("data/objects/b12345_0001.jp2") as infile:
+            infile.seek(150)
+            infile.read(10)
+            infile.seek(0)
+            assert infile.read(300) == contents[:300]
+
+        assert fs.provider.ranges == [
+            ("data/objects/b12345_0001.jp2", 100, 299),
+            ("data/objects/b12345_0001.jp2", 0, 99),
+        ]
+
+    def test_evicts_old_blocks(self, storage_manifest, recording_provider):
+        fs = BagFilesystem(
+            storage_manifest, block_size=100, readahead=0, max_cache_bytes=200
+        )
+        fs.provider = recording_provider
+
+        with fs.open("data/objects/b12345_0001.jp2") as infile:
+            infile.read(300)
+            infile.seek(0)
+            infile.read(10)
+
+        assert fs.provider.ranges == [
+            ("data/objects/b12345_0001.jp2", 0, 299),
+            ("data/objects/b12345_0001.jp2", 0, 99),
+        ]
+
+    def test_opening_a_missing_file_is_error(self, fs):
+        with pytest.raises(IOError) as err:
+            fs.open("data/missing.xml")
+
+        assert err.value.errno == errno.ENOENT
+
+    def test_opening_a_directory_is_error(self, fs):
+        with pytest.raises(IOError) as err:
+            fs.open("data")
+
+        assert err.value.errno == errno.EISDIR
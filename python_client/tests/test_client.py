@@ -1,14 +1,20 @@
+import email.utils
 import json
 import os
 import random
 import string
+import time
 
+import mock
 import pytest
+import requests
 
 from wellcome_storage_service import (
     DEFAULT_CREDENTIALS_PATH,
     RequestsOAuthStorageServiceClient,
+    RequestsStorageServiceClient,
 )
+from wellcome_storage_service.exceptions import ServerError
 
 
 def rand_hex():
@@ -56,3 +62,120 @@ def test_gets_credentials_from_default_path(tmpdir):
     )
 
     assert client.client_id == json.load(open(DEFAULT_CREDENTIALS_PATH))["client_id"]
+
+
+def _response(status_code, text="{}", headers=None):
+    return mock.Mock(status_code=status_code, text=text, headers=headers or {})
+
+
+class TestRetries(object):
+    @pytest.fixture(autouse=True)
+    def sleep(self):
+        with mock.patch("wellcome_storage_service.time.sleep") as sleep:
+            yield sleep
+
+    def _client(self, responses, **kwargs):
+        sess = mock.Mock()
+        sess.get.side_effect = responses
+        return RequestsStorageServiceClient(
+            api_url="https://example.org/storage/v1", sess=sess, **kwargs
+        )
+
+    def test_does_not_retry_by_default(self):
+        client = self._client([_response(503)])
+
+        with pytest.raises(ServerError):
+            client.get_ingest("1234")
+
+        assert client.sess.get.call_count == 1
+
+    def test_retries_throttled_get_until_it_succeeds(self):
+        client = self._client(
+            [_response(429), _response(502), _response(200, '{"id": "1234"}')],
+            max_retries=3,
+        )
+
+        assert client.get_ingest("1234") == {"id": "1234"}
+        assert client.retry_counts == {429: 1, 502: 1}
+
+    def test_gives_up_after_max_retries(self):
+        client = self._client([_response(503)] * 3, max_retries=2)
+
+        with pytest.raises(ServerError):
+            client.get_ingest("1234")
+
+        assert client.sess.get.call_count == 3
+        assert client.retry_counts == {503: 2}
+
+    def test_does_not_retry_other_errors(self):
+        client = self._client([_response(500)], max_retries=3)
+
+        with pytest.raises(ServerError):
+            client.get_ingest("1234")
+
+        assert client.retry_counts == {}
+
+    def test_retries_connection_errors(self):
+        client = self._client(
+            [requests.ConnectionError(), _response(200, '{"id": "1234"}')],
+            max_retries=1,
+        )
+
+        assert client.get_ingest("1234") == {"id": "1234"}
+        assert client.retry_counts == {"connection_error": 1}
+
+    def test_raises_connection_error_after_max_retries(self):
+        client = self._client([requests.ConnectionError()] * 2, max_retries=1)
+
+        with pytest.raises(requests.ConnectionError):
+            client.get_ingest("1234")
+
+    def test_honours_retry_after_seconds(self, sleep):
+        client = self._client(
+            [_response(429, headers={"Retry-After": "7"}), _response(200)],
+            max_retries=1,
+        )
+        client.get_ingest("1234")
+
+        sleep.assert_called_once_with(7)
+
+    def test_honours_retry_after_date(self, sleep):
+        retry_after = email.utils.formatdate(time.time() + 20, usegmt=True)
+        client = self._client(
+            [_response(503, headers={"Retry-After": retry_after}), _response(200)],
+            max_retries=1,
+        )
+        client.get_ingest("1234")
+
+        (wait,), _ = sleep.call_args
+        assert 15 <= wait <= 20
+
+    def test_caps_retry_after_at_max_backoff(self, sleep):
+        client = self._client(
+            [_response(429, headers={"Retry-After": "3600"}), _response(200)],
+            max_retries=1,
+            max_backoff=10,
+        )
+        client.get_ingest("1234")
+
+        sleep.assert_called_once_with(10)
+
+    def test_backoff_is_jittered_and_exponential(self, sleep):
+        client = self._client(
+            [_response(503)] * 4 + [_response(200)], max_retries=4, backoff_factor=1
+        )
+        client.get_ingest("1234")
+
+        waits = [args[0] for args, _ in sleep.call_args_list]
+        assert len(waits) == 4
+        for attempt, wait in enumerate(waits):
+            assert 0 <= wait <= 2**attempt
+
+
+def test_can_configure_connection_pool_size():
+    sess = requests.Session()
+    RequestsStorageServiceClient(
+        api_url="https://example.org/storage/v1", sess=sess, pool_maxsize=50
+    )
+
+    assert sess.get_adapter("https://example.org")._pool_maxsize == 50
@@ -0,0 +1,157 @@
+# -*- encoding: utf-8
+
+import gzip
+import io
+import tarfile
+
+import pytest
+
+from wellcome_storage_service import compression, download_compressed_bag
+
+BAG_FILES = {
+    "bagit.txt": b"BagIt-Version: 0.97\n",
+    "data/b12345.xml": b"<mets/>" * 1000,
+    "data/objects/b12345_0001.jp2": b"1" * 100000,
+    "data/objects/b12345_0002.jp2": b"2" * 100000,
+}
+
+
+@pytest.fixture
+def storage_manifest(make_local_bag):
+    return make_local_bag(BAG_FILES)
+
+
+def _read_archive(tf):
+    return {
+        member.name: tf.extractfile(member).read()
+        for member in tf.getmembers()
+        if member.isfile()
+    }
+
+
+def _expected_archive():
+    return {"b12345/%s" % name: contents for name, contents in BAG_FILES.items()}
+
+
+@pytest.mark.parametrize("compression_name", ["gzip", "none"])
+@pytest.mark.parametrize("threads", [None, 4])
+@pytest.mark.parametrize("skip_compressed", [True, False])
+def test_archive_has_every_file(
+    storage_manifest, tmpdir, monkeypatch, compression_name, threads, skip_compressed
+):
+    monkeypatch.setattr(compression, "GZIP_BLOCK_SIZE", 10000)
+    out_path = str(tmpdir.join("b12345.tar"))
+
+    download_compressed_bag(
+        storage_manifest,
+        out_path=out_path,
+        compression=compression_name,
+        threads=threads,
+        skip_compressed=skip_compressed,
+    )
+
+    with tarfile.open(out_path) as tf:
+        assert _read_archive(tf) == _expected_archive()
+
+
+def test_none_writes_a_plain_tar(storage_manifest, tmpdir):
+    out_path = str(tmpdir.join("b12345.tar"))
+
+    download_compressed_bag(storage_manifest, out_path=out_path, compression="none")
+
+    with tarfile.open(out_path, "r:") as tf:
+        assert _read_archive(tf) == _expected_archive()
+
+
+def test_threaded_gzip_can_be_read_by_gzip(storage_manifest, tmpdir, monkeypatch):
+    monkeypatch.setattr(compression, "GZIP_BLOCK_SIZE", 10000)
+    out_file = io.BytesIO()
+
+    download_compressed_bag(storage_manifest, fileobj=out_file, threads=4)
+
+    uncompressed = gzip.GzipFile(fileobj=io.BytesIO(out_file.getvalue())).read()
+    with tarfile.open(fileobj=io.BytesIO(uncompressed)) as tf:
+        assert _read_archive(tf) == _expected_archive()
+
+
+@pytest.mark.parametrize("threads", [None, 4])
+def test_skip_compressed_stores_compressed_files(storage_manifest, tmpdir, threads):
+    compressed_path = str(tmpdir.join("compressed.tar.gz"))
+    skipped_path = str(tmpdir.join("skipped.tar.gz"))
+
+    download_compressed_bag(storage_manifest, out_path=compressed_path, threads=threads)
+    download_compressed_bag(
+        storage_manifest, out_path=skipped_path, threads=threads, skip_compressed=True
+    )
+
+    # The .jp2 files are really very compressible, so we can tell that
+    # they were stored without compression.
+    assert tmpdir.join("compressed.tar.gz").size() < 5000
+    assert tmpdir.join("skipped.tar.gz").size() > 200000
+
+
+@pytest.mark.parametrize("threads", [None, 2])
+@pytest.mark.parametrize("skip_compressed", [True, False])
+def test_zstd(storage_manifest, tmpdir, threads, skip_compressed):
+    zstandard = pytest.importorskip("zstandard")
+    out_path = str(tmpdir.join("b12345.tar.zst"))
+
+    download_compressed_bag(
+        storage_manifest,
+        out_path=out_path,
+        compression="zstd",
+        threads=threads,
+        skip_compressed=skip_compressed,
+    )
+
+    with open(out_path, "rb") as infile:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            infile, read_across_frames=True
+        )
+        with tarfile.open(fileobj=reader, mode="r|") as tf:
+            contents = {}
+            for member in tf:
+                if member.isfile():
+                    contents[member.name] = tf.extractfile(member).read()
+
+    assert contents == _expected_archive()
+
+
+def test_needs_out_path_or_fileobj(storage_manifest):
+    with pytest.raises(ValueError, match="out_path or a fileobj"):
+        download_compressed_bag(storage_manifest)
+
+
+def test_failed_download_removes_partial_archive(storage_manifest, tmpdir):
+    tmpdir.join("storage/space/b12345/v1/data/objects/b12345_0002.jp2").remove()
+    out_path = tmpdir.join("b12345.tar.gz")
+
+    with pytest.raises(IOError):
+        download_compressed_bag(storage_manifest, out_path=str(out_path))
+
+    assert not out_path.exists()
+
+
+def test_unknown_compression_is_error(storage_manifest, tmpdir):
+    with pytest.raises(ValueError, match="Unsupported compression"):
+        download_compressed_bag(
+            storage_manifest,
+            out_path=str(tmpdir.join("b12345.tar.bz2")),
+            compression="bzip2",
+        )
+
+    assert not tmpdir.join("b12345.tar.bz2").exists()
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("data/b12345_0001.jp2", True),
+        ("data/VIDEO.MXF", True),
+        ("data/archive.zip", True),
+        ("data/b12345.xml", False),
+        ("bagit.txt", False),
+    ],
+)
+def test_is_compressed(name, expected):
+    assert compression.is_compressed(name) == expected
@@ -0,0 +1,236 @@
+# -*- encoding: utf-8
+
+import hashlib
+import os
+import tarfile
+import time
+
+import pytest
+
+from wellcome_storage_service import (
+    ContentCache,
+    DownloadStats,
+    download_bag,
+    download_compressed_bag,
+    iter_bag_contents,
+)
+
+
+def _sha256(contents):
+    return hashlib.sha256(contents).hexdigest()
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return ContentCache(cache_dir=str(tmpdir.join("cache")))
+
+
+def _put(cache, tmpdir, contents):
+    path = tmpdir.join("to_cache", _sha256(contents))
+    path.write_binary(contents, ensure=True)
+    cache.put("sha256", _sha256(contents), str(path))
+
+
+class TestContentCache(object):
+    def test_can_get_a_cached_file(self, cache, tmpdir):
+        _put(cache, tmpdir, b"hello world")
+        out_path = tmpdir.join("out", "hello.txt")
+
+        assert cache.get("sha256", _sha256(b"hello world"), str(out_path))
+        assert out_path.read_binary() == b"hello world"
+        assert cache.hits == 1
+
+    def test_missing_file_is_not_copied(self, cache, tmpdir):
+        out_path = tmpdir.join("out", "hello.txt")
+
+        assert not cache.get("sha256", _sha256(b"hello world"), str(out_path))
+        assert not out_path.exists()
+        assert cache.misses == 1
+
+    def test_checksum_algorithm_is_part_of_the_key(self, cache, tmpdir):
+        _put(cache, tmpdir, b"hello world")
+
+        assert cache.open("SHA-256", _sha256(b"hello world")) is not None
+        assert cache.open("sha512", _sha256(b"hello world")) is None
+
+    def test_cached_files_are_read_only(self, cache, tmpdir):
+        _put(cache, tmpdir, b"hello world")
+
+        with cache.open("sha256", _sha256(b"hello world")) as cached_file:
+            assert not os.stat(cached_file.name).st_mode & 0o222
+
+    def test_without_link_files_are_copied(self, tmpdir):
+        cache = ContentCache(cache_dir=str(tmpdir.join("cache")), link=False)
+        _put(cache, tmpdir, b"hello world")
+        out_path = tmpdir.join("out", "hello.txt")
+
+        cache.get("sha256", _sha256(b"hello world"), str(out_path))
+
+        assert os.stat(str(out_path)).st_nlink == 1
+
+    def test_replaces_existing_file(self, cache, tmpdir):
+        _put(cache, tmpdir, b"hello world")
+        out_path = tmpdir.join("out", "hello.txt")
+        out_path.write_binary(b"an older version", ensure=True)
+
+        cache.get("sha256", _sha256(b"hello world"), str(out_path))
+
+        assert out_path.read_binary() == b"hello world"
+
+    def test_evicts_least_recently_used_files(self, tmpdir):
+        cache = ContentCache(cache_dir=str(tmpdir.join("cache")), max_bytes=25)
+
+        _put(cache, tmpdir, b"1" * 10)
+        _put(cache, tmpdir, b"2" * 10)
+        cache.open("sha256", _sha256(b"1" * 10)).close()
+        _put(cache, tmpdir, b"3" * 10)
+
+        assert cache.total_bytes == 20
+        assert cache.open("sha256", _sha256(b"1" * 10)) is not None
+        assert cache.open("sha256", _sha256(b"2" * 10)) is None
+
+    def test_does_not_cache_files_bigger_than_the_cache(self, tmpdir):
+        cache = ContentCache(cache_dir=str(tmpdir.join("cache")), max_bytes=5)
+
+        _put(cache, tmpdir, b"hello world")
+
+        assert cache.total_bytes == 0
+
+    def test_finds_files_cached_by_another_process(self, tmpdir):
+        cache_dir = str(tmpdir.join("cache"))
+        _put(ContentCache(cache_dir), tmpdir, b"1" * 10)
+        time.sleep(0.01)
+        _put(ContentCache(cache_dir), tmpdir, b"2" * 10)
+
+        cache = ContentCache(cache_dir, max_bytes=25)
+        assert cache.total_bytes == 20
+
+        _put(cache, tmpdir, b"3" * 10)
+        assert cache.open("sha256", _sha256(b"1" * 10)) is None
+        assert cache.open("sha256", _sha256(b"2" * 10)) is not None
+
+    def test_using_a_file_does_not_change_linked_copies(self, cache, tmpdir):
+        _put(cache, tmpdir, b"hello world")
+        out_path = tmpdir.join("out", "hello.txt")
+        cache.get("sha256", _sha256(b"hello world"), str(out_path))
+        os.utime(str(out_path), (1000, 1000))
+
+        cache.get("sha256", _sha256(b"hello world"), str(tmpdir.join("out", "2.txt")))
+
+        assert os.stat(str(out_path)).st_mtime == 1000
+
+    def test_another_process_sees_which_files_were_used(self, tmpdir):
+        cache_dir = str(tmpdir.join("cache"))
+        _put(ContentCache(cache_dir), tmpdir, b"1" * 10)
+        time.sleep(0.01)
+        _put(ContentCache(cache_dir), tmpdir, b"2" * 10)
+        time.sleep(0.01)
+        ContentCache(cache_dir).open("sha256", _sha256(b"1" * 10)).close()
+
+        cache = ContentCache(cache_dir, max_bytes=25)
+        _put(cache, tmpdir, b"3" * 10)
+
+        assert cache.open("sha256", _sha256(b"1" * 10)) is not None
+        assert cache.open("sha256", _sha256(b"2" * 10)) is None
+        assert os.path.exists(cache._last_used_path(("sha256", _sha256(b"1" * 10))))
+
+    def test_rejects_a_checksum_that_isnt_a_checksum(self, cache, tmpdir):
+        with pytest.raises(ValueError, match="Not a valid checksum"):
+            cache.get("sha256", "../../etc/passwd", str(tmpdir.join("passwd")))
+
+
+BAG_FILES = {
+    "bagit.txt": b"BagIt-Version: 0.97\n",
+    "data/b12345.xml": b"<mets/>",
+    "data/objects/b12345_0001.jp2": b"1" * 1000,
+}
+
+
+class TestDownloadWithCache(object):
+    def test_second_download_comes_from_the_cache(self, cache, tmpdir, make_local_bag):
+        bag = make_local_bag(BAG_FILES)
+
+        first_stats = DownloadStats()
+        download_bag(
+            bag, out_dir=str(tmpdir.join("out1")), cache=cache, listener=first_stats
+        )
+
+        second_stats = DownloadStats()
+        download_bag(
+            bag, out_dir=str(tmpdir.join("out2")), cache=cache, listener=second_stats
+        )
+
+        assert first_stats.summary()["files"] == 3
+        assert second_stats.summary()["files"] == 0
+        assert cache.hits == 3
+        for name, contents in BAG_FILES.items():
+            assert tmpdir.join("out2", name).read_binary() == contents
+
+    def test_verify_uses_cached_files(self, cache, tmpdir, make_local_bag):
+        bag = make_local_bag(BAG_FILES)
+        download_bag(bag, out_dir=str(tmpdir.join("out1")), cache=cache)
+
+        results = download_bag(
+            bag, out_dir=str(tmpdir.join("out2")), cache=cache, verify=True
+        )
+
+        assert len(results) == 3
+        assert all(r.is_valid for r in results)
+
+    def test_files_that_fail_verification_are_not_cached(
+        self, cache, tmpdir, make_local_bag
+    ):
+        bag = make_local_bag(
+            BAG_FILES,
+            checksums={"data/b12345.xml": _sha256(b"something else")},
+        )
+
+        download_bag(bag, out_dir=str(tmpdir.join("out")), cache=cache)
+
+        assert cache.open("sha256", _sha256(b"<mets/>")) is None
+        assert cache.open("sha256", _sha256(b"something else")) is None
+        assert cache.total_bytes == len(b"BagIt-Version: 0.97\n") + 1000
+
+    def test_downloading_over_a_linked_file_does_not_change_the_cache(
+        self, cache, tmpdir, make_local_bag
+    ):
+        out_dir = str(tmpdir.join("out"))
+        v1 = make_local_bag(BAG_FILES, root="storage1")
+        download_bag(v1, out_dir=out_dir, cache=cache)
+        download_bag(v1, out_dir=out_dir, cache=cache)
+
+        v2_files = dict(BAG_FILES)
+        v2_files["data/b12345.xml"] = b"<mets>v2</mets>"
+        v2 = make_local_bag(v2_files, root="storage2")
+        download_bag(v2, out_dir=out_dir)
+
+        assert tmpdir.join("out/data/b12345.xml").read_binary() == b"<mets>v2</mets>"
+        with cache.open("sha256", _sha256(b"<mets/>")) as cached_file:
+            assert cached_file.read() == b"<mets/>"
+
+    def test_compressed_download_reads_from_the_cache(
+        self, cache, tmpdir, make_local_bag
+    ):
+        bag = make_local_bag(BAG_FILES)
+        download_bag(bag, out_dir=str(tmpdir.join("out")), cache=cache)
+
+        # Remove the bag from storage, so it can only come from the cache
+        tmpdir.join("storage").remove()
+        out_path = str(tmpdir.join("b12345.tar.gz"))
+        download_compressed_bag(bag, out_path=out_path, cache=cache)
+
+        with tarfile.open(out_path) as tf:
+            assert tf.extractfile("b12345/data/b12345.xml").read() == b"<mets/>"
+
+    @pytest.mark.parametrize("verify", [True, False])
+    def test_bag_contents_reads_from_the_cache(
+        self, cache, tmpdir, make_local_bag, verify
+    ):
+        bag = make_local_bag(BAG_FILES)
+        download_bag(bag, out_dir=str(tmpdir.join("out")), cache=cache)
+
+        # Remove the bag from storage, so it can only come from the cache
+        tmpdir.join("storage").remove()
+        contents = iter_bag_contents(bag, cache=cache, verify=verify)
+
+        assert {f["name"]: data for f, data in contents} == BAG_FILES
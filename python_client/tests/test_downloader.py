@@ -1,11 +1,1113 @@
 # -*- encoding: utf-8
 
+import hashlib
+import io
+import json
+import os
 import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from botocore.exceptions import ClientError
+import mock
 import pytest
 
-from wellcome_storage_service import downloader
+from wellcome_storage_service import (
+    BagDownloadError,
+    DownloadListener,
+    DownloadStats,
+    FileFilter,
+    FilesNotInBag,
+    FixityError,
+    StorageManifest,
+    downloader,
+)
+from wellcome_storage_service.streaming import parse_storage_manifest
+
+
+class MemoryProvider(downloader.AbstractProvider):
+    """
+    A provider that serves files from an in-memory dict of S3 keys, so we
+    can test the downloader without talking to a real bucket.
+    """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.requested_paths = []
+
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get_fileobj(self, location, manifest_file):
+        self.requested_paths.append(manifest_file["path"])
+        return io.BytesIO(self.objects[manifest_file["path"]])
+
+    def download(self, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            return super(MemoryProvider, self).download(**kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+MEMORY_BAG_FILES = {
+    "bagit.txt": b"BagIt-Version: 0.97\n",
+    "data/small.txt": b"hello world",
+    "data/medium.txt": b"m" * 1000,
+    "data/large.txt": b"L" * 100000,
+}
+
+
+@pytest.fixture
+def memory_provider(monkeypatch):
+    provider = MemoryProvider(
+        objects={
+            "v1/%s" % name: contents for name, contents in MEMORY_BAG_FILES.items()
+        }
+    )
+    monkeypatch.setattr(downloader, "_choose_provider", lambda location: provider)
+    return provider
+
+
+@pytest.fixture
+def memory_bag():
+    def _manifest_file(name):
+        return {
+            "name": name,
+            "path": "v1/%s" % name,
+            "size": len(MEMORY_BAG_FILES[name]),
+            "checksum": hashlib.sha256(MEMORY_BAG_FILES[name]).hexdigest(),
+        }
+
+    return {
+        "location": {"provider": {"id": "memory"}, "path": "space/bag"},
+        "manifest": {
+            "checksumAlgorithm": "SHA-256",
+            "files": [
+                _manifest_file(name)
+                for name in sorted(MEMORY_BAG_FILES)
+                if name.startswith("data/")
+            ],
+        },
+        "tagManifest": {
+            "checksumAlgorithm": "SHA-256",
+            "files": [_manifest_file("bagit.txt")],
+        },
+    }
+
+
+class TestConcurrentDownload(object):
+    def test_downloads_every_file(self, memory_provider, memory_bag, tmpdir):
+        downloader.download_bag(memory_bag, out_dir=str(tmpdir), max_workers=4)
+
+        assert tmpdir.join("bagit.txt").read() == "BagIt-Version: 0.97\n"
+        assert tmpdir.join("data", "small.txt").read() == "hello world"
+        assert tmpdir.join("data", "large.txt").size() == 100000
+
+    def test_schedules_largest_files_first(self, memory_provider, memory_bag, tmpdir):
+        downloader.download_bag(memory_bag, out_dir=str(tmpdir), max_workers=1)
+
+        assert memory_provider.requested_paths == [
+            "v1/data/large.txt",
+            "v1/data/medium.txt",
+            "v1/bagit.txt",
+            "v1/data/small.txt",
+        ]
+
+    def test_respects_max_in_flight_bytes(self, memory_provider, memory_bag, tmpdir):
+        downloader.download_bag(
+            memory_bag, out_dir=str(tmpdir), max_workers=4, max_in_flight_bytes=10
+        )
+
+        # Every file is bigger than the budget, so they're fetched one-by-one
+        assert memory_provider.max_in_flight == 1
+        assert len(tmpdir.join("data").listdir()) == 3
+
+    def test_reports_every_failure_without_aborting(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        del memory_provider.objects["v1/data/small.txt"]
+        del memory_provider.objects["v1/bagit.txt"]
+
+        with pytest.raises(BagDownloadError) as err:
+            downloader.download_bag(memory_bag, out_dir=str(tmpdir), max_workers=2)
+
+        failed_names = {f["name"] for f, _ in err.value.failures}
+        assert failed_names == {"data/small.txt", "bagit.txt"}
+        assert all(isinstance(e, KeyError) for _, e in err.value.failures)
+
+        # The other files were still downloaded
+        assert tmpdir.join("data", "large.txt").size() == 100000
+        assert tmpdir.join("data", "medium.txt").size() == 1000
+
+
+class TestVerifyWhileDownloading(object):
+    @pytest.mark.parametrize("max_workers", [None, 2])
+    def test_returns_verification_for_every_file(
+        self, memory_provider, memory_bag, tmpdir, max_workers
+    ):
+        results = downloader.download_bag(
+            memory_bag, out_dir=str(tmpdir), verify=True, max_workers=max_workers
+        )
+
+        assert {r.manifest_file["name"] for r in results} == set(MEMORY_BAG_FILES)
+        assert all(r.is_valid for r in results)
+
+    def test_does_not_return_results_without_verify(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        assert downloader.download_bag(memory_bag, out_dir=str(tmpdir)) is None
+
+    def test_reports_checksum_mismatch(self, memory_provider, memory_bag, tmpdir):
+        memory_provider.objects["v1/data/small.txt"] = b"HELLO WORLD"
+
+        results = downloader.download_bag(memory_bag, out_dir=str(tmpdir), verify=True)
+
+        invalid = [r for r in results if not r.is_valid]
+        assert len(invalid) == 1
+        assert invalid[0].manifest_file["name"] == "data/small.txt"
+        assert (
+            invalid[0].expected_checksum == hashlib.sha256(b"hello world").hexdigest()
+        )
+        assert invalid[0].actual_checksum == hashlib.sha256(b"HELLO WORLD").hexdigest()
+        assert invalid[0].size_matches
+
+    def test_reports_size_mismatch(self, memory_provider, memory_bag, tmpdir):
+        memory_provider.objects["v1/data/small.txt"] = b"hello world!"
+
+        results = downloader.download_bag(memory_bag, out_dir=str(tmpdir), verify=True)
+
+        invalid = [r for r in results if not r.is_valid]
+        assert len(invalid) == 1
+        assert invalid[0].expected_size == 11
+        assert invalid[0].actual_size == 12
+
+    @pytest.mark.parametrize("max_workers", [None, 2])
+    def test_fail_fast_raises_fixity_error(
+        self, memory_provider, memory_bag, tmpdir, max_workers
+    ):
+        memory_provider.objects["v1/data/large.txt"] = b"l" * 100000
+
+        with pytest.raises(FixityError, match="data/large.txt") as err:
+            downloader.download_bag(
+                memory_bag,
+                out_dir=str(tmpdir),
+                verify=True,
+                fail_fast=True,
+                max_workers=max_workers,
+            )
+
+        assert not err.value.verification.checksum_matches
+
+    def test_verifies_ranged_s3_download(self, tmpdir):
+        contents = b"x" * 5000
+
+        provider = downloader.S3InfrequentAccessProvider(
+            multipart_threshold=1000, part_size=1024
+        )
+        provider.s3_client = FakeS3Client(
+            objects={("example-bucket", "b12345/v1/data/big.mxf"): contents}
+        )
+        hasher = hashlib.sha512()
+
+        size = provider.download(
+            out_dir=str(tmpdir),
+            location={
+                "provider": {"id": "amazon-s3"},
+                "bucket": "example-bucket",
+                "path": "b12345",
+            },
+            manifest_file={
+                "name": "data/big.mxf",
+                "path": "v1/data/big.mxf",
+                "size": len(contents),
+            },
+            hasher=hasher,
+        )
+
+        assert size == len(contents)
+        assert hasher.hexdigest() == hashlib.sha512(contents).hexdigest()
+
+    def test_hashes_ranged_s3_parts_in_order(self, tmpdir):
+        contents = b"".join(bytes(bytearray([i])) * 1024 for i in range(5))
+
+        provider = downloader.S3InfrequentAccessProvider(
+            multipart_threshold=1000, part_size=1024, max_concurrency=5
+        )
+        provider.s3_client = FakeS3Client(
+            objects={("example-bucket", "b12345/v1/data/big.mxf"): contents}
+        )
+        get_object = provider.s3_client.get_object
+
+        def _get_object(**kwargs):
+            # Earlier parts take longer, so the parts arrive in reverse order
+            start = int(kwargs["Range"][len("bytes=") :].split("-")[0])
+            time.sleep(0.05 * (5 - start // 1024))
+            return get_object(**kwargs)
+
+        provider.s3_client.get_object = _get_object
+        hasher = hashlib.sha256()
+
+        size = provider.download(
+            out_dir=str(tmpdir),
+            location={
+                "provider": {"id": "amazon-s3"},
+                "bucket": "example-bucket",
+                "path": "b12345",
+            },
+            manifest_file={
+                "name": "data/big.mxf",
+                "path": "v1/data/big.mxf",
+                "size": len(contents),
+            },
+            hasher=hasher,
+        )
+
+        assert size == len(contents)
+        assert hasher.hexdigest() == hashlib.sha256(contents).hexdigest()
+        assert tmpdir.join("data", "big.mxf").read_binary() == contents
+
+
+class TestResumableDownload(object):
+    def test_skips_files_completed_by_previous_run(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        downloader.download_bag(memory_bag, out_dir=str(tmpdir), resume=True)
+        assert len(memory_provider.requested_paths) == 4
+
+        results = downloader.download_bag(
+            memory_bag, out_dir=str(tmpdir), resume=True, verify=True
+        )
+        assert len(memory_provider.requested_paths) == 4
+        assert len(results) == 4
+        assert all(r.is_valid for r in results)
+
+    def test_resumes_after_failure(self, memory_provider, memory_bag, tmpdir):
+        small = memory_provider.objects.pop("v1/data/small.txt")
+
+        with pytest.raises(BagDownloadError):
+            downloader.download_bag(
+                memory_bag, out_dir=str(tmpdir), resume=True, max_workers=2
+            )
+
+        memory_provider.objects["v1/data/small.txt"] = small
+        memory_provider.requested_paths = []
+
+        downloader.download_bag(memory_bag, out_dir=str(tmpdir), resume=True)
+
+        assert memory_provider.requested_paths == ["v1/data/small.txt"]
+        assert tmpdir.join("data", "small.txt").read() == "hello world"
+
+    def test_redownloads_files_which_have_changed_on_disk(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        downloader.download_bag(memory_bag, out_dir=str(tmpdir), resume=True)
+        tmpdir.join("data", "medium.txt").write("m" * 2000)
+        memory_provider.requested_paths = []
+
+        downloader.download_bag(memory_bag, out_dir=str(tmpdir), resume=True)
+
+        assert memory_provider.requested_paths == ["v1/data/medium.txt"]
+        assert tmpdir.join("data", "medium.txt").size() == 1000
+
+    def test_resumes_partial_file_from_offset(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        tmpdir.join("data").mkdir()
+        tmpdir.join("data", "large.txt").write("L" * 40000)
+
+        results = downloader.download_bag(
+            memory_bag, out_dir=str(tmpdir), resume=True, verify=True
+        )
+
+        assert all(r.is_valid for r in results)
+        assert tmpdir.join("data", "large.txt").read() == "L" * 100000
+
+    def test_restarts_a_resumed_file_that_does_not_match(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        tmpdir.join("data").mkdir()
+        tmpdir.join("data", "small.txt").write("HELLO")
+
+        downloader.download_bag(memory_bag, out_dir=str(tmpdir), resume=True)
+
+        assert tmpdir.join("data", "small.txt").read() == "hello world"
+        assert memory_provider.requested_paths.count("v1/data/small.txt") == 2
+
+    def test_resumed_file_that_never_matches_is_error(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        memory_provider.objects["v1/data/small.txt"] = b"HELLO WORLD"
+        tmpdir.join("data").mkdir()
+        tmpdir.join("data", "small.txt").write("HELLO")
+
+        with pytest.raises(FixityError):
+            downloader.download_bag(memory_bag, out_dir=str(tmpdir), resume=True)
+
+    def test_does_not_journal_invalid_files(self, memory_provider, memory_bag, tmpdir):
+        memory_provider.objects["v1/data/small.txt"] = b"HELLO WORLD"
+
+        downloader.download_bag(memory_bag, out_dir=str(tmpdir), resume=True)
+
+        journal = downloader._DownloadJournal(str(tmpdir))
+        assert "data/small.txt" not in journal.completed
+        assert "data/medium.txt" in journal.completed
+
+    def test_ignores_partially_written_journal_line(self, tmpdir):
+        tmpdir.join(downloader._DownloadJournal.filename).write(
+            '{"name": "bagit.txt", "size": 20, "checksum": "abc"}\n{"name": "da'
+        )
+
+        journal = downloader._DownloadJournal(str(tmpdir))
+        assert list(journal.completed) == ["bagit.txt"]
+
+    def test_s3_resumes_with_a_range_request(self, tmpdir):
+        provider = downloader.S3InfrequentAccessProvider()
+        provider.s3_client = FakeS3Client(
+            objects={("example-bucket", "b12345/v1/bagit.txt"): b"0123456789"}
+        )
+        tmpdir.join("bagit.txt").write("01234")
+        hasher = hashlib.sha256()
+
+        size = provider.download(
+            out_dir=str(tmpdir),
+            location={
+                "provider": {"id": "amazon-s3"},
+                "bucket": "example-bucket",
+                "path": "b12345",
+            },
+            manifest_file={"name": "bagit.txt", "path": "v1/bagit.txt", "size": 10},
+            hasher=hasher,
+            offset=5,
+        )
+
+        assert size == 10
+        assert provider.s3_client.requested_ranges == ["bytes=5-"]
+        assert tmpdir.join("bagit.txt").read() == "0123456789"
+        assert hasher.hexdigest() == hashlib.sha256(b"0123456789").hexdigest()
+
+
+class NonSeekableWriter(object):
+    """
+    A write-only file object that can't seek or tell, like a pipe to stdout.
+    """
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+class TestStreamingCompressedDownload(object):
+    def test_archive_contains_every_file(self, memory_provider, memory_bag, tmpdir):
+        out_path = tmpdir.join("bag.tar.gz")
+
+        downloader.download_compressed_bag(
+            memory_bag, out_path=str(out_path), top_level_dir="bag"
+        )
+
+        with tarfile.open(str(out_path), "r:gz") as tf:
+            assert tf.getnames() == [
+                "bag",
+                "bag/bagit.txt",
+                "bag/data",
+                "bag/data/large.txt",
+                "bag/data/medium.txt",
+                "bag/data/small.txt",
+            ]
+
+            for name, contents in MEMORY_BAG_FILES.items():
+                assert tf.extractfile("bag/%s" % name).read() == contents
+
+    def test_sets_mtime_to_manifest_creation_date(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        out_path = tmpdir.join("bag.tar.gz")
+        memory_bag["createdDate"] = "2019-09-12T20:26:53.094757Z"
+
+        downloader.download_compressed_bag(
+            memory_bag, out_path=str(out_path), top_level_dir="bag"
+        )
+
+        with tarfile.open(str(out_path), "r:gz") as tf:
+            assert {member.mtime for member in tf.getmembers()} == {1568320013}
+
+    def test_can_write_to_non_seekable_fileobj(self, memory_provider, memory_bag):
+        sink = NonSeekableWriter()
+
+        downloader.download_compressed_bag(
+            memory_bag, top_level_dir="bag", fileobj=sink
+        )
+
+        sink.buffer.seek(0)
+        with tarfile.open(fileobj=sink.buffer, mode="r:gz") as tf:
+            assert tf.extractfile("bag/data/small.txt").read() == b"hello world"
+
+    def test_never_stages_files_on_disk(self, memory_provider, memory_bag, tmpdir):
+        out_path = tmpdir.join("bag.tar.gz")
+
+        downloader.download_compressed_bag(
+            memory_bag, out_path=str(out_path), top_level_dir="bag"
+        )
+
+        assert tmpdir.listdir() == [out_path]
+
+    def test_size_mismatch_is_error(self, memory_provider, memory_bag, tmpdir):
+        memory_bag["manifest"]["files"][0]["size"] += 1
+
+        with pytest.raises(IOError, match="unexpected end of data"):
+            downloader.download_compressed_bag(
+                memory_bag, out_path=str(tmpdir.join("bag.tar.gz")), top_level_dir="bag"
+            )
+
+
+class TestFilteredDownload(object):
+    @pytest.mark.parametrize(
+        "file_filter, expected_paths",
+        [
+            (
+                FileFilter(include="data/*.txt"),
+                ["v1/data/large.txt", "v1/data/medium.txt", "v1/data/small.txt"],
+            ),
+            (
+                FileFilter(include=["data/s*", "bagit.txt"]),
+                ["v1/bagit.txt", "v1/data/small.txt"],
+            ),
+            (FileFilter(exclude="data/*"), ["v1/bagit.txt"]),
+            (FileFilter(names=["data/medium.txt"]), ["v1/data/medium.txt"]),
+            (
+                FileFilter(names=["bagit.txt"], include="data/l*"),
+                ["v1/bagit.txt", "v1/data/large.txt"],
+            ),
+            (
+                FileFilter(max_size=1000),
+                ["v1/bagit.txt", "v1/data/medium.txt", "v1/data/small.txt"],
+            ),
+            (FileFilter(min_size=1000), ["v1/data/large.txt", "v1/data/medium.txt"]),
+            (FileFilter(tag_files_only=True), ["v1/bagit.txt"]),
+        ],
+    )
+    def test_only_fetches_selected_files(
+        self, memory_provider, memory_bag, tmpdir, file_filter, expected_paths
+    ):
+        downloader.download_bag(
+            memory_bag, out_dir=str(tmpdir), file_filter=file_filter
+        )
+
+        assert sorted(memory_provider.requested_paths) == expected_paths
+        assert sorted(str(p.relto(tmpdir)) for p in tmpdir.visit() if p.isfile()) == [
+            path[len("v1/") :] for path in expected_paths
+        ]
+
+    def test_can_filter_a_concurrent_verified_download(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        results = downloader.download_bag(
+            memory_bag,
+            out_dir=str(tmpdir),
+            max_workers=2,
+            verify=True,
+            file_filter=FileFilter(exclude="data/large.txt"),
+        )
+
+        assert sorted(r.manifest_file["name"] for r in results) == [
+            "bagit.txt",
+            "data/medium.txt",
+            "data/small.txt",
+        ]
+        assert all(r.is_valid for r in results)
+
+    def test_missing_names_are_error_before_downloading(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        file_filter = FileFilter(names=["data/small.txt", "data/missing.txt"])
+
+        with pytest.raises(FilesNotInBag) as err:
+            downloader.download_bag(
+                memory_bag, out_dir=str(tmpdir), file_filter=file_filter
+            )
+
+        assert err.value.names == ["data/missing.txt"]
+        assert memory_provider.requested_paths == []
+
+    def test_can_filter_a_compressed_download(
+        self, memory_provider, memory_bag, tmpdir
+    ):
+        out_path = tmpdir.join("bag.tar.gz")
+
+        downloader.download_compressed_bag(
+            memory_bag,
+            out_path=str(out_path),
+            top_level_dir="bag",
+            file_filter=FileFilter(include="data/s*"),
+        )
+
+        with tarfile.open(str(out_path), "r:gz") as tf:
+            assert tf.getnames() == ["bag", "bag/data", "bag/data/small.txt"]
+
+        assert memory_provider.requested_paths == ["v1/data/small.txt"]
+
+    @pytest.mark.parametrize("file_filter", [None, FileFilter(include="data/*")])
+    def test_unverified_downloads_dont_need_a_checksum_algorithm(
+        self, memory_provider, memory_bag, tmpdir, file_filter
+    ):
+        del memory_bag["manifest"]["checksumAlgorithm"]
+        del memory_bag["tagManifest"]["checksumAlgorithm"]
+
+        downloader.download_bag(
+            memory_bag, out_dir=str(tmpdir.join("out")), file_filter=file_filter
+        )
+        downloader.download_compressed_bag(
+            memory_bag,
+            out_path=str(tmpdir.join("bag.tar.gz")),
+            top_level_dir="bag",
+            file_filter=file_filter,
+        )
+
+        assert tmpdir.join("out/data/small.txt").read() == "hello world"
+
+
+class RecordingListener(DownloadListener):
+    def __init__(self):
+        self.events = []
+        self.bytes = {}
+        self._lock = threading.Lock()
+
+    def file_started(self, manifest_file):
+        with self._lock:
+            self.events.append(("started", manifest_file["name"]))
+
+    def bytes_transferred(self, manifest_file, size, read_seconds, write_seconds):
+        assert read_seconds >= 0 and write_seconds >= 0
+        with self._lock:
+            name = manifest_file["name"]
+            self.bytes[name] = self.bytes.get(name, 0) + size
+
+    def file_retried(self, manifest_file, error):
+        with self._lock:
+            self.events.append(("retried", manifest_file["name"]))
+
+    def file_finished(self, manifest_file, size):
+        with self._lock:
+            self.events.append(("finished", manifest_file["name"]))
+
+    def file_failed(self, manifest_file, error):
+        with self._lock:
+            self.events.append(("failed", manifest_file["name"]))
+
+
+class TestDownloadListener(object):
+    @pytest.mark.parametrize("max_workers", [None, 2])
+    def test_reports_every_file(self, memory_provider, memory_bag, tmpdir, max_workers):
+        listener = RecordingListener()
+
+        downloader.download_bag(
+            memory_bag, out_dir=str(tmpdir), max_workers=max_workers, listener=listener
+        )
+
+        for name in MEMORY_BAG_FILES:
+            assert listener.events.index(("started", name)) < listener.events.index(
+                ("finished", name)
+            )
+        assert listener.bytes == {
+            name: len(contents) for name, contents in MEMORY_BAG_FILES.items()
+        }
+
+    def test_reports_failures(self, memory_provider, memory_bag, tmpdir):
+        del memory_provider.objects["v1/data/small.txt"]
+        listener = RecordingListener()
+
+        with pytest.raises(KeyError):
+            downloader.download_bag(memory_bag, out_dir=str(tmpdir), listener=listener)
+
+        assert ("failed", "data/small.txt") in listener.events
+
+    def test_reports_retries_on_another_replica(self, make_local_bag, tmpdir):
+        local_bag = make_local_bag(
+            MEMORY_BAG_FILES, root="primary", replicas=["replica"]
+        )
+        tmpdir.join("primary/space/b12345/v1/bagit.txt").remove()
+        listener = RecordingListener()
+
+        downloader.download_bag(
+            local_bag,
+            out_dir=str(tmpdir.join("out")),
+            use_replicas=True,
+            listener=listener,
+        )
+
+        assert listener.events.count(("retried", "bagit.txt")) == 1
+        assert ("finished", "bagit.txt") in listener.events
+
+    def test_reports_ranged_s3_downloads(self, tmpdir):
+        contents = b"0123456789" * 50
+        provider = downloader.S3InfrequentAccessProvider(
+            multipart_threshold=100, part_size=64
+        )
+        provider.s3_client = FakeS3Client(
+            {("bucket", "space/bag/v1/data/file"): contents}
+        )
+        listener = RecordingListener()
+
+        provider.download(
+            out_dir=str(tmpdir),
+            location={
+                "provider": {"id": "amazon-s3"},
+                "bucket": "bucket",
+                "path": "space/bag",
+            },
+            manifest_file={
+                "name": "data/file",
+                "path": "v1/data/file",
+                "size": len(contents),
+            },
+            listener=listener,
+        )
+
+        assert listener.bytes == {"data/file": len(contents)}
+
+    def test_reports_compressed_downloads(self, memory_provider, memory_bag, tmpdir):
+        listener = RecordingListener()
+
+        downloader.download_compressed_bag(
+            memory_bag,
+            out_path=str(tmpdir.join("bag.tar.gz")),
+            top_level_dir="bag",
+            listener=listener,
+        )
+
+        assert sorted(e for e in listener.events if e[0] == "finished") == sorted(
+            ("finished", name) for name in MEMORY_BAG_FILES
+        )
+        assert listener.bytes == {
+            name: len(contents) for name, contents in MEMORY_BAG_FILES.items()
+        }
+
+    def test_stats_summary(self, memory_provider, memory_bag, tmpdir):
+        stats = DownloadStats()
+
+        downloader.download_bag(
+            memory_bag, out_dir=str(tmpdir), max_workers=2, listener=stats
+        )
+        summary = stats.summary(slowest=2)
+
+        assert summary["files"] == len(MEMORY_BAG_FILES)
+        assert summary["failed"] == 0
+        assert summary["bytes"] == sum(len(c) for c in MEMORY_BAG_FILES.values())
+        assert len(summary["slowest_files"]) == 2
+        assert summary["file_throughput"]["p50"] > 0
+        assert summary["time_to_first_byte"]["p90"] >= 0
+        json.dumps(summary)
+
+
+def test_can_download_a_streamed_manifest(memory_provider, memory_bag, tmpdir):
+    body = io.BytesIO(json.dumps(memory_bag).encode("utf8"))
+
+    with parse_storage_manifest(body) as streamed_bag:
+        results = downloader.download_bag(
+            streamed_bag, out_dir=str(tmpdir), verify=True
+        )
+
+    assert len(results) == len(MEMORY_BAG_FILES)
+    assert all(r.is_valid for r in results)
+
+
+def test_can_download_a_compact_manifest(memory_provider, memory_bag, tmpdir):
+    storage_manifest = StorageManifest(memory_bag)
+
+    results = downloader.download_bag(
+        storage_manifest.to_dict(), out_dir=str(tmpdir), verify=True
+    )
+
+    assert len(results) == len(MEMORY_BAG_FILES)
+    assert all(r.is_valid for r in results)
+
+
+class TestInFlightLimiter(object):
+    def test_blocks_when_too_many_files_in_flight(self):
+        limiter = downloader._InFlightLimiter(max_files=2)
+        limiter.acquire(1)
+        limiter.acquire(1)
+        assert limiter._is_full(1)
+
+        limiter.release(1)
+        assert not limiter._is_full(1)
+
+    def test_blocks_when_too_many_bytes_in_flight(self):
+        limiter = downloader._InFlightLimiter(max_files=10, max_bytes=100)
+        limiter.acquire(60)
+        assert limiter._is_full(50)
+        assert not limiter._is_full(40)
+
+    def test_allows_oversized_file_when_empty(self):
+        limiter = downloader._InFlightLimiter(max_files=10, max_bytes=100)
+        assert not limiter._is_full(1000)
+
+
+class FakeS3Client(object):
+    """
+    Serves ``get_object`` calls from an in-memory dict of keys, including
+    requests with a Range header.
+    """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.requested_ranges = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        body = self.objects[(Bucket, Key)]
+
+        if Range is not None:
+            self.requested_ranges.append(Range)
+            start, end = Range[len("bytes=") :].split("-")
+            if end:
+                body = body[int(start) : int(end) + 1]
+            else:
+                body = body[int(start) :]
+
+        return {"Body": io.BytesIO(body)}
+
+
+class TestS3RangedDownload(object):
+    location = {
+        "provider": {"id": "amazon-s3"},
+        "bucket": "example-bucket",
+        "path": "digitised/b12345",
+    }
+
+    contents = bytes(bytearray(range(256))) * 40
+
+    @pytest.fixture
+    def provider(self):
+        provider = downloader.S3InfrequentAccessProvider(
+            multipart_threshold=1000, part_size=1024, max_concurrency=4
+        )
+        provider.s3_client = FakeS3Client(
+            objects={
+                ("example-bucket", "digitised/b12345/v1/data/big.mxf"): self.contents
+            }
+        )
+        return provider
+
+    def test_downloads_large_object_in_parts(self, provider, tmpdir):
+        provider.download(
+            out_dir=str(tmpdir),
+            location=self.location,
+            manifest_file={
+                "name": "data/big.mxf",
+                "path": "v1/data/big.mxf",
+                "size": len(self.contents),
+            },
+        )
+
+        assert tmpdir.join("data", "big.mxf").read_binary() == self.contents
+        assert sorted(provider.s3_client.requested_ranges) == sorted(
+            "bytes=%d-%d" % (start, start + 1023) for start in range(0, 10240, 1024)
+        )
+
+    @pytest.mark.parametrize(
+        "max_pool_connections, max_workers, expected",
+        [(None, 1, 10), (None, 16, 20), (100, 8, 100)],
+    )
+    def test_sizes_connection_pool_for_workers(
+        self, max_pool_connections, max_workers, expected
+    ):
+        provider = downloader.S3InfrequentAccessProvider(
+            max_concurrency=4, max_pool_connections=max_pool_connections
+        )
+        provider.set_max_workers(max_workers)
+
+        assert provider.s3_client.meta.config.max_pool_connections == expected
+
+    def test_files_share_a_bounded_pool_of_part_threads(self, provider, tmpdir):
+        part_threads = set()
+        get_object = provider.s3_client.get_object
+
+        def _get_object(**kwargs):
+            part_threads.add(threading.current_thread().ident)
+            return get_object(**kwargs)
+
+        provider.s3_client.get_object = _get_object
+
+        def _download(i):
+            provider.download(
+                out_dir=str(tmpdir.join(str(i))),
+                location=self.location,
+                manifest_file={
+                    "name": "data/big.mxf",
+                    "path": "v1/data/big.mxf",
+                    "size": len(self.contents),
+                },
+            )
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(_download, range(4)))
+
+        assert len(part_threads) <= provider.max_concurrency
+
+        provider.close()
+        assert provider._part_executor is None
+
+    def test_downloads_small_object_in_one_request(self, provider, tmpdir):
+        provider.s3_client.objects[
+            ("example-bucket", "digitised/b12345/v1/bagit.txt")
+        ] = b"BagIt-Version: 0.97\n"
+
+        provider.download(
+            out_dir=str(tmpdir),
+            location=self.location,
+            manifest_file={"name": "bagit.txt", "path": "v1/bagit.txt", "size": 20},
+        )
+
+        assert tmpdir.join("bagit.txt").read() == "BagIt-Version: 0.97\n"
+        assert provider.s3_client.requested_ranges == []
+
+    def test_failed_part_is_error(self, provider, tmpdir):
+        with pytest.raises(KeyError):
+            provider.download(
+                out_dir=str(tmpdir),
+                location=self.location,
+                manifest_file={
+                    "name": "data/missing.mxf",
+                    "path": "v1/data/missing.mxf",
+                    "size": 5000,
+                },
+            )
+
+    def test_get_range_requests_only_that_range(self, provider):
+        data = provider.get_range(
+            location=self.location,
+            manifest_file={"name": "data/big.mxf", "path": "v1/data/big.mxf"},
+            start=1000,
+            end=1099,
+        )
+
+        assert data == self.contents[1000:1100]
+        assert provider.s3_client.requested_ranges == ["bytes=1000-1099"]
+
+
+class SlowLocalFilesystemProvider(downloader.LocalFilesystemProvider):
+    def download(self, **kwargs):
+        time.sleep(0.02)
+        return super(SlowLocalFilesystemProvider, self).download(**kwargs)
+
+
+class TestReplicas(object):
+    @pytest.fixture
+    def local_bag(self, make_local_bag):
+        local_bag = make_local_bag(
+            MEMORY_BAG_FILES, root="primary", replicas=["replica"]
+        )
+        local_bag["replicaLocations"].insert(
+            0, {"provider": {"id": "aws-s3-glacier"}, "bucket": "glacier", "path": "x"}
+        )
+        return local_bag
+
+    def test_can_download_from_local_filesystem(self, local_bag, tmpdir):
+        out_dir = tmpdir.join("out")
+
+        results = downloader.download_bag(local_bag, out_dir=str(out_dir), verify=True)
+
+        assert all(r.is_valid for r in results)
+        for name, contents in MEMORY_BAG_FILES.items():
+            assert out_dir.join(name).read_binary() == contents
+
+    def test_falls_back_to_replica_if_primary_fails(self, local_bag, tmpdir):
+        tmpdir.join("primary/space/b12345/v1/data/large.txt").remove()
+
+        results = downloader.download_bag(
+            local_bag, out_dir=str(tmpdir.join("out")), verify=True, use_replicas=True
+        )
+
+        assert len(results) == len(MEMORY_BAG_FILES)
+        assert all(r.is_valid for r in results)
+
+    def test_does_not_use_replicas_by_default(self, local_bag, tmpdir):
+        tmpdir.join("primary/space/b12345/v1/data/large.txt").remove()
+
+        with pytest.raises(IOError):
+            downloader.download_bag(local_bag, out_dir=str(tmpdir.join("out")))
+
+    def test_failed_attempt_does_not_corrupt_checksum(self, local_bag, tmpdir):
+        # The primary has a truncated copy of the file, so reading it fails
+        # partway through the download.
+        tmpdir.join("primary/space/b12345/v1/data/large.txt").write_binary(b"L" * 10)
+        original_download = downloader.LocalFilesystemProvider.download
+
+        def _download(self, **kwargs):
+            size = original_download(self, **kwargs)
+            if size != kwargs["manifest_file"]["size"]:
+                raise IOError("Connection reset")
+            return size
+
+        with mock.patch.object(
+            downloader.LocalFilesystemProvider, "download", _download
+        ):
+            results = downloader.download_bag(
+                local_bag,
+                out_dir=str(tmpdir.join("out")),
+                verify=True,
+                use_replicas=True,
+            )
+
+        assert all(r.is_valid for r in results)
+
+    def test_prefers_faster_replica(self, local_bag, tmpdir, monkeypatch):
+        monkeypatch.setitem(downloader.PROVIDERS, "slow", SlowLocalFilesystemProvider)
+        local_bag["location"]["provider"]["id"] = "slow"
+        monkeypatch.setattr(
+            SlowLocalFilesystemProvider, "_local_path", _any_provider_local_path
+        )
+
+        replicas = downloader._Replicas(local_bag, use_replicas=True)
+        large_file = local_bag["manifest"]["files"][0]
+        assert large_file["name"] == "data/large.txt"
+
+        for _ in range(3):
+            replicas.download(str(tmpdir.join("out")), large_file)
+
+        fastest = replicas._ordered()[0]
+        assert fastest.location == local_bag["replicaLocations"][1]
+
+    def test_compressed_download_falls_back_to_replica(self, local_bag, tmpdir):
+        tmpdir.join("primary/space/b12345/v1/data/small.txt").remove()
+        out_path = tmpdir.join("bag.tar.gz")
+
+        downloader.download_compressed_bag(
+            local_bag, out_path=str(out_path), top_level_dir="bag", use_replicas=True
+        )
+
+        with tarfile.open(str(out_path), "r:gz") as tf:
+            assert tf.extractfile("bag/data/small.txt").read() == b"hello world"
+
+
+def _any_provider_local_path(self, location, manifest_file):
+    return os.path.join(location["bucket"], location["path"], manifest_file["path"])
+
+
+class FakeBlobServiceClient(object):
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self.blobs[(container, blob)])
+
+
+class FakeBlobClient(object):
+    def __init__(self, contents):
+        self.contents = contents
+
+    def download_blob(self, offset=0, length=None):
+        data = self.contents[offset:]
+        if length is not None:
+            data = data[:length]
+        return mock.Mock(
+            chunks=lambda: iter([data[:3], data[3:7], data[7:]]), readall=lambda: data
+        )
+
+
+class TestAzureBlobProvider(object):
+    location = {
+        "provider": {"id": "azure-blob-storage"},
+        "bucket": "container",
+        "path": "space/bag",
+    }
+
+    @pytest.fixture
+    def provider(self, monkeypatch):
+        provider = downloader.AzureBlobProvider()
+        service_client = FakeBlobServiceClient(
+            blobs={("container", "space/bag/v1/data/small.txt"): b"hello world"}
+        )
+        monkeypatch.setattr(
+            provider, "_service_client", lambda container: service_client
+        )
+        return provider
+
+    def test_can_download_blob(self, provider, tmpdir):
+        hasher = hashlib.sha256()
+        size = provider.download(
+            out_dir=str(tmpdir),
+            location=self.location,
+            manifest_file={"name": "data/small.txt", "path": "v1/data/small.txt"},
+            hasher=hasher,
+        )
+
+        assert size == 11
+        assert tmpdir.join("data/small.txt").read_binary() == b"hello world"
+        assert hasher.hexdigest() == hashlib.sha256(b"hello world").hexdigest()
+
+    def test_can_resume_blob(self, provider, tmpdir):
+        tmpdir.join("data/small.txt").write_binary(b"hello", ensure=True)
+
+        size = provider.download(
+            out_dir=str(tmpdir),
+            location=self.location,
+            manifest_file={"name": "data/small.txt", "path": "v1/data/small.txt"},
+            offset=5,
+        )
+
+        assert size == 11
+        assert tmpdir.join("data/small.txt").read_binary() == b"hello world"
+
+    def test_can_get_range_of_blob(self, provider):
+        data = provider.get_range(
+            location=self.location,
+            manifest_file={"name": "data/small.txt", "path": "v1/data/small.txt"},
+            start=2,
+            end=6,
+        )
+
+        assert data == b"llo w"
+
+
+def test_chunked_reader():
+    reader = downloader._ChunkedReader([b"hel", b"lo w", b"", b"orld"])
+
+    assert reader.read(2) == b"he"
+    assert reader.read(5) == b"llo w"
+    assert reader.read() == b"orld"
+    assert reader.read(10) == b""
+
+
+@pytest.mark.parametrize("read_size", [1, 7, 8096, 100000])
+def test_chunked_reader_reads_large_chunks(read_size):
+    chunks = [bytes(bytearray(range(256))) * 1000, b"", b"x" * 12345]
+    reader = downloader._ChunkedReader(chunks)
+    expected = io.BytesIO(b"".join(chunks))
+
+    while True:
+        data = reader.read(read_size)
+        assert data == expected.read(read_size)
+        if not data:
+            break
+
+
+class RecordingReader(object):
+    def __init__(self, contents):
+        self.file_obj = io.BytesIO(contents)
+        self.read_sizes = []
+
+    def read(self, size=-1):
+        self.read_sizes.append(size)
+        return self.file_obj.read(size)
+
+
+def test_copy_chunks_uses_chunk_size(monkeypatch):
+    monkeypatch.setattr(downloader, "CHUNK_SIZE", 4)
+    reader = RecordingReader(b"hello world")
+    out_file = io.BytesIO()
+
+    assert downloader._copy_chunks(reader, out_file) == 11
+    assert out_file.getvalue() == b"hello world"
+    assert reader.read_sizes == [4, 4, 4, 4]
 
 
 def test_cannot_download_a_bag_with_wrong_provider(tmpdir):
@@ -0,0 +1,186 @@
+# -*- encoding: utf-8
+
+import hashlib
+
+import pytest
+
+from wellcome_storage_service import (
+    BagVerificationResult,
+    download_bag,
+    verify_bag_directory,
+)
+from wellcome_storage_service import fixity
+
+BAG_FILES = {
+    "bagit.txt": b"BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n",
+    "bag-info.txt": b"External-Identifier: b12345\n",
+    "data/b12345.xml": b"<mets/>",
+    "data/objects/b12345_0001.jp2": b"1" * 1000,
+    "data/objects/b12345 0002.jp2": b"2" * 2000,
+    "data/objects/empty.txt": b"",
+}
+
+
+def _manifest(files, checksum_algorithm):
+    return b"".join(
+        b"%s  %s\n"
+        % (
+            hashlib.new(checksum_algorithm, contents).hexdigest().encode("ascii"),
+            name.encode("utf8"),
+        )
+        for name, contents in sorted(files.items())
+    )
+
+
+def _create_bag(root, files=BAG_FILES, checksum_algorithms=("sha256",)):
+    for name, contents in files.items():
+        root.join(name).write_binary(contents, ensure=True)
+
+    payload = {n: c for n, c in files.items() if n.startswith("data/")}
+    tag_files = {n: c for n, c in files.items() if not n.startswith("data/")}
+
+    for checksum_algorithm in checksum_algorithms:
+        manifest = _manifest(payload, checksum_algorithm)
+        root.join("manifest-%s.txt" % checksum_algorithm).write_binary(manifest)
+        tag_files["manifest-%s.txt" % checksum_algorithm] = manifest
+
+    for checksum_algorithm in checksum_algorithms:
+        root.join("tagmanifest-%s.txt" % checksum_algorithm).write_binary(
+            _manifest(tag_files, checksum_algorithm)
+        )
+
+    return str(root)
+
+
+@pytest.mark.parametrize("max_workers", [1, 2, None])
+def test_valid_bag_is_valid(tmpdir, max_workers):
+    bag_dir = _create_bag(tmpdir)
+
+    result = verify_bag_directory(bag_dir, max_workers=max_workers)
+
+    assert isinstance(result, BagVerificationResult)
+    assert result.is_valid
+    assert result.verified == sorted(list(BAG_FILES) + ["manifest-sha256.txt"])
+
+
+def test_reports_mismatched_missing_and_extra_files(tmpdir):
+    bag_dir = _create_bag(tmpdir)
+    tmpdir.join("data/b12345.xml").write_binary(b"<mets>changed</mets>")
+    tmpdir.join("data/objects/b12345_0001.jp2").remove()
+    tmpdir.join("data/objects/b12345_0003.jp2").write_binary(b"3")
+
+    result = verify_bag_directory(bag_dir, max_workers=2)
+
+    assert not result.is_valid
+    assert [v.manifest_file["name"] for v in result.mismatched] == ["data/b12345.xml"]
+    assert result.mismatched[0].actual_checksum == (
+        hashlib.sha256(b"<mets>changed</mets>").hexdigest()
+    )
+    assert result.missing == ["data/objects/b12345_0001.jp2"]
+    assert result.extra == ["data/objects/b12345_0003.jp2"]
+
+
+def test_reads_each_file_once_for_every_algorithm(tmpdir, monkeypatch):
+    bag_dir = _create_bag(tmpdir, checksum_algorithms=("md5", "sha256", "sha512"))
+
+    opened = []
+    hash_file = fixity._hash_file
+
+    def recording_hash_file(path, checksum_algorithms):
+        opened.append(path)
+        return hash_file(path, checksum_algorithms)
+
+    monkeypatch.setattr(fixity, "_hash_file", recording_hash_file)
+
+    result = verify_bag_directory(bag_dir, max_workers=1)
+
+    assert result.is_valid
+    assert len(opened) == len(set(opened))
+
+
+def test_reports_every_algorithm_that_does_not_match(tmpdir):
+    bag_dir = _create_bag(tmpdir, checksum_algorithms=("md5", "sha256"))
+    tmpdir.join("data/b12345.xml").write_binary(b"<mets>changed</mets>")
+
+    result = verify_bag_directory(bag_dir, max_workers=1)
+
+    assert [v.checksum_algorithm for v in result.mismatched] == ["md5", "sha256"]
+
+
+def test_decodes_percent_encoded_paths(tmpdir):
+    tmpdir.join("data/100%.txt").write_binary(b"hello world", ensure=True)
+    tmpdir.join("manifest-sha256.txt").write_binary(
+        b"%s  data/100%%25.txt\n"
+        % hashlib.sha256(b"hello world").hexdigest().encode("ascii")
+    )
+
+    result = verify_bag_directory(str(tmpdir), max_workers=1)
+
+    assert result.verified == ["data/100%.txt"]
+
+
+def test_rejects_paths_outside_the_bag(tmpdir):
+    tmpdir.join("manifest-sha256.txt").write_binary(b"abc123  data/../../etc/passwd\n")
+
+    with pytest.raises(ValueError, match="Path outside the bag"):
+        verify_bag_directory(str(tmpdir))
+
+
+def test_reports_malformed_manifest_line(tmpdir):
+    tmpdir.join("manifest-sha256.txt").write_binary(
+        b"abc123  data/b12345.xml\n\nabc123\n"
+    )
+
+    with pytest.raises(ValueError, match=r"manifest-sha256.txt, line 3: u?'abc123'"):
+        verify_bag_directory(str(tmpdir))
+
+
+def test_batches_small_files_together(monkeypatch):
+    monkeypatch.setattr(fixity, "BATCH_FILES", 2)
+    monkeypatch.setattr(fixity, "BATCH_BYTES", 100)
+
+    jobs = [(10, "a"), (200, "b"), (30, "c"), (20, "d"), (5, "e")]
+
+    assert list(fixity._make_batches(jobs)) == [["b"], ["c", "d"], ["a", "e"]]
+
+
+def test_can_verify_a_downloaded_bag(tmpdir):
+    storage_root = tmpdir.join("storage")
+    _create_bag(storage_root.join("space/b12345/v1"))
+
+    manifest_files = {"manifest": [], "tagManifest": []}
+    for path in storage_root.join("space/b12345/v1").visit(lambda p: p.isfile()):
+        name = path.relto(storage_root.join("space/b12345/v1"))
+        contents = path.read_binary()
+        manifest_files[
+            "manifest" if name.startswith("data/") else "tagManifest"
+        ].append(
+            {
+                "name": name,
+                "path": "v1/%s" % name,
+                "size": len(contents),
+                "checksum": hashlib.sha256(contents).hexdigest(),
+            }
+        )
+
+    storage_manifest = {
+        "info": {"externalIdentifier": "b12345"},
+        "location": {
+            "provider": {"id": "local-filesystem"},
+            "bucket": str(storage_root),
+            "path": "space/b12345",
+        },
+        "manifest": {
+            "checksumAlgorithm": "SHA-256",
+            "files": manifest_files["manifest"],
+        },
+        "tagManifest": {
+            "checksumAlgorithm": "SHA-256",
+            "files": manifest_files["tagManifest"],
+        },
+    }
+
+    out_dir = str(tmpdir.join("out"))
+    download_bag(storage_manifest, out_dir=out_dir)
+
+    assert verify_bag_directory(out_dir, max_workers=2).is_valid
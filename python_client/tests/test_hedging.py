@@ -0,0 +1,248 @@
+# -*- encoding: utf-8
+
+import io
+import threading
+import time
+
+import pytest
+
+from wellcome_storage_service import DownloadStats, HedgingPolicy, download_bag
+from wellcome_storage_service import downloader
+
+BAG_FILES = {
+    "bagit.txt": b"BagIt-Version: 0.97\n",
+    "data/b12345.xml": b"<mets/>",
+    "data/objects/b12345_0001.jp2": b"1" * 100,
+}
+
+
+def _primed_policy(**kwargs):
+    policy = HedgingPolicy(min_samples=1, min_delay=0.05, **kwargs)
+    policy.open(lambda: io.BytesIO(), lambda: io.BytesIO())
+    return policy
+
+
+class ClosableFile(io.BytesIO):
+    closed_event = None
+
+    def close(self):
+        super(ClosableFile, self).close()
+        if self.closed_event is not None:
+            self.closed_event.set()
+
+
+def _slow(result, seconds=0.5):
+    def open_file():
+        time.sleep(seconds)
+        return result
+
+    return open_file
+
+
+def _fail():
+    raise IOError("Connection reset")
+
+
+class TestHedgingPolicy(object):
+    def test_does_not_hedge_until_it_has_enough_timings(self):
+        policy = HedgingPolicy(min_samples=3)
+
+        for _ in range(2):
+            policy.open(lambda: io.BytesIO(), lambda: io.BytesIO())
+            assert policy.delay() is None
+
+        policy.open(lambda: io.BytesIO(), lambda: io.BytesIO())
+        assert policy.delay() is not None
+
+    def test_delay_is_percentile_of_timings(self):
+        policy = HedgingPolicy(percentile=90, min_samples=1, min_delay=0)
+        policy._latencies.extend([0.1 * i for i in range(1, 11)])
+
+        assert policy.delay() == pytest.approx(0.9)
+
+    def test_delay_is_at_least_min_delay(self):
+        policy = HedgingPolicy(min_samples=1, min_delay=0.25)
+        policy._latencies.extend([0.001] * 10)
+
+        assert policy.delay() == 0.25
+
+    def test_fast_request_is_not_hedged(self):
+        policy = _primed_policy()
+        hedged = []
+
+        read_file_obj, hedge_won = policy.open(
+            lambda: io.BytesIO(b"primary"),
+            lambda: io.BytesIO(b"hedge"),
+            on_hedge=lambda: hedged.append(True),
+        )
+
+        assert read_file_obj.read() == b"primary"
+        assert not hedge_won
+        assert hedged == []
+        assert policy.summary()["hedged"] == 0
+
+    def test_slow_request_is_hedged_and_loser_is_closed(self):
+        policy = _primed_policy()
+        hedged = []
+
+        loser = ClosableFile(b"primary")
+        loser.closed_event = threading.Event()
+
+        read_file_obj, hedge_won = policy.open(
+            _slow(loser),
+            lambda: io.BytesIO(b"hedge"),
+            on_hedge=lambda: hedged.append(1),
+        )
+
+        assert read_file_obj.read() == b"hedge"
+        assert hedge_won
+        assert hedged == [1]
+        assert loser.closed_event.wait(timeout=5)
+
+        summary = policy.summary()
+        assert summary["requests"] == 2
+        assert summary["hedged"] == 1
+        assert summary["hedge_wins"] == 1
+        assert summary["hedge_rate"] == 0.5
+
+    def test_uses_the_other_request_if_one_fails(self):
+        policy = _primed_policy()
+
+        def slow_failure():
+            time.sleep(0.2)
+            raise IOError("Connection reset")
+
+        read_file_obj, hedge_won = policy.open(
+            slow_failure, _slow(io.BytesIO(b"hedge"), seconds=0.4)
+        )
+
+        assert read_file_obj.read() == b"hedge"
+        assert hedge_won
+
+    def test_raises_primary_error_if_both_fail(self):
+        policy = _primed_policy()
+
+        def slow_failure():
+            time.sleep(0.2)
+            raise ValueError("primary failed")
+
+        with pytest.raises(ValueError, match="primary failed"):
+            policy.open(slow_failure, _fail)
+
+    def test_pool_is_sized_to_the_callers(self):
+        with HedgingPolicy() as policy:
+            policy.set_max_workers(5)
+            policy.open(lambda: io.BytesIO(), lambda: io.BytesIO())
+
+            assert policy._executor._max_workers == 10
+
+    def test_close_stops_the_pool_but_keeps_the_timings(self):
+        policy = _primed_policy()
+        policy.close()
+
+        assert policy._executor is None
+        assert policy.delay() is not None
+
+        read_file_obj, _ = policy.open(
+            lambda: io.BytesIO(b"primary"), lambda: io.BytesIO(b"hedge")
+        )
+        assert read_file_obj.read() == b"primary"
+        policy.close()
+
+    def test_time_queued_for_a_thread_does_not_count(self):
+        policy = _primed_policy()
+        release = threading.Event()
+
+        # Fill the pool, so the next request has to wait for a thread.
+        blockers = [policy._executor.submit(release.wait) for _ in range(2)]
+        time.sleep(0.2)
+        threading.Timer(0.2, release.set).start()
+
+        read_file_obj, hedge_won = policy.open(
+            lambda: io.BytesIO(b"primary"), lambda: io.BytesIO(b"hedge")
+        )
+
+        assert read_file_obj.read() == b"primary"
+        assert not hedge_won
+        assert policy.summary()["hedged"] == 0
+        assert all(b.result() for b in blockers)
+        policy.close()
+
+    def test_only_applies_to_small_files(self):
+        policy = HedgingPolicy(max_size=100)
+
+        assert policy.applies_to({"size": 100})
+        assert not policy.applies_to({"size": 101})
+        assert policy.applies_to({})
+
+
+class SlowPrimaryProvider(downloader.LocalFilesystemProvider):
+    """
+    Reads bags from a local directory, but is slow to open files in the
+    bag's primary location.
+    """
+
+    def get_fileobj(self, location, manifest_file):
+        if location["bucket"].endswith("primary"):
+            time.sleep(0.5)
+        return super(SlowPrimaryProvider, self).get_fileobj(location, manifest_file)
+
+
+@pytest.fixture
+def storage_manifest(make_local_bag, monkeypatch):
+    monkeypatch.setitem(downloader.PROVIDERS, "local-filesystem", SlowPrimaryProvider)
+    return make_local_bag(BAG_FILES, root="primary", replicas=["replica"])
+
+
+def test_download_bag_hedges_to_replica(storage_manifest, tmpdir):
+    out_dir = tmpdir.join("out")
+    policy = _primed_policy()
+    stats = DownloadStats()
+
+    results = download_bag(
+        storage_manifest,
+        out_dir=str(out_dir),
+        verify=True,
+        use_replicas=True,
+        listener=stats,
+        hedging=policy,
+    )
+
+    assert all(r.is_valid for r in results)
+    for name, contents in BAG_FILES.items():
+        assert out_dir.join(name).read_binary() == contents
+
+    # The first file is always hedged, because the primary is slower than
+    # the request we primed the policy with, and the replica always wins.
+    hedged = stats.summary()["hedged"]
+    assert hedged >= 1
+    assert policy.summary()["hedged"] == hedged
+    assert policy.summary()["hedge_wins"] == hedged
+
+
+def test_download_bag_stops_the_hedging_pool(storage_manifest, tmpdir):
+    policy = _primed_policy()
+
+    download_bag(
+        storage_manifest,
+        out_dir=str(tmpdir.join("out")),
+        max_workers=3,
+        hedging=policy,
+    )
+
+    assert policy.max_workers == 3
+    assert policy._executor is None
+
+
+def test_large_files_are_not_hedged(storage_manifest, tmpdir):
+    stats = DownloadStats()
+
+    download_bag(
+        storage_manifest,
+        out_dir=str(tmpdir.join("out")),
+        listener=stats,
+        hedging=_primed_policy(max_size=10),
+    )
+
+    # Only the 7 byte XML file is small enough to hedge
+    assert stats.summary()["hedged"] == 1
@@ -1,8 +1,19 @@
 # -*- encoding: utf-8
 
+import json
+import threading
+import time
+
 import pytest
 
+from wellcome_storage_service import (
+    BulkIngestResult,
+    StorageServiceClientBase,
+    ingest_stage_timings,
+    is_finished,
+)
 from wellcome_storage_service.exceptions import IngestNotFound, ServerError, UserError
+from wellcome_storage_service.ingests import _next_poll_delay, _parse_date
 
 
 def test_get_missing_ingest_is_error(client):
@@ -102,3 +113,257 @@ def test_it_wraps_a_4xx_as_a_usererror(client):
             s3_bucket="testing-bucket",
             s3_key="bagit.zip",
         )
+
+
+API_URL = "https://api.example.org/storage/v1"
+
+
+def _ingest(ingest_id, status, events=()):
+    return {
+        "id": ingest_id,
+        "status": {"id": status, "type": "Status"},
+        "createdDate": "2019-07-09T12:00:00.000Z",
+        "events": [
+            {"description": description, "createdDate": created_date}
+            for description, created_date in events
+        ],
+    }
+
+
+class FakeIngestsClient(StorageServiceClientBase):
+    """
+    A client that returns a scripted sequence of statuses for each ingest,
+    e.g. ``{"1": ["accepted", "processing", "succeeded"]}``.  Once we reach
+    the end of the sequence, we keep returning the last status.
+    """
+
+    def __init__(self, statuses, server_errors=0):
+        super(FakeIngestsClient, self).__init__(api_url=API_URL)
+        self.statuses = {k: list(v) for k, v in statuses.items()}
+        self.server_errors = server_errors
+        self.requested_urls = []
+        self._lock = threading.Lock()
+
+    def _http_get(self, url):
+        with self._lock:
+            self.requested_urls.append(url)
+
+            if self.server_errors:
+                self.server_errors -= 1
+                return (500, b"")
+
+            ingest_id = url.split("/")[-1]
+            try:
+                statuses = self.statuses[ingest_id]
+            except KeyError:
+                return (404, b"")
+
+            status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+
+        return (200, json.dumps(_ingest(ingest_id, status)))
+
+
+def _wait(client, ingests, **kwargs):
+    return list(
+        client.wait_for_ingests(ingests, min_interval=0, max_interval=0.01, **kwargs)
+    )
+
+
+def test_yields_ingests_as_they_finish():
+    client = FakeIngestsClient(
+        statuses={
+            "slow": ["accepted", "processing", "processing", "processing", "failed"],
+            "fast": ["processing", "succeeded"],
+            "done": ["succeeded"],
+        }
+    )
+
+    ingests = _wait(client, ["slow", "fast", "done"])
+
+    assert [i["id"] for i in ingests] == ["done", "fast", "slow"]
+    assert [i["status"]["id"] for i in ingests] == ["succeeded", "succeeded", "failed"]
+
+    # Finished ingests aren't polled again
+    assert client.requested_urls.count(API_URL + "/ingests/done") == 1
+
+
+def test_accepts_ingest_locations():
+    client = FakeIngestsClient(statuses={"123": ["succeeded"]})
+
+    ingests = _wait(client, [API_URL + "/ingests/123"])
+
+    assert [i["id"] for i in ingests] == ["123"]
+
+
+def test_retries_server_errors():
+    client = FakeIngestsClient(statuses={"123": ["succeeded"]}, server_errors=2)
+
+    ingests = _wait(client, ["123"])
+
+    assert [i["id"] for i in ingests] == ["123"]
+    assert len(client.requested_urls) == 3
+
+
+def test_missing_ingest_is_error():
+    client = FakeIngestsClient(statuses={})
+
+    with pytest.raises(IngestNotFound):
+        _wait(client, ["404"])
+
+
+def test_polls_many_ingests_concurrently():
+    statuses = {str(i): ["processing", "succeeded"] for i in range(50)}
+    client = FakeIngestsClient(statuses=statuses)
+
+    ingests = _wait(client, list(statuses), max_workers=5)
+
+    assert sorted(i["id"] for i in ingests) == sorted(statuses)
+    assert len(client.requested_urls) == 100
+
+
+@pytest.mark.parametrize(
+    "last_event, expected_delay",
+    [
+        # Something just happened, so poll again soon
+        ("2019-07-09T12:59:59.000Z", 1),
+        # Nothing for two minutes, so wait a bit longer
+        ("2019-07-09T12:58:00.000Z", 30),
+        # Nothing for hours, so wait as long as we're allowed
+        ("2019-07-09T09:00:00.000Z", 60),
+    ],
+)
+def test_poll_delay_depends_on_last_event(last_event, expected_delay):
+    ingest = _ingest("123", "processing", events=[("Unpacking started", last_event)])
+    now = _parse_date("2019-07-09T13:00:00.000Z")
+
+    delay = _next_poll_delay(ingest, now, min_interval=1, max_interval=60)
+
+    assert delay == expected_delay
+
+
+def test_stage_timings():
+    ingest = _ingest(
+        "123",
+        "succeeded",
+        events=[
+            ("Unpacking succeeded", "2019-07-09T12:00:35.500Z"),
+            ("Unpacking started", "2019-07-09T12:00:01.250Z"),
+            ("Verification succeeded", "2019-07-09T12:02:00.500Z"),
+        ],
+    )
+
+    assert is_finished(ingest)
+    assert ingest_stage_timings(ingest) == [
+        ("Unpacking started", 1.25),
+        ("Unpacking succeeded", 34.25),
+        ("Verification succeeded", 85.0),
+    ]
+
+
+def test_date_with_microseconds():
+    assert _parse_date("2019-07-09T12:39:09.835662Z") == pytest.approx(
+        1562675949.835662
+    )
+
+
+class FakeCreateIngestsClient(StorageServiceClientBase):
+    """
+    A client that creates an ingest for every POST, except for any bags
+    listed in ``responses``, which get a scripted sequence of status codes
+    first, e.g. ``{"b2": [429, 503]}``.
+    """
+
+    backoff_factor = 0.001
+
+    def __init__(self, responses=None):
+        super(FakeCreateIngestsClient, self).__init__(api_url=API_URL)
+        self.responses = responses or {}
+        self.created = []
+        self._lock = threading.Lock()
+
+    def _http_post(self, url, json):
+        external_identifier = json["bag"]["info"]["externalIdentifier"]
+
+        with self._lock:
+            scripted = self.responses.get(external_identifier)
+            if scripted:
+                status_code = scripted.pop(0)
+                body = '{"label": "Error", "description": "Scripted error"}'
+                return (status_code, {}, body)
+
+            self.created.append(external_identifier)
+            location = "%s/ingests/%s" % (API_URL, external_identifier)
+            return (201, {"Location": location}, "")
+
+
+def _ingest_requests(count):
+    for i in range(count):
+        yield {
+            "space": "digitised",
+            "external_identifier": "b%d" % i,
+            "s3_bucket": "bucket",
+            "s3_key": "b%d.tar.gz" % i,
+        }
+
+
+class TestCreateS3Ingests(object):
+    def test_creates_every_ingest(self):
+        client = FakeCreateIngestsClient()
+
+        results = list(client.create_s3_ingests(_ingest_requests(25), max_workers=4))
+
+        assert len(results) == 25
+        assert sorted(client.created) == sorted("b%d" % i for i in range(25))
+        for result in results:
+            assert isinstance(result, BulkIngestResult)
+            assert result.error is None
+            assert result.location.endswith(result.request["external_identifier"])
+
+    def test_retries_throttled_requests(self):
+        client = FakeCreateIngestsClient(responses={"b1": [429, 503, 429]})
+
+        results = list(client.create_s3_ingests(_ingest_requests(3)))
+
+        assert all(result.error is None for result in results)
+        assert sorted(client.created) == ["b0", "b1", "b2"]
+
+    def test_does_not_retry_errors_that_might_have_created_an_ingest(self):
+        client = FakeCreateIngestsClient(responses={"b1": [502]})
+
+        results = {
+            r.request["external_identifier"]: r
+            for r in client.create_s3_ingests(_ingest_requests(3))
+        }
+
+        assert isinstance(results["b1"].error, ServerError)
+        assert results["b1"].location is None
+        assert sorted(client.created) == ["b0", "b2"]
+
+    def test_user_errors_are_not_retried(self):
+        client = FakeCreateIngestsClient(responses={"b0": [400, 400]})
+
+        (result,) = client.create_s3_ingests(_ingest_requests(1))
+
+        assert isinstance(result.error, UserError)
+        assert client.responses["b0"] == [400]
+
+    def test_gives_up_after_max_retries(self):
+        client = FakeCreateIngestsClient(responses={"b0": [429] * 10})
+
+        (result,) = client.create_s3_ingests(_ingest_requests(1), max_retries=2)
+
+        assert isinstance(result.error, ServerError)
+        assert len(client.responses["b0"]) == 7
+
+    def test_limits_requests_per_second(self):
+        client = FakeCreateIngestsClient()
+
+        start = time.time()
+        list(
+            client.create_s3_ingests(
+                _ingest_requests(6), max_workers=6, max_requests_per_second=50
+            )
+        )
+
+        # Six requests at 50/second means five gaps of 20 milliseconds
+        assert time.time() - start >= 0.1
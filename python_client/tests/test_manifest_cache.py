@@ -0,0 +1,139 @@
+# -*- encoding: utf-8
+
+import json
+
+import mock
+import pytest
+
+from wellcome_storage_service import (
+    ManifestCache,
+    RequestsStorageServiceClient,
+    ServerError,
+    UserError,
+)
+
+
+def _bag_json(version):
+    return json.dumps({"id": "digitised/b12345", "version": version})
+
+
+class TestManifestCache(object):
+    def test_returns_none_for_missing_manifest(self):
+        cache = ManifestCache()
+        assert cache.get("digitised", "b12345", "v1") is None
+
+    def test_can_get_manifest_from_memory(self):
+        cache = ManifestCache()
+        cache.put("digitised", "b12345", "v1", _bag_json("v1"))
+
+        assert cache.get("digitised", "b12345", "v1") == _bag_json("v1")
+        assert cache.get("digitised", "b12345", "v2") is None
+
+    def test_evicts_least_recently_used_manifest(self):
+        cache = ManifestCache(max_memory_bytes=250)
+        cache.put("digitised", "b1", "v1", "a" * 100)
+        cache.put("digitised", "b2", "v1", "b" * 100)
+
+        # Reading b1 makes b2 the least recently used
+        cache.get("digitised", "b1", "v1")
+        cache.put("digitised", "b3", "v1", "c" * 100)
+
+        assert cache.get("digitised", "b1", "v1") is not None
+        assert cache.get("digitised", "b2", "v1") is None
+        assert cache.get("digitised", "b3", "v1") is not None
+        assert cache._memory_bytes == 200
+
+    def test_does_not_keep_manifest_bigger_than_memory_limit(self):
+        cache = ManifestCache(max_memory_bytes=10)
+        cache.put("digitised", "b1", "v1", "a" * 100)
+
+        assert cache.get("digitised", "b1", "v1") is None
+
+    def test_memory_limit_counts_bytes_not_characters(self):
+        cache = ManifestCache(max_memory_bytes=150)
+
+        # 100 characters, but 200 bytes in UTF-8
+        cache.put("digitised", "b1", "v1", b"\xc3\xa9".decode("utf8") * 100)
+
+        assert cache.get("digitised", "b1", "v1") is None
+        assert cache._memory_bytes == 0
+
+    def test_non_ascii_manifest_round_trips(self, tmpdir):
+        title = b"Caf\xc3\xa9 \xe2\x98\x83".decode("utf8")
+        body = json.dumps({"title": title}, ensure_ascii=False)
+        ManifestCache(cache_dir=str(tmpdir)).put("digitised", "b1", "v1", body)
+
+        assert ManifestCache(cache_dir=str(tmpdir)).get("digitised", "b1", "v1") == body
+
+    def test_can_get_manifest_from_disk(self, tmpdir):
+        ManifestCache(cache_dir=str(tmpdir)).put(
+            "born-digital", "PP/CRI/A/1", "v1", _bag_json("v1")
+        )
+
+        cache = ManifestCache(cache_dir=str(tmpdir))
+        assert cache.get("born-digital", "PP/CRI/A/1", "v1") == _bag_json("v1")
+
+        # Identifiers with slashes are stored as a single file
+        assert tmpdir.join("born-digital", "PP%2FCRI%2FA%2F1", "v1.json.gz").exists()
+
+
+class TestClientWithManifestCache(object):
+    @pytest.fixture
+    def client(self):
+        sess = mock.Mock()
+        sess.get.side_effect = lambda url: mock.Mock(
+            status_code=200, text=_bag_json(url.split("=")[-1] if "=" in url else "v3")
+        )
+        return RequestsStorageServiceClient(
+            api_url="https://example.org/storage/v1",
+            sess=sess,
+            manifest_cache=ManifestCache(),
+        )
+
+    def test_versioned_lookup_is_cached(self, client):
+        first = client.get_bag("digitised", "b12345", version="v1")
+        second = client.get_bag("digitised", "b12345", version="v1")
+
+        assert first == second
+        assert client.sess.get.call_count == 1
+
+    def test_cached_manifests_are_independent_copies(self, client):
+        client.get_bag("digitised", "b12345", version="v1")["version"] = "changed"
+
+        assert client.get_bag("digitised", "b12345", version="v1")["version"] == "v1"
+
+    def test_latest_version_lookup_always_goes_to_api(self, client):
+        client.get_bag("digitised", "b12345")
+        client.get_bag("digitised", "b12345")
+
+        assert client.sess.get.call_count == 2
+
+    def test_latest_version_lookup_populates_cache(self, client):
+        client.get_bag("digitised", "b12345")
+        bag = client.get_bag("digitised", "b12345", version="v3")
+
+        assert bag["version"] == "v3"
+        assert client.sess.get.call_count == 1
+
+    @pytest.mark.parametrize(
+        "status_code, body, exc_class",
+        [
+            (500, json.dumps({"label": "Internal Server Error"}), ServerError),
+            (
+                400,
+                json.dumps({"label": "Bad Request", "description": "Bad version"}),
+                UserError,
+            ),
+        ],
+    )
+    def test_error_responses_are_raised_and_not_cached(
+        self, client, status_code, body, exc_class
+    ):
+        client.sess.get.side_effect = lambda url: mock.Mock(
+            status_code=status_code, text=body
+        )
+
+        with pytest.raises(exc_class):
+            client.get_bag("digitised", "b12345", version="v1")
+
+        assert client.manifest_cache.get("digitised", "b12345", "v1") is None
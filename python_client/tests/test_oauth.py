@@ -1,5 +1,16 @@
 # -*- encoding: utf-8
 
+import json
+import os
+import stat
+import threading
+import time
+
+import mock
+
+from wellcome_storage_service import RequestsOAuthStorageServiceClient
+from wellcome_storage_service._token_cache import _read_cache, write_cached_token
+
 
 def test_refreshes_an_expired_token(client):
     client.get_ingest("025a929b-7ec4-4fe9-836a-a65b39528b09")
@@ -14,3 +25,121 @@ def test_refreshes_an_expired_token(client):
     client.get_ingest("025a929b-7ec4-4fe9-836a-a65b39528b09")
 
     assert client.sess.token["access_token"] != original_token
+
+
+def _offline_client(**kwargs):
+    """
+    Create a client whose token endpoint and API are both mocked out,
+    so we can count how many tokens it fetches.
+    """
+    client = RequestsOAuthStorageServiceClient(
+        api_url="https://example.org/storage/v1",
+        client_id="client_id",
+        client_secret="client_secret",
+        token_url="https://example.org/token",
+        **kwargs
+    )
+
+    def fetch_token(**fetch_kwargs):
+        # Sleep so that concurrent callers pile up behind the lock
+        time.sleep(0.05)
+        client.sess.token = {
+            "access_token": "token-%d" % (client.sess.fetch_token.call_count),
+            "token_type": "Bearer",
+            "expires_in": 3600,
+            "expires_at": time.time() + 3600,
+        }
+        return client.sess.token
+
+    client.sess.fetch_token = mock.Mock(side_effect=fetch_token)
+    client.sess.get = mock.Mock(return_value=mock.Mock(status_code=200, text="{}"))
+    return client
+
+
+def test_concurrent_threads_only_fetch_one_token():
+    client = _offline_client()
+
+    threads = [
+        threading.Thread(target=client.get_ingest, args=("1234",)) for _ in range(50)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert client.sess.fetch_token.call_count == 1
+    assert client.sess.get.call_count == 50
+
+
+def test_refreshes_a_token_close_to_expiry():
+    client = _offline_client()
+    client.get_ingest("1234")
+
+    client.sess.token["expires_at"] = time.time() + 5
+    client.get_ingest("1234")
+
+    assert client.sess.fetch_token.call_count == 2
+
+
+def test_reuses_token_from_cache(tmpdir):
+    cache_path = str(tmpdir.join("oauth-token-cache.json"))
+
+    first_client = _offline_client(token_cache_path=cache_path)
+    first_client.get_ingest("1234")
+    assert first_client.sess.fetch_token.call_count == 1
+
+    second_client = _offline_client(token_cache_path=cache_path)
+    second_client.get_ingest("1234")
+    assert second_client.sess.fetch_token.call_count == 0
+    assert second_client.sess.token["access_token"] == "token-1"
+
+    # The cache holds credentials, so only the owner can read it
+    assert stat.S_IMODE(os.stat(cache_path).st_mode) == 0o600
+
+
+def test_ignores_expired_token_in_cache(tmpdir):
+    cache_path = str(tmpdir.join("oauth-token-cache.json"))
+
+    first_client = _offline_client(token_cache_path=cache_path)
+    first_client.get_ingest("1234")
+
+    tokens = json.load(open(cache_path))
+    for token in tokens.values():
+        token["expires_at"] -= 7200
+    json.dump(tokens, open(cache_path, "w"))
+
+    second_client = _offline_client(token_cache_path=cache_path)
+    second_client.get_ingest("1234")
+    assert second_client.sess.fetch_token.call_count == 1
+
+
+def test_ignores_corrupt_token_cache(tmpdir):
+    cache_path = tmpdir.join("oauth-token-cache.json")
+    cache_path.write("{not json")
+
+    client = _offline_client(token_cache_path=str(cache_path))
+    client.get_ingest("1234")
+
+    assert client.sess.fetch_token.call_count == 1
+    assert len(json.load(cache_path.open())) == 1
+
+
+def test_concurrent_writers_keep_every_token(tmpdir):
+    cache_path = str(tmpdir.join("oauth-token-cache.json"))
+
+    def _write(i):
+        write_cached_token(
+            cache_path,
+            token_url="https://example.org/token",
+            client_id="client-%d" % i,
+            token={"access_token": "token-%d" % i, "expires_at": time.time() + 3600},
+        )
+
+    threads = [threading.Thread(target=_write, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(_read_cache(cache_path)) == 20
+    assert not [name for name in os.listdir(str(tmpdir)) if name.endswith(".tmp")]
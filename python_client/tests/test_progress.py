@@ -0,0 +1,51 @@
+# -*- encoding: utf-8
+
+import pytest
+
+from wellcome_storage_service import DownloadStats
+from wellcome_storage_service.progress import _percentiles
+
+
+@pytest.mark.parametrize(
+    "values, expected",
+    [
+        ([], {"p50": None, "p90": None, "p99": None}),
+        ([5], {"p50": 5, "p90": 5, "p99": 5}),
+        (list(range(1, 101)), {"p50": 50, "p90": 90, "p99": 99}),
+        ([3, 1, 2], {"p50": 2, "p90": 3, "p99": 3}),
+    ],
+)
+def test_percentiles(values, expected):
+    assert _percentiles(values) == expected
+
+
+def test_summary_of_failed_and_retried_files():
+    stats = DownloadStats()
+    small = {"name": "small.txt"}
+    large = {"name": "large.txt"}
+
+    stats.file_started(small)
+    stats.bytes_transferred(small, size=5, read_seconds=0.1, write_seconds=0.0)
+    stats.file_retried(small, error=IOError("Connection reset"))
+    stats.bytes_transferred(small, size=11, read_seconds=0.2, write_seconds=0.1)
+    stats.file_finished(small, size=11)
+
+    stats.file_started(large)
+    stats.file_failed(large, error=IOError("Access denied"))
+
+    summary = stats.summary()
+
+    assert summary["files"] == 1
+    assert summary["failed"] == 1
+    assert summary["retries"] == 1
+    assert summary["bytes"] == 11
+    assert summary["read_seconds"] == pytest.approx(0.3)
+    assert summary["write_seconds"] == pytest.approx(0.1)
+    assert [f["name"] for f in summary["slowest_files"]] == ["small.txt"]
+
+
+def test_empty_summary():
+    summary = DownloadStats().summary()
+
+    assert summary["files"] == 0
+    assert summary["throughput"] is None
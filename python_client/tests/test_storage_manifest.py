@@ -0,0 +1,105 @@
+# -*- encoding: utf-8
+
+import io
+import json
+
+import pytest
+
+from wellcome_storage_service import StorageManifest
+from wellcome_storage_service.streaming import parse_storage_manifest
+
+from test_streaming import _real_bag
+
+
+@pytest.fixture
+def bag():
+    return _real_bag()
+
+
+@pytest.fixture
+def manifest(bag):
+    return StorageManifest(bag)
+
+
+def test_looks_up_files_by_name(bag, manifest):
+    for name in ("manifest", "tagManifest"):
+        for manifest_file in bag[name]["files"]:
+            assert manifest_file["name"] in manifest
+            assert manifest[manifest_file["name"]] == manifest_file
+
+    assert len(manifest) == len(bag["manifest"]["files"]) + len(
+        bag["tagManifest"]["files"]
+    )
+
+
+def test_missing_file_is_keyerror(manifest):
+    assert "data/doesnotexist.txt" not in manifest
+    assert manifest.get("data/doesnotexist.txt") is None
+
+    with pytest.raises(KeyError):
+        manifest["data/doesnotexist.txt"]
+
+
+def test_iterates_payload_files_then_tag_files(bag, manifest):
+    assert list(manifest) == bag["manifest"]["files"] + bag["tagManifest"]["files"]
+    assert list(manifest.files(tag_files=False)) == bag["manifest"]["files"]
+
+
+def test_keeps_paths_that_are_not_prefix_and_name(bag):
+    bag["manifest"]["files"][0]["path"] = "v2/data/renamed.xml"
+    manifest = StorageManifest(bag)
+
+    assert list(manifest) == bag["manifest"]["files"] + bag["tagManifest"]["files"]
+
+
+def test_bag_level_fields(bag, manifest):
+    assert manifest.id == bag["id"]
+    assert manifest.space == bag["space"]["id"]
+    assert manifest.external_identifier == bag["info"]["externalIdentifier"]
+    assert manifest.version == bag["version"]
+    assert manifest.location == bag["location"]
+    assert manifest.replica_locations == bag["replicaLocations"]
+
+
+def test_with_prefix(manifest):
+    names = [f["name"] for f in manifest.with_prefix("data/objects/")]
+    assert names == ["data/objects/L0008210-LS-CS.jp2"]
+
+
+def test_glob(manifest):
+    names = sorted(f["name"] for f in manifest.glob("tagmanifest-*.txt"))
+    assert names == ["tagmanifest-sha256.txt", "tagmanifest-sha512.txt"]
+
+    names = [f["name"] for f in manifest.glob("data/*.xml")]
+    assert names == ["data/b11733330.xml"]
+
+
+def test_total_size(bag, manifest):
+    all_files = bag["manifest"]["files"] + bag["tagManifest"]["files"]
+    assert manifest.total_size() == sum(f["size"] for f in all_files)
+    assert manifest.total_size(prefix="data/objects/") == 1327244
+    assert manifest.total_size(prefix="nope/") == 0
+
+
+def test_tag_files_and_checksum_algorithms(manifest):
+    assert manifest.is_tag_file("bagit.txt")
+    assert not manifest.is_tag_file("data/b11733330.xml")
+    assert manifest.checksum_algorithm("data/b11733330.xml") == "sha256"
+
+
+def test_to_dict_matches_original(bag, manifest):
+    storage_manifest = manifest.to_dict()
+
+    assert storage_manifest["location"] == bag["location"]
+    for name in ("manifest", "tagManifest"):
+        assert list(storage_manifest[name]["files"]) == bag[name]["files"]
+        assert len(storage_manifest[name]["files"]) == len(bag[name]["files"])
+
+
+def test_can_build_from_a_streamed_manifest(bag):
+    body = io.BytesIO(json.dumps(bag).encode("utf8"))
+
+    with parse_storage_manifest(body) as streamed_bag:
+        manifest = StorageManifest(streamed_bag)
+
+    assert list(manifest) == bag["manifest"]["files"] + bag["tagManifest"]["files"]
@@ -0,0 +1,119 @@
+# -*- encoding: utf-8
+
+import gc
+import io
+import json
+import os
+
+import mock
+import pytest
+
+from wellcome_storage_service import RequestsStorageServiceClient
+from wellcome_storage_service.exceptions import BagNotFound
+from wellcome_storage_service.streaming import parse_storage_manifest
+
+
+def _real_bag():
+    # A real storage manifest, from the bag used in the downloader tests
+    cassette = json.load(open("tests/cassettes/test_downloading_compressed_bag.json"))
+    body = cassette["http_interactions"][1]["response"]["body"]["string"]
+    return json.loads(body)
+
+
+def _stream(bag):
+    return io.BytesIO(json.dumps(bag).encode("utf8"))
+
+
+def test_parsed_manifest_matches_json():
+    bag = _real_bag()
+
+    with parse_storage_manifest(_stream(bag)) as streamed_bag:
+        assert streamed_bag["location"] == bag["location"]
+        assert streamed_bag["info"] == bag["info"]
+        assert streamed_bag["manifest"]["checksumAlgorithm"] == "SHA-256"
+
+        for name in ("manifest", "tagManifest"):
+            assert list(streamed_bag[name]["files"]) == bag[name]["files"]
+            assert len(streamed_bag[name]["files"]) == len(bag[name]["files"])
+
+
+def test_files_can_be_iterated_more_than_once():
+    with parse_storage_manifest(_stream(_real_bag())) as streamed_bag:
+        files = streamed_bag["manifest"]["files"]
+        assert list(files) == list(files)
+
+
+def test_close_deletes_spooled_files():
+    streamed_bag = parse_storage_manifest(_stream(_real_bag()))
+    spool_path = streamed_bag["manifest"]["files"].path
+    assert os.path.exists(spool_path)
+
+    streamed_bag.close()
+    assert not os.path.exists(spool_path)
+
+
+def test_files_outlive_the_manifest():
+    streamed_bag = parse_storage_manifest(_stream(_real_bag()))
+    files = streamed_bag["manifest"]["files"]
+    spool_path = files.path
+
+    del streamed_bag
+    gc.collect()
+
+    assert len(list(files)) == len(_real_bag()["manifest"]["files"])
+
+    # The spool is deleted once nothing refers to it
+    del files
+    gc.collect()
+    assert not os.path.exists(spool_path)
+
+
+def test_handles_empty_file_list():
+    bag = _real_bag()
+    bag["tagManifest"]["files"] = []
+
+    with parse_storage_manifest(_stream(bag)) as streamed_bag:
+        assert list(streamed_bag["tagManifest"]["files"]) == []
+
+
+def test_invalid_json_is_error():
+    with pytest.raises(Exception):
+        parse_storage_manifest(io.BytesIO(b'{"manifest": {"files": [{"name": "a"'))
+
+
+class TestClientStreaming(object):
+    def _client(self, status_code, body):
+        sess = mock.Mock()
+        sess.get.return_value = mock.Mock(
+            status_code=status_code, raw=io.BytesIO(body.encode("utf8"))
+        )
+        return RequestsStorageServiceClient(
+            api_url="https://example.org/storage/v1", sess=sess
+        )
+
+    def test_can_stream_bag(self):
+        bag = _real_bag()
+        client = self._client(200, json.dumps(bag))
+
+        with client.stream_bag("digitised", "b11733330", version="v1") as streamed:
+            assert streamed["id"] == "digitised/b11733330"
+
+        client.sess.get.assert_called_once_with(
+            "https://example.org/storage/v1/bags/digitised/b11733330?version=v1",
+            stream=True,
+        )
+
+    def test_can_iterate_bag_files(self):
+        bag = _real_bag()
+        client = self._client(200, json.dumps(bag))
+
+        names = [f["name"] for f in client.iter_bag_files("digitised", "b11733330")]
+        assert names == [
+            f["name"] for f in bag["manifest"]["files"] + bag["tagManifest"]["files"]
+        ]
+
+    def test_missing_bag_is_error(self):
+        client = self._client(404, "{}")
+
+        with pytest.raises(BagNotFound):
+            client.stream_bag("digitised", "doesnotexist")
@@ -0,0 +1,174 @@
+# -*- encoding: utf-8
+
+import os
+
+import pytest
+
+from wellcome_storage_service import sync_bag, SyncResult
+from wellcome_storage_service.sync import STAGING_DIR
+
+V1_FILES = {
+    "bagit.txt": b"BagIt-Version: 0.97\n",
+    "bag-info.txt": b"External-Identifier: b12345\nPayload-Oxum: 1.1\n",
+    "data/b12345.xml": b"<mets>v1</mets>",
+    "data/objects/b12345_0001.jp2": b"1" * 100,
+    "data/objects/b12345_0002.jp2": b"2" * 100,
+    "data/objects/b12345_0003.jp2": b"3" * 200,
+}
+
+
+def _read_dir(out_dir):
+    contents = {}
+    for dirpath, _, filenames in os.walk(out_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, out_dir).replace(os.sep, "/")
+            with open(path, "rb") as infile:
+                contents[name] = infile.read()
+    return contents
+
+
+def test_sync_into_empty_directory_downloads_everything(make_local_bag, tmpdir):
+    out_dir = str(tmpdir.join("out"))
+
+    result = sync_bag(make_local_bag(V1_FILES), out_dir=out_dir)
+
+    assert isinstance(result, SyncResult)
+    assert result.downloaded == sorted(V1_FILES)
+    assert result.unchanged == []
+    assert _read_dir(out_dir) == V1_FILES
+
+
+@pytest.mark.parametrize("max_workers", [None, 4])
+@pytest.mark.parametrize("use_previous_manifest", [True, False])
+def test_sync_only_downloads_changed_files(
+    make_local_bag, tmpdir, max_workers, use_previous_manifest
+):
+    out_dir = str(tmpdir.join("out"))
+    v1 = make_local_bag(V1_FILES)
+    sync_bag(v1, out_dir=out_dir)
+
+    v2_files = dict(V1_FILES)
+    v2_files["bag-info.txt"] = b"External-Identifier: b12345\nPayload-Oxum: 2.2\n"
+    v2_files["data/b12345.xml"] = b"<mets>v2</mets>"
+    v2_files["data/objects/b12345_0004.jp2"] = b"4" * 300
+    del v2_files["data/objects/b12345_0003.jp2"]
+
+    result = sync_bag(
+        make_local_bag(v2_files, version="v2"),
+        out_dir=out_dir,
+        previous_manifest=v1 if use_previous_manifest else None,
+        max_workers=max_workers,
+    )
+
+    assert result.downloaded == [
+        "bag-info.txt",
+        "data/b12345.xml",
+        "data/objects/b12345_0004.jp2",
+    ]
+    assert result.deleted == ["data/objects/b12345_0003.jp2"]
+    assert result.unchanged == [
+        "bagit.txt",
+        "data/objects/b12345_0001.jp2",
+        "data/objects/b12345_0002.jp2",
+    ]
+    assert _read_dir(out_dir) == v2_files
+
+
+def test_renamed_files_are_moved_not_downloaded(make_local_bag, tmpdir):
+    out_dir = str(tmpdir.join("out"))
+    sync_bag(make_local_bag(V1_FILES), out_dir=out_dir)
+
+    # Swap two files, and move another into a new directory
+    v2_files = dict(V1_FILES)
+    v2_files["data/objects/b12345_0001.jp2"] = V1_FILES["data/objects/b12345_0002.jp2"]
+    v2_files["data/objects/b12345_0002.jp2"] = V1_FILES["data/objects/b12345_0001.jp2"]
+    v2_files["data/images/0003.jp2"] = v2_files.pop("data/objects/b12345_0003.jp2")
+
+    result = sync_bag(make_local_bag(v2_files, version="v2"), out_dir=out_dir)
+
+    assert result.downloaded == []
+    assert result.deleted == []
+    assert result.renamed == [
+        ("data/objects/b12345_0001.jp2", "data/objects/b12345_0002.jp2"),
+        ("data/objects/b12345_0002.jp2", "data/objects/b12345_0001.jp2"),
+        ("data/objects/b12345_0003.jp2", "data/images/0003.jp2"),
+    ]
+    assert _read_dir(out_dir) == v2_files
+    assert not os.path.exists(os.path.join(out_dir, STAGING_DIR))
+
+
+def test_file_needed_under_several_names_is_copied(make_local_bag, tmpdir):
+    out_dir = str(tmpdir.join("out"))
+    sync_bag(make_local_bag(V1_FILES), out_dir=out_dir)
+
+    v2_files = dict(V1_FILES)
+    v2_files["data/copy1.jp2"] = V1_FILES["data/objects/b12345_0001.jp2"]
+    v2_files["data/copy2.jp2"] = V1_FILES["data/objects/b12345_0001.jp2"]
+
+    result = sync_bag(make_local_bag(v2_files, version="v2"), out_dir=out_dir)
+
+    assert result.downloaded == []
+    assert _read_dir(out_dir) == v2_files
+
+
+def test_without_delete_extra_files_are_kept(make_local_bag, tmpdir):
+    out_dir = tmpdir.join("out")
+    sync_bag(make_local_bag(V1_FILES), out_dir=str(out_dir))
+    out_dir.join("notes.txt").write("my notes")
+
+    v2_files = dict(V1_FILES)
+    v2_files["data/images/0003.jp2"] = v2_files.pop("data/objects/b12345_0003.jp2")
+
+    result = sync_bag(
+        make_local_bag(v2_files, version="v2"), out_dir=str(out_dir), delete=False
+    )
+
+    assert result.deleted == []
+    assert result.renamed == [("data/objects/b12345_0003.jp2", "data/images/0003.jp2")]
+    assert out_dir.join("notes.txt").read() == "my notes"
+    assert out_dir.join("data/objects/b12345_0003.jp2").read_binary() == b"3" * 200
+
+
+def test_empty_directories_are_removed(make_local_bag, tmpdir):
+    out_dir = str(tmpdir.join("out"))
+    sync_bag(make_local_bag(V1_FILES), out_dir=out_dir)
+
+    v2_files = {
+        name: contents
+        for name, contents in V1_FILES.items()
+        if not name.startswith("data/objects/")
+    }
+    sync_bag(make_local_bag(v2_files, version="v2"), out_dir=out_dir)
+
+    assert not os.path.exists(os.path.join(out_dir, "data", "objects"))
+
+
+def test_previous_manifest_is_trusted(make_local_bag, tmpdir):
+    out_dir = tmpdir.join("out")
+    v1 = make_local_bag(V1_FILES)
+    sync_bag(v1, out_dir=str(out_dir))
+
+    # Corrupt a file without changing its size.  If we're told the directory
+    # has v1 in it, we don't read the files, so we don't notice.
+    out_dir.join("data/objects/b12345_0001.jp2").write_binary(b"X" * 100)
+
+    result = sync_bag(v1, out_dir=str(out_dir), previous_manifest=v1)
+    assert result.downloaded == []
+
+    result = sync_bag(v1, out_dir=str(out_dir))
+    assert result.downloaded == ["data/objects/b12345_0001.jp2"]
+    assert _read_dir(str(out_dir)) == V1_FILES
+
+
+def test_previous_manifest_is_ignored_for_files_with_wrong_size(make_local_bag, tmpdir):
+    out_dir = tmpdir.join("out")
+    v1 = make_local_bag(V1_FILES)
+    sync_bag(v1, out_dir=str(out_dir))
+
+    out_dir.join("data/objects/b12345_0001.jp2").write_binary(b"truncated")
+
+    result = sync_bag(v1, out_dir=str(out_dir), previous_manifest=v1)
+
+    assert result.downloaded == ["data/objects/b12345_0001.jp2"]
+    assert _read_dir(str(out_dir)) == V1_FILES
@@ -0,0 +1,242 @@
+# -*- encoding: utf-8
+
+import io
+import os
+import tarfile
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from wellcome_storage_service import StorageServiceClientBase, upload_bag
+from wellcome_storage_service.uploader import (
+    MAX_PARTS,
+    MIN_PART_SIZE,
+    _choose_part_size,
+    _MultipartUploadWriter,
+)
+
+
+class FakeMultipartS3Client(object):
+    """
+    Records the calls for S3 uploads, so we can reassemble the object that
+    would have been uploaded.
+    """
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.objects = {}
+        self.parts = {}
+        self.aborted = []
+
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            time.sleep(0.01)
+            if PartNumber == self.fail_part:
+                raise IOError("Connection reset")
+            self.parts[PartNumber] = Body
+            return {"ETag": '"etag-%d"' % PartNumber}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = MultipartUpload["Parts"]
+        assert [p["PartNumber"] for p in parts] == list(range(1, len(parts) + 1))
+        assert [p["ETag"] for p in parts] == [
+            '"etag-%d"' % p["PartNumber"] for p in parts
+        ]
+        self.objects[(Bucket, Key)] = b"".join(
+            self.parts[p["PartNumber"]] for p in parts
+        )
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+
+
+def _writer(s3_client, part_size=10, max_concurrency=2):
+    return _MultipartUploadWriter(
+        s3_client=s3_client,
+        bucket="bucket",
+        key="key",
+        part_size=part_size,
+        max_concurrency=max_concurrency,
+    )
+
+
+class TestMultipartUploadWriter(object):
+    def test_uploads_in_parts(self):
+        s3_client = FakeMultipartS3Client()
+
+        with _writer(s3_client) as writer:
+            for _ in range(10):
+                writer.write(b"abcdefg")
+
+        assert s3_client.objects[("bucket", "key")] == b"abcdefg" * 10
+        assert [len(p) for _, p in sorted(s3_client.parts.items())] == [10] * 7
+
+    def test_small_object_is_single_put(self):
+        s3_client = FakeMultipartS3Client()
+
+        with _writer(s3_client) as writer:
+            writer.write(b"hello")
+
+        assert s3_client.objects[("bucket", "key")] == b"hello"
+        assert s3_client.parts == {}
+
+    def test_limits_parts_in_flight(self):
+        s3_client = FakeMultipartS3Client()
+
+        with _writer(s3_client, max_concurrency=3) as writer:
+            for _ in range(20):
+                writer.write(b"x" * 10)
+
+        assert s3_client.max_in_flight <= 3
+
+    def test_failed_part_aborts_upload(self):
+        s3_client = FakeMultipartS3Client(fail_part=2)
+
+        with pytest.raises(IOError, match="Connection reset"):
+            with _writer(s3_client) as writer:
+                for _ in range(10):
+                    writer.write(b"x" * 10)
+
+        assert s3_client.aborted == ["upload-1"]
+        assert ("bucket", "key") not in s3_client.objects
+
+    def test_write_does_not_check_every_part(self, monkeypatch):
+        # Count how many times we look at a part's result; if every write()
+        # looked at every part so far, this would grow with the square of
+        # the number of parts.
+        checks = []
+        original_exception = Future.exception
+
+        def exception(future, *args, **kwargs):
+            checks.append(future)
+            return original_exception(future, *args, **kwargs)
+
+        monkeypatch.setattr(Future, "exception", exception)
+        s3_client = FakeMultipartS3Client()
+
+        writer = _writer(s3_client, max_concurrency=4)
+        for _ in range(2000):
+            writer.write(b"x")
+        checks_while_writing = len(checks)
+        writer.close()
+
+        assert len(s3_client.parts) == 200
+        assert checks_while_writing <= 200
+
+
+def _make_bag(bag_dir, files):
+    for name, contents in files.items():
+        bag_dir.join(name).write_binary(contents, ensure=True)
+
+
+BAG_FILES = {
+    "bagit.txt": b"BagIt-Version: 0.97\n",
+    "bag-info.txt": b"External-Identifier: b12345\n",
+    "data/b12345.xml": b"<mets/>",
+    "data/objects/b12345_0001.jp2": b"\x00\x01" * 1000,
+}
+
+
+def _archive_contents(body):
+    with tarfile.open(fileobj=io.BytesIO(body), mode="r:gz") as tf:
+        return {
+            member.name: tf.extractfile(member).read()
+            for member in tf.getmembers()
+            if member.isfile()
+        }
+
+
+def test_upload_bag(tmpdir):
+    bag_dir = tmpdir.join("bag")
+    _make_bag(bag_dir, BAG_FILES)
+    s3_client = FakeMultipartS3Client()
+
+    size = upload_bag(
+        str(bag_dir), s3_bucket="bucket", s3_key="b12345.tar.gz", s3_client=s3_client
+    )
+
+    body = s3_client.objects[("bucket", "b12345.tar.gz")]
+    assert size == len(body)
+    assert _archive_contents(body) == BAG_FILES
+    assert tmpdir.listdir() == [bag_dir]
+
+
+def test_upload_large_bag_in_parts(tmpdir):
+    bag_dir = tmpdir.join("bag")
+    files = dict(BAG_FILES)
+    files["data/objects/random.bin"] = os.urandom(int(MIN_PART_SIZE * 2.5))
+    _make_bag(bag_dir, files)
+    s3_client = FakeMultipartS3Client()
+
+    upload_bag(
+        str(bag_dir),
+        s3_bucket="bucket",
+        s3_key="b12345.tar.gz",
+        s3_client=s3_client,
+        part_size=MIN_PART_SIZE,
+    )
+
+    assert len(s3_client.parts) == 3
+    assert _archive_contents(s3_client.objects[("bucket", "b12345.tar.gz")]) == files
+
+
+@pytest.mark.parametrize(
+    "total_size, part_size, expected_part_size",
+    [
+        (100, 16 * 1024 * 1024, 16 * 1024 * 1024),
+        (100, 1024, MIN_PART_SIZE),
+        # 500 GB won't fit in 10,000 parts of 16 MiB
+        (500 * 10**9, 16 * 1024 * 1024, 500 * 10**9 // (MAX_PARTS - 1000) + 1),
+    ],
+)
+def test_choose_part_size(total_size, part_size, expected_part_size):
+    assert _choose_part_size(total_size, part_size) == expected_part_size
+
+
+class FakeIngestsClient(StorageServiceClientBase):
+    def __init__(self):
+        super(FakeIngestsClient, self).__init__(api_url="https://example.org")
+        self.payloads = []
+
+    def _http_post(self, url, json):
+        self.payloads.append(json)
+        return (201, {"Location": "https://example.org/ingests/123"}, "")
+
+
+def test_create_s3_ingest_from_directory(tmpdir):
+    bag_dir = tmpdir.join("bag")
+    _make_bag(bag_dir, BAG_FILES)
+    s3_client = FakeMultipartS3Client()
+    client = FakeIngestsClient()
+
+    location = client.create_s3_ingest_from_directory(
+        str(bag_dir),
+        space="digitised",
+        external_identifier="b12345",
+        s3_bucket="bucket",
+        s3_key="b12345.tar.gz",
+        s3_client=s3_client,
+    )
+
+    assert location == "https://example.org/ingests/123"
+    assert ("bucket", "b12345.tar.gz") in s3_client.objects
+    assert client.payloads[0]["sourceLocation"]["path"] == "b12345.tar.gz"
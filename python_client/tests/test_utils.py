@@ -1,6 +1,8 @@
 # -*- encoding: utf-8
 
 import os
+import threading
+import time
 
 import mock
 import pytest
@@ -37,3 +39,67 @@ class TestMkdirP:
         with mock.patch("wellcome_storage_service._utils.os.makedirs", m):
             with pytest.raises(OSError, match=message):
                 utils.mkdir_p(path)
+
+
+class TestRateLimiter:
+    def test_spaces_out_calls(self):
+        limiter = utils.RateLimiter(max_per_second=100)
+
+        start = time.time()
+        for _ in range(5):
+            limiter.wait()
+
+        assert time.time() - start >= 0.04
+
+    def test_unlimited_by_default(self):
+        limiter = utils.RateLimiter()
+
+        start = time.time()
+        for _ in range(100):
+            limiter.wait()
+
+        assert time.time() - start < 0.1
+
+    def test_pause_delays_next_call(self):
+        limiter = utils.RateLimiter()
+
+        limiter.pause(0.05)
+        start = time.time()
+        limiter.wait()
+
+        assert time.time() - start >= 0.04
+
+
+class TestImapUnordered:
+    def test_yields_every_result(self):
+        results = utils.imap_unordered(lambda x: x * 2, range(20), max_workers=3)
+        assert sorted(results) == [x * 2 for x in range(20)]
+
+    def test_reads_input_lazily(self):
+        consumed = []
+
+        def _items():
+            for i in range(100):
+                consumed.append(i)
+                yield i
+
+        results = utils.imap_unordered(lambda x: x, _items(), max_workers=2)
+        next(results)
+
+        assert len(consumed) < 10
+
+    def test_caps_concurrent_calls(self):
+        lock = threading.Lock()
+        state = {"in_flight": 0, "max_in_flight": 0}
+
+        def _slow(x):
+            with lock:
+                state["in_flight"] += 1
+                state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            time.sleep(0.01)
+            with lock:
+                state["in_flight"] -= 1
+
+        list(utils.imap_unordered(_slow, range(20), max_workers=4))
+
+        assert state["max_in_flight"] <= 4
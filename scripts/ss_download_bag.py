@@ -5,13 +5,18 @@ Download the contents of a bag.  Usage:
 
     python ss_download_bag.py <SPACE> <EXTERNAL_IDENTIFIER> [<VERSION>]
 
+It shows a progress bar while downloading, then prints a summary of the
+download (throughput, slowest files) as JSON to stderr, and the path to
+the downloaded bag to stdout.
+
 """
 
+import json
 import sys
 import tempfile
 
 import click
-from wellcome_storage_service import download_bag
+from wellcome_storage_service import DownloadStats, download_bag
 
 from common import get_logger
 from ss_get_bag import lookup_bag
@@ -20,11 +25,30 @@ from ss_get_bag import lookup_bag
 logger = get_logger(__name__)
 
 
-def confirm_size(storage_manifest):
+class ProgressBarStats(DownloadStats):
+    """
+    Records stats for the download, and updates a progress bar as each
+    chunk of the bag is downloaded.
+    """
+
+    def __init__(self, progress_bar):
+        super().__init__()
+        self.progress_bar = progress_bar
+
+    def bytes_transferred(self, manifest_file, size, read_seconds, write_seconds):
+        super().bytes_transferred(manifest_file, size, read_seconds, write_seconds)
+        self.progress_bar.update(size)
+
+
+def get_total_size(storage_manifest):
     all_files = (
         storage_manifest["manifest"]["files"] + storage_manifest["tagManifest"]["files"]
     )
-    total_size = sum(f["size"] for f in all_files)
+    return sum(f["size"] for f in all_files)
+
+
+def confirm_size(storage_manifest):
+    total_size = get_total_size(storage_manifest)
 
     # If the size is >100MB, double-check before initiating the download.
     if total_size > 1000 * 1000 * 1000:
@@ -57,6 +81,12 @@ if __name__ == "__main__":
 
     out_dir = tempfile.mkdtemp()
 
-    download_bag(storage_manifest=storage_manifest, out_dir=out_dir)
+    with click.progressbar(
+        length=get_total_size(storage_manifest), file=sys.stderr
+    ) as progress_bar:
+        stats = ProgressBarStats(progress_bar)
+        download_bag(storage_manifest=storage_manifest, out_dir=out_dir, listener=stats)
+
+    click.echo(json.dumps(stats.summary(), indent=2), err=True)
 
     print(out_dir)
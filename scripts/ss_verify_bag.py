@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8
+"""
+Check a bag on disk against its BagIt manifests.  Usage:
+
+    python ss_verify_bag.py <BAG_DIR> [<MAX_WORKERS>]
+
+Files are hashed on one process per CPU, unless you pass MAX_WORKERS.
+It prints any mismatched, missing or extra files, and exits with a
+non-zero status if the bag isn't valid.
+
+"""
+
+import sys
+
+import click
+from wellcome_storage_service import verify_bag_directory
+
+
+if __name__ == "__main__":
+    try:
+        bag_dir = sys.argv[1]
+    except IndexError:
+        sys.exit(f"Usage: {__file__} <BAG_DIR> [<MAX_WORKERS>]")
+
+    try:
+        max_workers = int(sys.argv[2])
+    except IndexError:
+        max_workers = None
+
+    result = verify_bag_directory(bag_dir, max_workers=max_workers)
+
+    for verification in result.mismatched:
+        click.echo(
+            f"Mismatched: {verification.manifest_file['name']} "
+            f"({verification.checksum_algorithm}: expected "
+            f"{verification.expected_checksum}, got {verification.actual_checksum})"
+        )
+
+    for name in result.missing:
+        click.echo(f"Missing:    {name}")
+
+    for name in result.extra:
+        click.echo(f"Extra:      {name}")
+
+    click.echo(
+        f"{len(result.verified)} file(s) verified, {len(result.mismatched)} "
+        f"mismatched, {len(result.missing)} missing, {len(result.extra)} extra",
+        err=True,
+    )
+
+    if not result.is_valid:
+        sys.exit(1)